@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+# Aho-Corasick automaton for finding every lexicon symbol inside a line of OCR
+# text in one pass, no matter how the OCR engine split it into words.
+# Matching is case-insensitive: keys and text are uppercased char by char
+# (chars whose uppercase is longer than one char, e.g., ß, are kept as-is so
+# that offsets still point into the original text).
+#
+# The lexicon's normalizations apply to the line too, before it's scanned:
+# the line becomes segments (text, start, end), each the normalized form of
+# line[start:end]. Char-wise normalizations (upper, nfkc, alphanumeric, ...)
+# map each segment, ones that rewrite substrings (swaps) merge the segments
+# a rewrite covers, and iter_segments reports offsets into the line.
+
+BOUNDARY_RULES = ["none", "alpha", "alnum", "token"]
+
+
+def fold(c):
+    u = c.upper()
+    return u if len(u) == 1 else c
+
+
+def is_boundary(text, start, end, rule="alnum"):
+    # none: any substring, e.g., AKT in pAKT1
+    # alpha: no letter right before or after, e.g., AKT in AKT-p or 2AKT
+    # alnum: no letter or digit right before or after
+    # token: only whitespace (or the ends of the line) before and after
+    if rule == "none":
+        return True
+    before = text[start - 1] if start > 0 else ""
+    after = text[end] if end < len(text) else ""
+    if rule == "alpha":
+        return not before.isalpha() and not after.isalpha()
+    if rule == "alnum":
+        return not before.isalnum() and not after.isalnum()
+    if rule == "token":
+        return (not before or before.isspace()) and (not after or after.isspace())
+    raise ValueError('boundary rule "%s" not recognized. Specify one: %s' % (rule, ",".join(BOUNDARY_RULES)))
+
+
+def select_longest(matches):
+    # leftmost-longest, non-overlapping subset of (start, end, key, value) matches
+    selected = []
+    last_end = 0
+    for m in sorted(matches, key=lambda m: (m[0], m[0] - m[1])):
+        if m[0] >= last_end:
+            selected.append(m)
+            last_end = m[1]
+    return selected
+
+
+class Automaton:
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        # the (key length, key, value) ending at each state, if any
+        self.own = [None]
+        # own plus the outputs of every suffix state; filled in by build
+        self.out = None
+        self.size = 0
+
+    def add(self, key, value):
+        # the first value added for a (case-folded) key wins
+        if not key:
+            return
+        state = 0
+        for c in key:
+            c = fold(c)
+            next_state = self.goto[state].get(c)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][c] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.own.append(None)
+            state = next_state
+        if self.own[state] is None:
+            self.own[state] = (len(key), key, value)
+            self.size += 1
+        self.out = None
+
+    def build(self):
+        out = [[] for _ in self.goto]
+        queue = deque()
+        for next_state in self.goto[0].values():
+            self.fail[next_state] = 0
+            queue.append(next_state)
+        while queue:
+            state = queue.popleft()
+            # breadth first, so the fail state's outputs are already complete
+            out[state] = ([self.own[state]] if self.own[state] else []) + out[self.fail[state]]
+            for c, next_state in self.goto[state].items():
+                queue.append(next_state)
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[next_state] = self.goto[f].get(c, 0)
+        self.out = out
+
+    def __len__(self):
+        return self.size
+
+    def iter(self, text, boundary="none"):
+        # yields (start, end, key, value) for every key found in text
+        if self.out is None:
+            self.build()
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for i, c in enumerate(text):
+            c = fold(c)
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for length, key, value in out[state]:
+                start = i + 1 - length
+                if is_boundary(text, start, i + 1, boundary):
+                    yield (start, i + 1, key, value)
+
+
+def get_segments(line):
+    return [(c, i, i + 1) for i, c in enumerate(line)]
+
+
+def map_segments(segments, f):
+    # f(text) => normalized text. Segments that become "" are dropped.
+    mapped = []
+    for text, start, end in segments:
+        text = f(text)
+        if text:
+            mapped.append((text, start, end))
+    return mapped
+
+
+def sub_segments(segments, pattern, replace):
+    # pattern.sub(replace, ...) over the segments' text. A replacement spans
+    # the segments its match touched, and consecutive chars with the same
+    # span make up one segment again.
+    text = "".join(segment[0] for segment in segments)
+    spans = [(start, end) for segment_text, start, end in segments for c in segment_text]
+    chars = []
+    position = 0
+    for m in pattern.finditer(text):
+        if m.start() == m.end():
+            continue
+        chars.extend(zip(text[position:m.start()], spans[position:m.start()]))
+        span = (spans[m.start()][0], spans[m.end() - 1][1])
+        chars.extend((c, span) for c in replace(m))
+        position = m.end()
+    chars.extend(zip(text[position:], spans[position:]))
+    result = []
+    for c, span in chars:
+        if result and (result[-1][1], result[-1][2]) == span:
+            result[-1] = (result[-1][0] + c, ) + span
+        else:
+            result.append((c, ) + span)
+    return result
+
+
+def iter_segments(automaton, line, segments, boundary="none"):
+    # Automaton.iter over the segments' text, yielding (start, end, key,
+    # value) with offsets into line, and boundaries checked in line
+    text = "".join(segment[0] for segment in segments)
+    starts = [start for segment_text, start, end in segments for c in segment_text]
+    ends = [end for segment_text, start, end in segments for c in segment_text]
+    for start, end, key, value in automaton.iter(text):
+        line_start = starts[start]
+        line_end = ends[end - 1]
+        if is_boundary(line, line_start, line_end, boundary):
+            yield (line_start, line_end, key, value)
@@ -0,0 +1,145 @@
+import re
+import unittest
+from aho_corasick import (
+    Automaton, get_segments, is_boundary, iter_segments, map_segments, select_longest, sub_segments)
+
+import match
+import transforms
+from transform_chain import Budget
+
+
+def build(keys):
+    automaton = Automaton()
+    for i, key in enumerate(keys):
+        automaton.add(key, i)
+    return automaton
+
+
+class TestAutomaton(unittest.TestCase):
+
+    def test_finds_overlapping_keys(self):
+        automaton = build(["AKT", "AKT1", "KT1", "PI3K"])
+        found = {(start, end, key) for start, end, key, value in automaton.iter("pAKT1/PI3K")}
+        self.assertEqual(found, {(1, 4, "AKT"), (1, 5, "AKT1"), (2, 5, "KT1"), (6, 10, "PI3K")})
+
+    def test_case_insensitive(self):
+        automaton = build(["WNT5A"])
+        self.assertEqual(list(automaton.iter("wnt5a")), [(0, 5, "WNT5A", 0)])
+
+    def test_first_value_wins(self):
+        automaton = Automaton()
+        automaton.add("TP53", 1)
+        automaton.add("tp53", 2)
+        self.assertEqual(len(automaton), 1)
+        self.assertEqual([m[3] for m in automaton.iter("TP53")], [1])
+
+    def test_fail_links(self):
+        automaton = build(["ABCD", "BCE", "CE"])
+        found = {(start, key) for start, end, key, value in automaton.iter("ABCE")}
+        self.assertEqual(found, {(1, "BCE"), (2, "CE")})
+
+    def test_offsets_survive_multichar_uppercase(self):
+        automaton = build(["AKT"])
+        self.assertEqual([m[:2] for m in automaton.iter("ßAKT")], [(1, 4)])
+
+    def test_boundaries(self):
+        automaton = build(["AKT"])
+        self.assertEqual(len(list(automaton.iter("pAKT1", "none"))), 1)
+        self.assertEqual(len(list(automaton.iter("pAKT1", "alpha"))), 0)
+        self.assertEqual(len(list(automaton.iter("2AKT-p", "alpha"))), 1)
+        self.assertEqual(len(list(automaton.iter("2AKT-p", "alnum"))), 0)
+        self.assertEqual(len(list(automaton.iter("(AKT)", "alnum"))), 1)
+        self.assertEqual(len(list(automaton.iter("(AKT)", "token"))), 0)
+        self.assertEqual(len(list(automaton.iter("a AKT b", "token"))), 1)
+        self.assertRaises(ValueError, is_boundary, "AKT", 0, 3, "nope")
+
+    def test_select_longest(self):
+        automaton = build(["AKT", "AKT1", "KT1", "PI3K"])
+        selected = select_longest(automaton.iter("pAKT1/PI3K"))
+        self.assertEqual([m[2] for m in selected], ["AKT1", "PI3K"])
+
+
+class TestSegments(unittest.TestCase):
+
+    def test_map_drops_empty(self):
+        segments = map_segments(get_segments("NF-kB"), lambda c: "" if c == "-" else c.upper())
+        self.assertEqual(segments, [("N", 0, 1), ("F", 1, 2), ("K", 3, 4), ("B", 4, 5)])
+
+    def test_sub_merges_what_a_match_covers(self):
+        segments = sub_segments(get_segments("IFNY-II"), re.compile("IFNY|II"), lambda m: {"IFNY": "IFNG", "II": "2"}[m.group(0)])
+        self.assertEqual(segments, [("IFNG", 0, 4), ("-", 4, 5), ("2", 5, 7)])
+
+    def test_sub_inside_a_merged_segment(self):
+        # ß uppercases to SS, one segment
+        segments = sub_segments(map_segments(get_segments("aß"), str.upper), re.compile("S"), lambda m: "Z")
+        self.assertEqual(segments, [("A", 0, 1), ("ZZ", 1, 2)])
+
+    def test_sub_text_is_pattern_sub(self):
+        pattern = re.compile("KAPPA|ΚΑ|II")
+        line = "nf-kappaB κaII ßII"
+        segments = sub_segments(map_segments(get_segments(line), str.upper), pattern, lambda m: "K" if m.group(0) != "II" else "2")
+        self.assertEqual("".join(segment[0] for segment in segments), pattern.sub(
+            lambda m: "K" if m.group(0) != "II" else "2", line.upper()))
+        self.assertIn(("K", 3, 8), segments)
+
+    def test_offsets_into_the_line(self):
+        automaton = build(["NFKB"])
+        line = "p-NF-κB/RELA"
+        segments = map_segments(get_segments(line), lambda c: {"κ": "K", "-": ""}.get(c, c))
+        self.assertEqual(list(iter_segments(automaton, line, segments, "none")), [(2, 7, "NFKB", 0)])
+        # boundaries are checked in the line, where "-" comes before NF
+        self.assertEqual(len(list(iter_segments(automaton, line, segments, "alnum"))), 1)
+        self.assertEqual(len(list(iter_segments(automaton, "pNF-κB", map_segments(get_segments("pNF-κB"), str.upper), "alnum"))), 0)
+
+
+class RecordingWriter:
+
+    def __init__(self):
+        self.attempts = []
+        self.offsets = []
+
+    def add(self, ocr_processor_id, matcher_id, figure_id, word, transformed_word, symbol_id, transforms_applied):
+        self.attempts.append((word, transformed_word, symbol_id))
+
+    def add_offset(self, ocr_processor_id, matcher_id, figure_id, symbol, start, end):
+        self.offsets.append((symbol, start, end))
+
+
+class TestMatchFigure(unittest.TestCase):
+
+    def match(self, names, symbols, paragraph, boundary="alnum"):
+        normalizations = [
+            {"transform": getattr(getattr(transforms, name), name), "name": name, "category": "normalize"}
+            for name in names]
+        symbol_ids_by_symbol = match.build_symbol_ids_by_symbol(
+            [{"id": i, "symbol": symbol} for i, symbol in enumerate(symbols)], normalizations)
+        matcher = {
+            "id": 1,
+            "transforms_applied_by_count": ["-a aho_corasick:" + boundary],
+            "budget": Budget(),
+            "automaton": match.build_automaton(symbol_ids_by_symbol),
+            "boundary": boundary,
+            "line_normalizations": match.get_line_normalizations(normalizations),
+        }
+        writer = RecordingWriter()
+        match.match_figure_aho_corasick(matcher, writer, 1, 1, paragraph)
+        return writer
+
+    def test_normalized_key_matches_raw_text(self):
+        # the lexicon's NF-κB is only a key as NF-KB and NFKB
+        writer = self.match(["swaps", "alphanumeric"], ["NF-κB"], "TNF\ninhibits NF-κB here")
+        self.assertIn(("NF-κB", "NFKB", 0), writer.attempts)
+        self.assertEqual(writer.offsets, [("NFKB", 13, 18)])
+
+    def test_keys_dont_match_across_words(self):
+        writer = self.match(["alphanumeric"], ["MYC"], "MY C")
+        self.assertEqual(writer.offsets, [])
+
+    def test_word_level_normalizations_only_apply_to_the_lexicon(self):
+        # so the line is scanned as is
+        writer = self.match(["stop"], ["AKT1"], "pAKT1 akt1")
+        self.assertEqual(writer.offsets, [("AKT1", 6, 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# expand vs. expand_gm, on the words from transforms/expand.test.py and on
+# the words of a synthetic corpus (see synthetic.py), e.g., with
+# --pathological-rate for more huge ranges. Also reports how many words the
+# two expand to different sets of words.
+#
+# Usage:
+#   ./benchmarks/bench_expand.py --figures 1000 [--test-repeat 2000] [--output out.json]
+
+import argparse
+from pathlib import Path, PurePath
+import re
+
+# first, for the path to the repo's modules
+import common
+import synthetic
+from bench_transforms import best_of, get_rate, get_words
+from transforms import expand, expand_gm
+
+test_word_re = re.compile(r"expand\.expand\('([^']*)'\)")
+
+
+def get_test_words():
+    with open(Path(PurePath(common.REPO_DIR, "transforms", "expand.test.py")), "r") as f:
+        return test_word_re.findall(f.read())
+
+
+def bench(words, repeat):
+    results = {"words": len(words)}
+    for name, transform in [("expand", expand.expand), ("expand_gm", expand_gm.expand_gm)]:
+        seconds, _ = best_of(repeat, lambda: [transform(word) for word in words])
+        results[name + "_words_per_second"] = get_rate(len(words), seconds)
+    results["speedup"] = round(results["expand_gm_words_per_second"] / results["expand_words_per_second"], 2)
+    different = [word for word in dict.fromkeys(words) if set(expand.expand(word)) != set(expand_gm.expand_gm(word))]
+    results["unique_words_different"] = len(different)
+    results["different_examples"] = different[0:10]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark expand_gm against expand.")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--test-repeat", type=int, default=2000,
+                        help="Times to go through the expand.test.py words, per run. Default: 2000.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs; the fastest counts. Default: 3.")
+    parser.add_argument("--output", help="Also write the JSON results to this file.")
+    args = parser.parse_args()
+
+    test_words = get_test_words()
+    lexicon, figures = synthetic.get_corpus(args)
+    corpus_words = get_words(figures)
+
+    results = {
+        "expand_test_words": bench(test_words * args.test_repeat, args.repeat),
+        "corpus_words": bench(corpus_words, args.repeat),
+    }
+    params = synthetic.get_params(args)
+    params.update({"test_repeat": args.test_repeat, "repeat": args.repeat})
+    common.write_results("expand", params, results, args.output)
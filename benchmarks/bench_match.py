@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# End-to-end benchmark of the match pipeline on a synthetic corpus (see
+# synthetic.py): build symbol_ids_by_symbol from the lexicon, then run
+# match.py's match_figure (or match_figure_aho_corasick) over every figure,
+# the same way pfocr.py match does for one process.
+#
+# Match attempts go to one of two backends:
+# * memory (default): rows are only counted, so this measures the matching
+#   itself and needs no database.
+# * postgres: rows go through MatchAttemptsWriter into transformed_words,
+#   match_attempts and match_offsets tables in a scratch schema, which is
+#   dropped afterwards. --dsn is a libpq connection string for a throwaway
+#   database, e.g., "dbname=pfocr_bench".
+#
+# Usage:
+#   ./benchmarks/bench_match.py --figures 1000 --symbols 20000 [--mode aho_corasick] [--dsn "dbname=pfocr_bench"]
+
+import argparse
+import os
+import time
+
+# first, for the path to the repo's modules
+import common
+from aho_corasick import BOUNDARY_RULES
+import db
+import synthetic
+import transforms
+from match import (
+    build_automaton, build_symbol_ids_by_symbol, get_line_normalizations, match_figure, match_figure_aho_corasick,
+    split_words)
+from match_writer import MatchAttemptsWriter
+from transform_chain import Budget, TransformCache, TransformStats
+
+DEFAULT_CHAIN = "-n stop -n nfkc -n deburr -m expand -m root -n swaps -n alphanumeric"
+OCR_PROCESSOR_ID = 1
+MATCHER_ID = 1
+
+SCRATCH_TABLES_SQL = '''
+CREATE TABLE transformed_words (
+    id serial PRIMARY KEY,
+    transformed_word text UNIQUE NOT NULL CHECK (transformed_word <> '')
+);
+CREATE TABLE match_attempts (
+    id serial PRIMARY KEY,
+    ocr_processor_id integer NOT NULL,
+    matcher_id integer NOT NULL,
+    transforms_applied text NOT NULL CHECK (transforms_applied <> ''),
+    figure_id integer NOT NULL,
+    word text NOT NULL CHECK (word <> ''),
+    transformed_word_id integer REFERENCES transformed_words,
+    symbol_id integer,
+    UNIQUE (ocr_processor_id, matcher_id, figure_id, transformed_word_id)
+);
+CREATE UNIQUE INDEX match_attempts_null_unique_idx
+ON match_attempts (ocr_processor_id, matcher_id, figure_id, transformed_word_id)
+WHERE transformed_word_id IS NULL;
+CREATE TABLE match_offsets (
+    PRIMARY KEY (ocr_processor_id, matcher_id, figure_id, start_offset, end_offset),
+    ocr_processor_id integer NOT NULL,
+    matcher_id integer NOT NULL,
+    figure_id integer NOT NULL,
+    transformed_word_id integer REFERENCES transformed_words NOT NULL,
+    start_offset integer NOT NULL,
+    end_offset integer NOT NULL
+);
+'''
+
+
+class CountingWriter:
+    # Stands in for MatchAttemptsWriter when nothing is written anywhere
+    def __init__(self):
+        self.match_attempts = 0
+        self.match_offsets = 0
+        self.transformed_words = set()
+
+    def add(self, ocr_processor_id, matcher_id, figure_id, word, transformed_word, symbol_id, transforms_applied):
+        self.match_attempts += 1
+        if transformed_word:
+            self.transformed_words.add(transformed_word)
+
+    def add_offset(self, ocr_processor_id, matcher_id, figure_id, transformed_word, start_offset, end_offset):
+        self.match_offsets += 1
+        self.transformed_words.add(transformed_word)
+
+    def flush(self):
+        pass
+
+
+def parse_chain(chain):
+    # "-n stop -m expand" => [{"category": "normalize", "name": "stop"}, {"category": "mutate", ...}]
+    categories = {"-n": "normalize", "-m": "mutate"}
+    tokens = chain.split()
+    if len(tokens) % 2 != 0 or any(flag not in categories for flag in tokens[0::2]):
+        raise Exception('transform chain "%s" not recognized. Use e.g. "-n stop -m expand"' % chain)
+    return [{"category": categories[flag], "name": name} for flag, name in zip(tokens[0::2], tokens[1::2])]
+
+
+def build_matcher(lexicon, args, mode="transforms", boundary="alnum", cache_size=100000):
+    if mode == "aho_corasick":
+        args = [arg for arg in args if arg["category"] == "normalize"]
+    transforms_to_apply = [
+        {"transform": getattr(getattr(transforms, arg["name"]), arg["name"]), "batch": transforms.get_batch(arg["name"]),
+         "name": arg["name"], "category": arg["category"]}
+        for arg in args]
+    transforms_applied_by_count = []
+    for i in range(len(args) + 1):
+        transforms_applied_by_count.append(" ".join("-" + t["category"][0] + " " + t["name"] for t in args[0:i]))
+    if mode == "aho_corasick":
+        transforms_applied_by_count[-1] = (transforms_applied_by_count[-1] + " -a aho_corasick:" + boundary).strip()
+
+    normalizations = [t for t in transforms_to_apply if t["category"] == "normalize"]
+    symbol_ids_by_symbol = build_symbol_ids_by_symbol(lexicon, normalizations)
+    matcher = {
+        "id": MATCHER_ID,
+        "transforms_to_apply": transforms_to_apply,
+        "transforms_applied_by_count": transforms_applied_by_count,
+        "symbol_ids_by_symbol": symbol_ids_by_symbol,
+        "transform_cache": TransformCache("bench", maxsize=cache_size, stats=TransformStats(transforms_to_apply)),
+        "budget": Budget(),
+        "match_figure": match_figure,
+    }
+    if mode == "aho_corasick":
+        matcher["automaton"] = build_automaton(symbol_ids_by_symbol)
+        matcher["boundary"] = boundary
+        matcher["line_normalizations"] = get_line_normalizations(normalizations)
+        matcher["match_figure"] = match_figure_aho_corasick
+    return matcher
+
+
+def count_words(figures):
+    word_count = 0
+    for figure in figures:
+        for line in figure["result"]["textAnnotations"][0]["description"].split("\n"):
+            word_count += len(split_words(line))
+    return word_count
+
+
+def run_matches(matcher, writer, figures):
+    success_count = 0
+    fail_count = 0
+    for figure in figures:
+        description = figure["result"]["textAnnotations"][0]["description"]
+        successes, fails = matcher["match_figure"](matcher, writer, OCR_PROCESSOR_ID, figure["figure_id"], description)
+        success_count += len(successes)
+        fail_count += len(fails)
+    writer.flush()
+    return success_count, fail_count
+
+
+def open_scratch_schema(dsn):
+    # a connection whose search_path starts with a new, empty schema
+    db.configure(dsn=dsn)
+    conn = db.get_conn()
+    schema = "pfocr_bench_%s" % os.getpid()
+    cur = conn.cursor()
+    cur.execute("CREATE SCHEMA %s;" % schema)
+    cur.execute("SET search_path TO %s;" % schema)
+    cur.execute(SCRATCH_TABLES_SQL)
+    cur.close()
+    conn.commit()
+    return conn, schema
+
+
+def drop_scratch_schema(conn, schema):
+    conn.rollback()
+    cur = conn.cursor()
+    cur.execute("DROP SCHEMA %s CASCADE;" % schema)
+    cur.execute("RESET search_path;")
+    cur.close()
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark matching a synthetic corpus against a synthetic lexicon.")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--chain", default=DEFAULT_CHAIN, help='Transform chain, as for pfocr.py match. Default: "%s".' % DEFAULT_CHAIN)
+    parser.add_argument("--mode", default="transforms", choices=["transforms", "aho_corasick"], help="Match mode. Default: transforms.")
+    parser.add_argument("--boundary", default="alnum", choices=BOUNDARY_RULES, help="aho_corasick word boundary. Default: alnum.")
+    parser.add_argument("--cache-size", type=int, default=100000, help="TransformCache size. Default: 100000.")
+    parser.add_argument("--dsn", help="Write match attempts to a scratch schema in this (throwaway) Postgres database.")
+    parser.add_argument("--output", help="Also write the JSON results to this file.")
+    args = parser.parse_args()
+
+    lexicon, figures = synthetic.get_corpus(args)
+    word_count = count_words(figures)
+
+    start = time.perf_counter()
+    matcher = build_matcher(lexicon, parse_chain(args.chain), args.mode, args.boundary, args.cache_size)
+    lexicon_seconds = time.perf_counter() - start
+
+    conn = schema = None
+    if args.dsn:
+        conn, schema = open_scratch_schema(args.dsn)
+        writer = MatchAttemptsWriter(conn, {})
+    else:
+        writer = CountingWriter()
+
+    try:
+        start = time.perf_counter()
+        success_count, fail_count = run_matches(matcher, writer, figures)
+        if conn:
+            conn.commit()
+        match_seconds = time.perf_counter() - start
+
+        results = {
+            "backend": "postgres" if conn else "memory",
+            "lexicon_entries": len(matcher["symbol_ids_by_symbol"]),
+            "lexicon_seconds": round(lexicon_seconds, 3),
+            "figures": len(figures),
+            "words": word_count,
+            "lines_matched": success_count,
+            "lines_unmatched": fail_count,
+            "match_seconds": round(match_seconds, 3),
+            "figures_per_second": round(len(figures) / match_seconds, 1),
+            "words_per_second": round(word_count / match_seconds, 1),
+            "quarantined": matcher["budget"].counts,
+        }
+        if conn:
+            cur = conn.cursor()
+            cur.execute("SELECT (SELECT count(*) FROM match_attempts), (SELECT count(*) FROM match_offsets);")
+            results["match_attempts"], results["match_offsets"] = cur.fetchone()
+            cur.close()
+        else:
+            results["match_attempts"] = writer.match_attempts
+            results["match_offsets"] = writer.match_offsets
+        if args.mode == "transforms":
+            results["transforms"] = [
+                {"position": position, "name": name, "category": category, "calls": calls, "seconds": round(seconds, 6),
+                 "p95_seconds": p95, "outputs": outputs, "hits": hits}
+                for position, name, category, calls, seconds, p95, outputs, hits in matcher["transform_cache"].stats.rows()]
+    finally:
+        if conn:
+            drop_scratch_schema(conn, schema)
+
+    params = synthetic.get_params(args)
+    params.update({"chain": args.chain, "mode": args.mode, "boundary": args.boundary, "cache_size": args.cache_size})
+    common.write_results("match", params, results, args.output)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Micro-benchmarks for each module in transforms/: every transform is called
+# once per word of the synthetic corpus (see synthetic.py), on its own, i.e.,
+# not as part of a chain, and without the TransformCache. Each transform's
+# batch form (see transforms/batch.py) is timed too, over the unique words,
+# and compared with the single-word function over the same words.
+#
+# Usage:
+#   ./benchmarks/bench_transforms.py --figures 200 [--transforms expand,swaps] [--output out.json]
+
+import argparse
+import time
+
+# first, for the path to the repo's modules
+import common
+import synthetic
+import transforms
+
+
+def get_words(figures):
+    words = []
+    for figure in figures:
+        for line in figure["result"]["textAnnotations"][0]["description"].split("\n"):
+            words.extend(line.split(" "))
+    return words
+
+
+def best_of(repeat, f):
+    # (seconds, result) of the fastest of repeat runs, to keep out one-off
+    # noise (e.g., a GC pass)
+    best_seconds = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        seconds = time.perf_counter() - start
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return best_seconds, result
+
+
+def get_rate(count, seconds):
+    return round(count / seconds, 1) if seconds else None
+
+
+def bench_transform(transform, transform_batch, words, repeat):
+    seconds, output_count = best_of(repeat, lambda: sum(len(transform(word)) for word in words))
+    unique_words = list(dict.fromkeys(words))
+    unique_seconds, _ = best_of(repeat, lambda: [transform(word) for word in unique_words])
+    batch_seconds, (outputs, parents) = best_of(repeat, lambda: transform_batch(unique_words))
+    return {
+        "words": len(words),
+        "seconds": round(seconds, 6),
+        "words_per_second": get_rate(len(words), seconds),
+        "outputs": output_count,
+        "unique_words": len(unique_words),
+        "unique_words_per_second": get_rate(len(unique_words), unique_seconds),
+        "batch_words_per_second": get_rate(len(unique_words), batch_seconds),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each transform on a synthetic corpus.")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--transforms", help="Comma-separated transforms. Default: all of transforms.__all__.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per transform; the fastest counts. Default: 3.")
+    parser.add_argument("--output", help="Also write the JSON results to this file.")
+    args = parser.parse_args()
+
+    names = args.transforms.split(",") if args.transforms else transforms.__all__
+    lexicon, figures = synthetic.get_corpus(args)
+    words = get_words(figures)
+
+    results = {}
+    for name in names:
+        transform = getattr(getattr(transforms, name), name)
+        results[name] = bench_transform(transform, transforms.get_batch(name), words, args.repeat)
+
+    params = synthetic.get_params(args)
+    params["repeat"] = args.repeat
+    common.write_results("transforms", params, results, args.output)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Shared by the benchmark scripts: makes the repo's modules importable from
+# benchmarks/, and writes results as one JSON object, so runs can be diffed
+# or collected over time.
+
+import json
+import os
+from pathlib import Path, PurePath
+import platform
+import resource
+import subprocess
+import sys
+
+REPO_DIR = str(Path(PurePath(os.path.dirname(os.path.abspath(__file__)), "..")).resolve())
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except(Exception):
+        return None
+
+
+def write_results(benchmark, params, results, output_path=None):
+    report = {
+        "benchmark": benchmark,
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+    }
+    report_json = json.dumps(report, indent=1, ensure_ascii=False)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(report_json + "\n")
+    print(report_json)
+    return report
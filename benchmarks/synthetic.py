@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Synthetic inputs for the benchmarks: a lexicon of gene-like symbols and
+# figures shaped like GCV results (textAnnotations[0].description), with the
+# kinds of words the transforms deal with, e.g., ranges (WNT1-3), slashes
+# (KDM6A/B), phospho prefixes (p-AKT1), Greek letters (TGF-β1), lowercase and
+# plain noise. Everything comes from one seeded random.Random, so the same
+# arguments always give the same corpus.
+#
+# Usage, to write the corpus out (lexicon.json, figures.jsonl):
+#   ./benchmarks/synthetic.py --figures 1000 --symbols 20000 out_dir
+
+import argparse
+import json
+import os
+from pathlib import Path, PurePath
+import random
+import string
+
+GREEK = ["α", "β", "γ", "δ", "κ"]
+NOISE_WORDS = [
+    "cell", "cells", "signaling", "pathway", "activation", "inhibition", "membrane", "nucleus",
+    "cytoplasm", "apoptosis", "proliferation", "survival", "growth", "receptor", "ligand",
+    "kinase", "complex", "binding", "transcription", "expression", "DNA", "RNA", "mRNA",
+    "protein", "Figure", "Fig.", "and", "or", "the", "of", "to", "in", "→", "+", "-", "?",
+    "(A)", "(B)", "ATP", "ADP", "Ca2+", "H2O", "CO2", "cAMP"]
+
+
+def make_symbol(rng):
+    # e.g., ABC12, ABCD3A, TGF-β1
+    prefix = "".join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(2, 5)))
+    number = str(rng.randint(1, 20))
+    kind = rng.random()
+    if kind < 0.1:
+        return prefix + "-" + rng.choice(GREEK) + number
+    if kind < 0.3:
+        return prefix + number + rng.choice(string.ascii_uppercase)
+    return prefix + number
+
+
+def make_lexicon(symbol_count, seed=0):
+    # [{"id", "symbol"}], like the rows of the symbols table
+    rng = random.Random(seed)
+    symbols = set()
+    while len(symbols) < symbol_count:
+        symbols.add(make_symbol(rng))
+    return [{"id": i + 1, "symbol": symbol} for i, symbol in enumerate(sorted(symbols))]
+
+
+def split_symbol(symbol):
+    # ABC12 => ("ABC", 12, ""), ABC12A => ("ABC", 12, "A"), else None
+    end = len(symbol)
+    suffix = ""
+    if end > 1 and symbol[-1].isalpha() and symbol[-2].isdigit():
+        suffix = symbol[-1]
+        end -= 1
+    start = end
+    while start > 0 and symbol[start - 1].isdigit():
+        start -= 1
+    if start == end or start == 0:
+        return None
+    return symbol[0:start], int(symbol[start:end]), suffix
+
+
+def make_word(rng, symbols, hit_rate, pathological_rate):
+    if rng.random() >= hit_rate:
+        return rng.choice(NOISE_WORDS)
+    symbol = rng.choice(symbols)
+    parts = split_symbol(symbol)
+    kind = rng.random()
+    if parts and kind < pathological_rate:
+        # a range that expands to thousands of words
+        root, number, suffix = parts
+        return "%s%s-%s" % (root, number, number + rng.randint(1000, 5000))
+    if parts and kind < 0.15:
+        root, number, suffix = parts
+        return "%s%s-%s" % (root, number, number + rng.randint(1, 4))
+    if parts and kind < 0.25:
+        root, number, suffix = parts
+        if suffix:
+            next_suffix = string.ascii_uppercase[(string.ascii_uppercase.index(suffix) + 1) % 26]
+            return "%s%s%s/%s" % (root, number, suffix, next_suffix)
+        return "%s%s/%s" % (root, number, number + rng.randint(1, 3))
+    if kind < 0.35:
+        return "p-" + symbol
+    if kind < 0.45:
+        return symbol.lower()
+    if kind < 0.5:
+        return symbol + rng.choice([",", ";", ")", ":"])
+    return symbol
+
+
+def make_description(rng, symbols, lines_per_figure, words_per_line, hit_rate, pathological_rate):
+    lines = []
+    for _ in range(max(1, int(rng.gauss(lines_per_figure, lines_per_figure / 4)))):
+        word_count = max(1, int(rng.gauss(words_per_line, words_per_line / 2)))
+        lines.append(" ".join(make_word(rng, symbols, hit_rate, pathological_rate) for _ in range(word_count)))
+    return "\n".join(lines)
+
+
+def make_figures(figure_count, lexicon, lines_per_figure=40, words_per_line=2, hit_rate=0.3, pathological_rate=0.0, seed=0):
+    # yields {"figure_id", "result"}, with result like ocr_processors__figures.result
+    rng = random.Random(seed + 1)
+    symbols = [s["symbol"] for s in lexicon]
+    for figure_id in range(1, figure_count + 1):
+        description = make_description(rng, symbols, lines_per_figure, words_per_line, hit_rate, pathological_rate)
+        yield {"figure_id": figure_id, "result": {"textAnnotations": [{"description": description}]}}
+
+
+def add_arguments(parser):
+    parser.add_argument("--figures", type=int, default=1000, help="Number of figures. Default: 1000.")
+    parser.add_argument("--symbols", type=int, default=20000, help="Number of lexicon symbols. Default: 20000.")
+    parser.add_argument("--lines-per-figure", type=int, default=40, help="Mean lines per figure. Default: 40.")
+    parser.add_argument("--words-per-line", type=int, default=2, help="Mean words per line. Default: 2.")
+    parser.add_argument("--hit-rate", type=float, default=0.3,
+                        help="Share of words that are (decorated) lexicon symbols. Default: 0.3.")
+    parser.add_argument("--pathological-rate", type=float, default=0.0,
+                        help="Share of symbol words that are huge ranges, e.g., ABC1-3000. Default: 0.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Default: 0.")
+
+
+def get_corpus(args):
+    # (lexicon, list of figures) for parsed add_arguments args
+    lexicon = make_lexicon(args.symbols, seed=args.seed)
+    figures = list(make_figures(
+        args.figures, lexicon, lines_per_figure=args.lines_per_figure, words_per_line=args.words_per_line,
+        hit_rate=args.hit_rate, pathological_rate=args.pathological_rate, seed=args.seed))
+    return lexicon, figures
+
+
+def get_params(args):
+    return {name: getattr(args, name) for name in
+            ["figures", "symbols", "lines_per_figure", "words_per_line", "hit_rate", "pathological_rate", "seed"]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic lexicon and OCR corpus.")
+    add_arguments(parser)
+    parser.add_argument("dir", help="Output directory")
+    args = parser.parse_args()
+
+    lexicon, figures = get_corpus(args)
+    os.makedirs(args.dir, exist_ok=True)
+    with open(Path(PurePath(args.dir, "lexicon.json")), "w") as f:
+        json.dump(lexicon, f, ensure_ascii=False)
+    with open(Path(PurePath(args.dir, "figures.jsonl")), "w") as f:
+        for figure in figures:
+            f.write(json.dumps(figure, ensure_ascii=False) + "\n")
+    print("wrote {symbols} symbols and {figures} figures to {dir}".format(
+        symbols=len(lexicon), figures=len(figures), dir=args.dir))
@@ -0,0 +1,25 @@
+/* Adds the figures__xrefs_materialized table to an existing database.
+Fill it for existing runs with pfocr.py summarize (or by rerunning match). */
+/*\c pfocr20200224;*/
+/*SET ROLE pfocr;*/
+
+/* figures__xrefs for one (matcher, ocr_processor), stored instead of recomputed on every query.
+Refreshed by pfocr.py match when it finishes (see summarize.refresh_figures__xrefs). */
+CREATE TABLE figures__xrefs_materialized (
+	matcher_id integer REFERENCES matchers NOT NULL,
+	ocr_processor_id integer REFERENCES ocr_processors NOT NULL,
+	figure_id integer REFERENCES figures NOT NULL,
+	pmcid text NOT NULL,
+	figure_filepath text NOT NULL,
+	word text,
+	transformed_word text NOT NULL,
+	symbol text NOT NULL,
+	hgnc_symbol text NOT NULL,
+	xref text NOT NULL,
+	in_wp_hs boolean NOT NULL,
+	source text,
+	transforms_applied text
+);
+
+CREATE INDEX figures__xrefs_materialized_run_idx
+ON figures__xrefs_materialized (matcher_id, ocr_processor_id, pmcid, figure_filepath, word);
@@ -0,0 +1,6 @@
+/* Adds the index pfocr.py export uses to read a run in figure_id order. */
+/*\c pfocr20200224;*/
+/*SET ROLE pfocr;*/
+
+CREATE INDEX figures__xrefs_materialized_figure_idx
+ON figures__xrefs_materialized (matcher_id, ocr_processor_id, figure_id);
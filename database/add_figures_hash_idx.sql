@@ -0,0 +1,5 @@
+/* Adds the index ocr_pmc.py uses to find figures with the same image. */
+/*\c pfocr20200224;*/
+/*SET ROLE pfocr;*/
+
+CREATE INDEX figures_hash_idx ON figures (hash);
@@ -0,0 +1,13 @@
+/* Adds the match_offsets table to an existing database. */
+/*\c pfocr20200224;*/
+/*SET ROLE pfocr;*/
+
+CREATE TABLE match_offsets (
+	PRIMARY KEY (ocr_processor_id, matcher_id, figure_id, start_offset, end_offset),
+	ocr_processor_id integer REFERENCES ocr_processors NOT NULL,
+	matcher_id integer REFERENCES matchers NOT NULL,
+	figure_id integer REFERENCES figures NOT NULL,
+	transformed_word_id integer REFERENCES transformed_words NOT NULL,
+	start_offset integer NOT NULL,
+	end_offset integer NOT NULL
+);
@@ -0,0 +1,13 @@
+/* Adds the ocr_failures table to an existing database. */
+/*\c pfocr20200224;*/
+/*SET ROLE pfocr;*/
+
+/* figures an ocr_processor couldn't handle (pfocr.py ocr). A later run retries them unless run with --skip-failed. */
+CREATE TABLE ocr_failures (
+	PRIMARY KEY (ocr_processor_id, figure_id),
+	ocr_processor_id integer REFERENCES ocr_processors NOT NULL,
+	figure_id integer REFERENCES figures NOT NULL,
+	error text NOT NULL,
+	attempts integer NOT NULL DEFAULT 1,
+	failed_at timestamp NOT NULL DEFAULT now()
+);
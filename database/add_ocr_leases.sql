@@ -0,0 +1,12 @@
+/* Adds the ocr_leases table to an existing database. */
+/*\c pfocr20200224;*/
+/*SET ROLE pfocr;*/
+
+/* figures claimed by a pfocr.py ocr --queue worker. Expired leases can be claimed by another worker. */
+CREATE TABLE ocr_leases (
+	PRIMARY KEY (ocr_processor_id, figure_id),
+	ocr_processor_id integer REFERENCES ocr_processors NOT NULL,
+	figure_id integer REFERENCES figures NOT NULL,
+	worker text NOT NULL,
+	leased_until timestamp NOT NULL
+);
@@ -0,0 +1,19 @@
+/* Adds the transform_stats table to an existing database. */
+/*\c pfocr20200224;*/
+/*SET ROLE pfocr;*/
+
+/* per-stage costs and hits of a matcher's transform chain, for its latest pfocr.py match run.
+calls, total_seconds, p95_seconds and outputs only count words that weren't already cached. */
+CREATE TABLE transform_stats (
+	PRIMARY KEY (matcher_id, position),
+	matcher_id integer REFERENCES matchers NOT NULL,
+	position integer NOT NULL,
+	name text NOT NULL,
+	category text NOT NULL,
+	calls bigint NOT NULL,
+	total_seconds double precision NOT NULL,
+	p95_seconds double precision NOT NULL,
+	outputs bigint NOT NULL,
+	hits bigint NOT NULL,
+	updated timestamp DEFAULT CURRENT_TIMESTAMP
+);
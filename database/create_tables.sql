@@ -95,6 +95,9 @@ CREATE TABLE figures (
 	hash text
 );
 
+/* ocr_pmc.py looks up figures with the same image by hash, to reuse their OCR results */
+CREATE INDEX figures_hash_idx ON figures (hash);
+
 CREATE TABLE ocr_processors (
         id serial PRIMARY KEY,
 	created timestamp DEFAULT CURRENT_TIMESTAMP,
@@ -156,6 +159,77 @@ CREATE UNIQUE INDEX match_attempts_null_unique_idx
 ON match_attempts (ocr_processor_id, matcher_id, figure_id, transformed_word_id)
 WHERE transformed_word_id IS NULL;
 
+/* where each hit was found in textAnnotations[0].description (pfocr.py match --mode aho_corasick) */
+CREATE TABLE match_offsets (
+	PRIMARY KEY (ocr_processor_id, matcher_id, figure_id, start_offset, end_offset),
+	ocr_processor_id integer REFERENCES ocr_processors NOT NULL,
+	matcher_id integer REFERENCES matchers NOT NULL,
+	figure_id integer REFERENCES figures NOT NULL,
+	transformed_word_id integer REFERENCES transformed_words NOT NULL,
+	start_offset integer NOT NULL,
+	end_offset integer NOT NULL
+);
+
+/* figures an ocr_processor couldn't handle (pfocr.py ocr). A later run retries them unless run with --skip-failed. */
+CREATE TABLE ocr_failures (
+	PRIMARY KEY (ocr_processor_id, figure_id),
+	ocr_processor_id integer REFERENCES ocr_processors NOT NULL,
+	figure_id integer REFERENCES figures NOT NULL,
+	error text NOT NULL,
+	attempts integer NOT NULL DEFAULT 1,
+	failed_at timestamp NOT NULL DEFAULT now()
+);
+
+/* figures claimed by a pfocr.py ocr --queue worker. Expired leases can be claimed by another worker. */
+CREATE TABLE ocr_leases (
+	PRIMARY KEY (ocr_processor_id, figure_id),
+	ocr_processor_id integer REFERENCES ocr_processors NOT NULL,
+	figure_id integer REFERENCES figures NOT NULL,
+	worker text NOT NULL,
+	leased_until timestamp NOT NULL
+);
+
+/* figures__xrefs for one (matcher, ocr_processor), stored instead of recomputed on every query.
+Refreshed by pfocr.py match when it finishes (see summarize.refresh_figures__xrefs). */
+CREATE TABLE figures__xrefs_materialized (
+	matcher_id integer REFERENCES matchers NOT NULL,
+	ocr_processor_id integer REFERENCES ocr_processors NOT NULL,
+	figure_id integer REFERENCES figures NOT NULL,
+	pmcid text NOT NULL,
+	figure_filepath text NOT NULL,
+	word text,
+	transformed_word text NOT NULL,
+	symbol text NOT NULL,
+	hgnc_symbol text NOT NULL,
+	xref text NOT NULL,
+	in_wp_hs boolean NOT NULL,
+	source text,
+	transforms_applied text
+);
+
+CREATE INDEX figures__xrefs_materialized_run_idx
+ON figures__xrefs_materialized (matcher_id, ocr_processor_id, pmcid, figure_filepath, word);
+
+/* pfocr.py export reads a run in figure_id order */
+CREATE INDEX figures__xrefs_materialized_figure_idx
+ON figures__xrefs_materialized (matcher_id, ocr_processor_id, figure_id);
+
+/* per-stage costs and hits of a matcher's transform chain, for its latest pfocr.py match run.
+calls, total_seconds, p95_seconds and outputs only count words that weren't already cached. */
+CREATE TABLE transform_stats (
+	PRIMARY KEY (matcher_id, position),
+	matcher_id integer REFERENCES matchers NOT NULL,
+	position integer NOT NULL,
+	name text NOT NULL,
+	category text NOT NULL,
+	calls bigint NOT NULL,
+	total_seconds double precision NOT NULL,
+	p95_seconds double precision NOT NULL,
+	outputs bigint NOT NULL,
+	hits bigint NOT NULL,
+	updated timestamp DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE VIEW figures__xrefs AS WITH hgnc AS (
 	SELECT xref_id, symbol
 		FROM lexicon
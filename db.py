@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Shared database access: DSN configuration, a connection pool, a helper for
+# batched statements and per-statement timing.
+#
+# DSN, in order of precedence:
+# * configure(dsn=...), e.g., from pfocr.py --dsn
+# * the PFOCR_DSN environment variable
+# * dbname=<first line of CURRENT_DB>, next to the script being run
+# Either way, libpq's own environment variables (PGHOST, PGUSER, PGPASSWORD,
+# etc.) fill in anything the DSN leaves out.
+#
+# get_conn() hands out a pooled connection. Its close() puts it back in the
+# pool (rolling back anything uncommitted) instead of disconnecting, so the
+# usual "finally: conn.close()" works unchanged.
+#
+# Every execute, executemany and copy_expert is timed, whatever the cursor
+# class. Statements are grouped by their text with literals replaced by ?,
+# so e.g. each page of an execute_values counts as the same statement.
+# Stats are per process: with match --workers, the workers' statements
+# aren't included.
+
+from itertools import islice
+import os
+from pathlib import Path, PurePath
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import re
+import sys
+import time
+
+POOL_MAX_CONNECTIONS = 8
+
+config = {"dsn": None}
+# pid => pool, so a forked child doesn't use its parent's connections
+pools = {}
+# normalized statement => [count, total seconds, max seconds, rows]
+stats = {}
+
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+VALUES_LIST_RE = re.compile(r"\(\?(?:, ?\?)*\)(?:, ?\(\?(?:, ?\?)*\))+")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def configure(dsn=None):
+    config["dsn"] = dsn
+
+
+def get_dsn():
+    if config["dsn"]:
+        return config["dsn"]
+    if os.environ.get("PFOCR_DSN"):
+        return os.environ["PFOCR_DSN"]
+    current_script_path = os.path.dirname(sys.argv[0])
+    current_db = open(Path(PurePath(current_script_path, "CURRENT_DB")), "r").read().splitlines()[0]
+    return "dbname=%s" % current_db
+
+
+def normalize_statement(statement):
+    if isinstance(statement, bytes):
+        statement = statement.decode("utf8", "replace")
+    statement = LITERAL_RE.sub("?", str(statement))
+    statement = WHITESPACE_RE.sub(" ", statement).strip()
+    return VALUES_LIST_RE.sub("(?), ...", statement)
+
+
+def record(statement, seconds, rows):
+    key = normalize_statement(statement)
+    entry = stats.get(key)
+    if entry is None:
+        entry = stats[key] = [0, 0.0, 0.0, 0]
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] = max(entry[2], seconds)
+    if rows and rows > 0:
+        entry[3] += rows
+
+
+class TimedCursorMixin:
+    def execute(self, query, vars=None):
+        start = time.monotonic()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record(query, time.monotonic() - start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        start = time.monotonic()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record(query, time.monotonic() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.monotonic()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record(sql, time.monotonic() - start, self.rowcount)
+
+
+timed_cursor_classes = {}
+
+
+def get_timed_cursor_class(cursor_factory):
+    timed_cursor_class = timed_cursor_classes.get(cursor_factory)
+    if timed_cursor_class is None:
+        timed_cursor_class = type("Timed" + cursor_factory.__name__, (TimedCursorMixin, cursor_factory), {})
+        timed_cursor_classes[cursor_factory] = timed_cursor_class
+    return timed_cursor_class
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        cursor_factory = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = get_timed_cursor_class(cursor_factory)
+        return super().cursor(*args, **kwargs)
+
+    def close(self):
+        pool = getattr(self, "pool", None)
+        if pool is None or self.closed:
+            return super().close()
+        self.pool = None
+        pool.putconn(self)
+
+
+class ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    def __init__(self, maxconn, *args, **kwargs):
+        # connections are opened as needed, but once open, up to maxconn
+        # idle ones are kept (the pool only keeps minconn idle connections)
+        super().__init__(0, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+
+    def _connect(self, key=None):
+        conn = psycopg2.connect(*self._args, connection_factory=PooledConnection, **self._kwargs)
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+        return conn
+
+    def getconn(self, key=None):
+        conn = super().getconn(key)
+        conn.pool = self
+        return conn
+
+    def putconn(self, conn, key=None, close=False):
+        # the pool closes connections it doesn't keep, e.g., broken ones
+        conn.pool = None
+        return super().putconn(conn, key, close)
+
+
+def get_pool():
+    pid = os.getpid()
+    pool = pools.get(pid)
+    if pool is None:
+        pool = pools[pid] = ConnectionPool(POOL_MAX_CONNECTIONS, get_dsn())
+    return pool
+
+
+def get_conn():
+    return get_pool().getconn()
+
+
+def close_all():
+    pool = pools.pop(os.getpid(), None)
+    if pool:
+        pool.closeall()
+
+
+def execute_batches(cur, sql, rows, template=None, page_size=1000):
+    # Runs sql (with a single VALUES %s) over rows, page_size rows per
+    # statement, without building the whole list. Returns the total row count.
+    rows = iter(rows)
+    row_count = 0
+    while True:
+        page = list(islice(rows, page_size))
+        if not page:
+            return row_count
+        psycopg2.extras.execute_values(cur, sql, page, template=template, page_size=len(page))
+        if cur.rowcount > 0:
+            row_count += cur.rowcount
+
+
+def get_slowest(limit=20):
+    # [(statement, count, total seconds, max seconds, rows)], by total time
+    return sorted(
+        ((statement, count, total, max_seconds, rows) for statement, (count, total, max_seconds, rows) in stats.items()),
+        key=lambda s: s[2], reverse=True)[0:limit]
+
+
+def report(limit=20, width=160):
+    lines = ['db stats: {count} statements, {total:.2f}s total. Slowest:'.format(
+        count=sum(entry[0] for entry in stats.values()), total=sum(entry[1] for entry in stats.values()))]
+    lines.append('{:>10} {:>8} {:>10} {:>12}  {}'.format("total(s)", "calls", "max(s)", "rows", "statement"))
+    for statement, count, total, max_seconds, rows in get_slowest(limit):
+        if len(statement) > width:
+            statement = statement[0:width - 3] + "..."
+        lines.append('{:>10.3f} {:>8} {:>10.3f} {:>12}  {}'.format(total, count, max_seconds, rows, statement))
+    return '\n'.join(lines)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pfocr.py export: writes one run's figure => gene results for downstream
+# analysis, in one streaming pass over figures__xrefs_materialized:
+#
+# * Parquet, partitioned by figure id range:
+#   <dir>/parquet/matcher_id=M/ocr_processor_id=P/figure_bucket=B/part.parquet
+#   Each partition's key (its row count and latest match_attempts id) and
+#   digest are kept in manifest.json next to the partitions. A partition
+#   whose key hasn't changed since the last export isn't read again, and
+#   one whose rows come out the same (same digest) isn't rewritten.
+# * GMT, one gene set (entrez ids) per figure: <dir>/pfocr_M_P.gmt
+
+import hashlib
+import json
+import os
+from pathlib import Path, PurePath
+import psycopg2
+import psycopg2.extras
+import shutil
+import sys
+
+from get_pg_conn import get_pg_conn
+from summarize import refresh_figures__xrefs
+
+COLUMNS = ["figure_id", "pmcid", "figure", "word", "symbol", "source", "hgnc_symbol", "entrez", "transforms_applied"]
+# repetitive string columns, stored dictionary-encoded
+DICTIONARY_COLUMNS = ["pmcid", "figure", "symbol", "source", "hgnc_symbol", "entrez", "transforms_applied"]
+MANIFEST_VERSION = 1
+# COLUMNS for one run. Rows come grouped by figure, for the writers, and in
+# the same order on every export, so an unchanged partition has the same digest.
+ROWS_QUERY = '''
+    SELECT figure_id, pmcid, regexp_replace(figure_filepath, '^.*/', '') AS figure,
+        word, symbol, source, hgnc_symbol, xref AS entrez, transforms_applied
+    FROM figures__xrefs_materialized
+    WHERE matcher_id = %s AND ocr_processor_id = %s
+    ORDER BY figure_id, word, symbol, source, xref, transforms_applied;
+    '''
+# ROWS_QUERY for some partitions (figure_id // partition_size) only
+PARTITION_ROWS_QUERY = ROWS_QUERY.replace(
+    "WHERE matcher_id = %s AND ocr_processor_id = %s",
+    "WHERE matcher_id = %s AND ocr_processor_id = %s AND figure_id / %s = ANY(%s)")
+# Each partition's key: its row count, and the latest match attempt for its
+# figures. Rematching a figure deletes its attempts and adds new ones (with
+# higher ids), so a partition's rows can only have changed if its key has.
+# Only grouped counts and ids are read, from the run's indexes.
+PARTITION_KEYS_QUERY = '''
+    SELECT xrefs.bucket, xrefs.row_count, attempts.max_id
+    FROM (
+        SELECT figure_id / %(partition_size)s AS bucket, count(*) AS row_count
+        FROM figures__xrefs_materialized
+        WHERE matcher_id = %(matcher_id)s AND ocr_processor_id = %(ocr_processor_id)s
+        GROUP BY 1) AS xrefs
+    LEFT JOIN (
+        SELECT figure_id / %(partition_size)s AS bucket, max(id) AS max_id
+        FROM match_attempts
+        WHERE matcher_id = %(matcher_id)s AND ocr_processor_id = %(ocr_processor_id)s
+        GROUP BY 1) AS attempts
+    ON attempts.bucket = xrefs.bucket;
+    '''
+
+
+def get_parquet_writer():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('Parquet export needs pyarrow (pip install pyarrow), or use --format gmt')
+
+    def write_partition(path, rows):
+        columns = list(zip(*rows))
+        table = pyarrow.table({
+            name: pyarrow.array(values, type=pyarrow.int32() if name == "figure_id" else pyarrow.string())
+            for name, values in zip(COLUMNS, columns)})
+        tmp_path = str(path) + ".tmp"
+        try:
+            pyarrow.parquet.write_table(table, tmp_path, use_dictionary=DICTIONARY_COLUMNS, compression="zstd")
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return write_partition
+
+
+class PartitionedParquet:
+    # Buffers one partition's rows at a time. rows must come in figure_id
+    # order, so a partition is complete as soon as a row for the next one
+    # shows up.
+    # write_partition(path, rows) defaults to writing Parquet with pyarrow.
+    # After set_keys, rows of partitions that haven't changed are skipped,
+    # and only changed_buckets need to be read.
+    def __init__(self, run_dir, partition_size, write_partition=None):
+        self.run_dir = run_dir
+        self.partition_size = partition_size
+        self.write_partition = write_partition or get_parquet_writer()
+        self.manifest_path = Path(PurePath(run_dir, "manifest.json"))
+        self.manifest = {"version": MANIFEST_VERSION, "partition_size": partition_size, "partitions": {}}
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            # a different partition size means different partitions, so
+            # none of the old ones are kept
+            if manifest.get("version") == MANIFEST_VERSION and manifest.get("partition_size") == partition_size:
+                self.manifest = manifest
+            else:
+                for key in manifest.get("partitions", {}):
+                    shutil.rmtree(self.get_partition_dir(int(key)), ignore_errors=True)
+        self.seen = set()
+        # None: every partition is read and compared by digest
+        self.keys = None
+        self.changed_buckets = None
+        self.bucket = None
+        self.rows = []
+        self.digest = None
+        self.written = 0
+        self.unchanged = 0
+
+    def get_partition_dir(self, bucket):
+        return Path(PurePath(self.run_dir, "figure_bucket=%06d" % bucket))
+
+    def set_keys(self, keys_by_bucket):
+        # bucket => key, e.g., from PARTITION_KEYS_QUERY. Partitions whose key
+        # is the same as in the manifest (and whose file is still there) are
+        # kept as they are, and partitions not in keys_by_bucket are removed.
+        self.keys = {str(bucket): key for bucket, key in keys_by_bucket.items()}
+        self.changed_buckets = []
+        for key, partition_key in sorted(self.keys.items(), key=lambda item: int(item[0])):
+            previous = self.manifest["partitions"].get(key)
+            path = Path(PurePath(self.get_partition_dir(int(key)), "part.parquet"))
+            if previous and previous.get("key") == partition_key and path.exists():
+                self.seen.add(key)
+                self.unchanged += 1
+            else:
+                self.changed_buckets.append(int(key))
+
+    def add(self, row):
+        bucket = row[0] // self.partition_size
+        if self.keys is not None and str(bucket) in self.seen:
+            # unchanged, per set_keys
+            return
+        if bucket != self.bucket:
+            self.flush()
+            self.bucket = bucket
+            self.digest = hashlib.sha1()
+        self.rows.append(row)
+        self.digest.update(json.dumps(row).encode("utf8"))
+        self.digest.update(b"\n")
+
+    def flush(self):
+        if self.bucket is None:
+            return
+        key = str(self.bucket)
+        digest = self.digest.hexdigest()
+        partition_dir = self.get_partition_dir(self.bucket)
+        path = Path(PurePath(partition_dir, "part.parquet"))
+        self.seen.add(key)
+        previous = self.manifest["partitions"].get(key)
+        if previous and previous["digest"] == digest and path.exists():
+            self.unchanged += 1
+        else:
+            os.makedirs(partition_dir, exist_ok=True)
+            self.write_partition(path, self.rows)
+            self.written += 1
+        self.manifest["partitions"][key] = {"digest": digest, "rows": len(self.rows)}
+        if self.keys is not None:
+            self.manifest["partitions"][key]["key"] = self.keys.get(key)
+        self.bucket = None
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        # partitions that no longer have any rows
+        for key in list(self.manifest["partitions"]):
+            if key not in self.seen:
+                shutil.rmtree(self.get_partition_dir(int(key)), ignore_errors=True)
+                del self.manifest["partitions"][key]
+        os.makedirs(self.run_dir, exist_ok=True)
+        tmp_path = str(self.manifest_path) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+
+class GmtWriter:
+    # One line per figure: figure name, pmcid, then its distinct entrez ids.
+    # rows for a figure must be consecutive.
+    def __init__(self, path, min_genes=1):
+        self.path = path
+        self.min_genes = min_genes
+        self.tmp_path = str(path) + ".tmp"
+        self.f = open(self.tmp_path, "w")
+        self.figure_id = None
+        self.figure = None
+        self.pmcid = None
+        self.entrez_ids = []
+        self.gene_set_count = 0
+
+    def add(self, row):
+        figure_id, pmcid, figure, word, symbol, source, hgnc_symbol, entrez, transforms_applied = row
+        if figure_id != self.figure_id:
+            self.flush()
+            self.figure_id = figure_id
+            self.figure = figure
+            self.pmcid = pmcid
+        if entrez not in self.entrez_ids:
+            self.entrez_ids.append(entrez)
+
+    def flush(self):
+        if self.figure_id is not None and len(self.entrez_ids) >= self.min_genes:
+            self.f.write("\t".join([self.figure, self.pmcid] + sorted(self.entrez_ids)) + "\n")
+            self.gene_set_count += 1
+        self.figure_id = None
+        self.entrez_ids = []
+
+    def close(self):
+        try:
+            self.flush()
+            self.f.close()
+            os.replace(self.tmp_path, self.path)
+        finally:
+            self.discard()
+
+    def discard(self):
+        # drops what was written, unless close() already moved it into place
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def export(args):
+    formats = args.format.split(",")
+    for export_format in formats:
+        if export_format not in ["parquet", "gmt"]:
+            raise Exception('export format "%s" not recognized. Specify one or both: parquet,gmt' % export_format)
+
+    conn = get_pg_conn()
+    ids_cur = conn.cursor()
+
+    try:
+        matcher_id = args.matcher_id
+        if matcher_id is None:
+            ids_cur.execute("SELECT max(matcher_id) FROM match_attempts;")
+            matcher_id = ids_cur.fetchone()[0]
+        ocr_processor_id = args.ocr_processor_id
+        if ocr_processor_id is None:
+            ids_cur.execute("SELECT max(ocr_processor_id) FROM match_attempts WHERE matcher_id = %s;", (matcher_id, ))
+            ocr_processor_id = ids_cur.fetchone()[0]
+        if matcher_id is None or ocr_processor_id is None:
+            print('export: no match attempts to export. Run pfocr.py match first, or pass --matcher-id and --ocr-processor-id.')
+            sys.exit(1)
+        print('export: matcher {matcher_id}, ocr_processor {ocr_processor_id}'.format(matcher_id=matcher_id, ocr_processor_id=ocr_processor_id))
+
+        # runs matched before figures__xrefs_materialized existed
+        ids_cur.execute(
+            "SELECT EXISTS (SELECT 1 FROM figures__xrefs_materialized WHERE matcher_id = %s AND ocr_processor_id = %s);",
+            (matcher_id, ocr_processor_id))
+        if not ids_cur.fetchone()[0]:
+            refresh_figures__xrefs(ids_cur, matcher_id, ocr_processor_id)
+            conn.commit()
+
+        writers = []
+        parquet = None
+        if "parquet" in formats:
+            run_dir = Path(PurePath(args.dir, "parquet", "matcher_id=%s" % matcher_id, "ocr_processor_id=%s" % ocr_processor_id))
+            parquet = PartitionedParquet(run_dir, args.partition_size)
+            writers.append(parquet)
+        gmt = None
+        if "gmt" in formats:
+            os.makedirs(args.dir, exist_ok=True)
+            gmt = GmtWriter(Path(PurePath(args.dir, "pfocr_%s_%s.gmt" % (matcher_id, ocr_processor_id))), min_genes=args.min_genes)
+            writers.append(gmt)
+
+        rows_query = ROWS_QUERY
+        rows_params = (matcher_id, ocr_processor_id)
+        read_rows = True
+        if parquet:
+            ids_cur.execute(PARTITION_KEYS_QUERY, {
+                "matcher_id": matcher_id, "ocr_processor_id": ocr_processor_id, "partition_size": args.partition_size})
+            parquet.set_keys({bucket: [row_count, max_id] for bucket, row_count, max_id in ids_cur})
+            if not gmt:
+                # the GMT needs every row, Parquet only the changed partitions'
+                rows_query = PARTITION_ROWS_QUERY
+                rows_params = (matcher_id, ocr_processor_id, args.partition_size, parquet.changed_buckets)
+                read_rows = len(parquet.changed_buckets) > 0
+
+        try:
+            # one pass, itersize rows at a time, in figure_id order
+            row_count = 0
+            if read_rows:
+                rows_cur = conn.cursor("figures__xrefs_export")
+                rows_cur.itersize = 10000
+                rows_cur.execute(rows_query, rows_params)
+                for row in rows_cur:
+                    row = tuple(row)
+                    for writer in writers:
+                        writer.add(row)
+                    row_count += 1
+                rows_cur.close()
+
+            for writer in writers:
+                writer.close()
+        finally:
+            if gmt:
+                gmt.discard()
+
+        print('export: {row_count} rows read'.format(row_count=row_count))
+        if parquet:
+            print('export: {written} Parquet partitions written, {unchanged} unchanged'.format(written=parquet.written, unchanged=parquet.unchanged))
+        if gmt:
+            print('export: {gene_set_count} figure gene sets written to {path}'.format(gene_set_count=gmt.gene_set_count, path=gmt.path))
+
+    except(psycopg2.DatabaseError) as e:
+        print('Database Error %s' % e)
+        sys.exit(1)
+
+    finally:
+        if conn:
+            conn.close()
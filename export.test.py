@@ -0,0 +1,341 @@
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import unittest
+from pathlib import Path, PurePath
+
+import export
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# figure_id, pmcid, figure, word, symbol, source, hgnc_symbol, entrez, transforms_applied
+rows = [
+    (3, "PMC1", "PMC1__fig1.jpg", "AKT", "AKT1", "alias_symbol", "AKT1", "207", "upper"),
+    (3, "PMC1", "PMC1__fig1.jpg", "WNT9/10", "WNT10", "hgnc_symbol", "WNT10A", "80326", "expand"),
+    (3, "PMC1", "PMC1__fig1.jpg", "WNT9/10", "WNT9", "hgnc_symbol", "WNT9A", "7483", "expand"),
+    (3, "PMC1", "PMC1__fig1.jpg", "akt1", "AKT1", "hgnc_symbol", "AKT1", "207", "upper"),
+    (7, "PMC1", "PMC1__fig2.jpg", "TP53", "TP53", "hgnc_symbol", "TP53", "7157", "noop"),
+    (12, "PMC2", "PMC2__fig1.jpg", "EGFR", "EGFR", "hgnc_symbol", "EGFR", "1956", "noop"),
+    (12, "PMC2", "PMC2__fig1.jpg", "ERBB1", "ERBB1", "alias_symbol", "EGFR", "1956", "upper"),
+    (25, "PMC3", "PMC3__fig4.jpg", "MYC", "MYC", "hgnc_symbol", "MYC", "4609", "noop"),
+]
+
+order_by_re = re.compile(r"ORDER BY (.+?);", re.S)
+
+
+class RecordingWriter:
+    # write_partition for PartitionedParquet: writes the rows as JSON and
+    # remembers which partitions were written
+
+    def __init__(self):
+        self.paths = []
+
+    def __call__(self, path, rows):
+        self.paths.append(path)
+        with open(path, "w") as f:
+            json.dump(rows, f)
+
+
+class ExportConnection:
+    # serves export() its queries from rows, sorted by the query's ORDER BY.
+    # attempt_ids: figure_id => its latest match_attempts id (default 1).
+    # max_ids: what the max(matcher_id/ocr_processor_id) queries return.
+
+    def __init__(self, rows, attempt_ids=None, max_ids=(1, 2)):
+        self.rows = rows
+        self.attempt_ids = attempt_ids or {}
+        self.max_ids = list(max_ids)
+        self.queries = []
+
+    def cursor(self, name=None):
+        return ExportCursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ExportCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.results = []
+
+    def execute(self, statement, params=None):
+        self.conn.queries.append(statement)
+        if "EXISTS" in statement:
+            self.results = [(True, )]
+            return
+        if "SELECT max(" in statement:
+            self.results = [(self.conn.max_ids.pop(0), )]
+            return
+        if statement == export.PARTITION_KEYS_QUERY:
+            partition_size = params["partition_size"]
+            keys = {}
+            for row in self.conn.rows:
+                bucket = row[0] // partition_size
+                row_count, max_id = keys.get(bucket, (0, None))
+                attempt_id = self.conn.attempt_ids.get(row[0], 1)
+                keys[bucket] = (row_count + 1, attempt_id if max_id is None else max(max_id, attempt_id))
+            self.results = [(bucket, row_count, max_id) for bucket, (row_count, max_id) in keys.items()]
+            return
+        rows = self.conn.rows
+        if statement == export.PARTITION_ROWS_QUERY:
+            matcher_id, ocr_processor_id, partition_size, buckets = params
+            rows = [row for row in rows if row[0] // partition_size in buckets]
+        # the SELECT's output names, with xref AS entrez
+        names = [{"xref": "entrez"}.get(name.strip(), name.strip())
+                 for name in order_by_re.search(statement).group(1).split(",")]
+        indexes = [export.COLUMNS.index(name) for name in names]
+        self.results = sorted(rows, key=lambda row: [row[i] for i in indexes])
+
+    def fetchone(self):
+        return self.results[0]
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def close(self):
+        pass
+
+
+class TestGmtWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = Path(PurePath(self.dir, "pfocr.gmt"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, rows, min_genes=1):
+        gmt = export.GmtWriter(self.path, min_genes=min_genes)
+        for row in rows:
+            gmt.add(row)
+        gmt.close()
+        with open(self.path, "r") as f:
+            return f.read(), gmt.gene_set_count
+
+    def test_one_line_per_figure(self):
+        text, gene_set_count = self.write(rows)
+        self.assertEqual(text, "".join([
+            "PMC1__fig1.jpg\tPMC1\t207\t7483\t80326\n",
+            "PMC1__fig2.jpg\tPMC1\t7157\n",
+            "PMC2__fig1.jpg\tPMC2\t1956\n",
+            "PMC3__fig4.jpg\tPMC3\t4609\n"]))
+        self.assertEqual(gene_set_count, 4)
+        self.assertFalse(os.path.exists(str(self.path) + ".tmp"))
+
+    def test_min_genes(self):
+        text, gene_set_count = self.write(rows, min_genes=2)
+        self.assertEqual(text, "PMC1__fig1.jpg\tPMC1\t207\t7483\t80326\n")
+        self.assertEqual(gene_set_count, 1)
+
+    def test_empty(self):
+        self.assertEqual(self.write([]), ("", 0))
+
+    def test_removes_the_temp_file_on_errors(self):
+        # a figure without a name can't be written
+        bad_row = (8, "PMC9", None, "x", "X", "s", "X", "1", "noop")
+        gmt = export.GmtWriter(self.path)
+        gmt.add(bad_row)
+        self.assertRaises(TypeError, gmt.add, rows[4])
+        gmt.discard()
+        self.assertEqual(os.listdir(self.dir), [])
+
+        gmt = export.GmtWriter(self.path)
+        gmt.add(bad_row)
+        self.assertRaises(TypeError, gmt.close)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+class TestPartitionedParquet(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.run_dir = Path(PurePath(self.dir, "matcher_id=1", "ocr_processor_id=1"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, rows, partition_size=10):
+        writer = RecordingWriter()
+        parquet = export.PartitionedParquet(self.run_dir, partition_size, write_partition=writer)
+        for row in rows:
+            parquet.add(row)
+        parquet.close()
+        return parquet, sorted(os.path.basename(os.path.dirname(path)) for path in writer.paths)
+
+    def read_manifest(self):
+        with open(Path(PurePath(self.run_dir, "manifest.json")), "r") as f:
+            return json.load(f)
+
+    def test_partitions_by_figure_id(self):
+        parquet, written = self.write(rows)
+        self.assertEqual(written, ["figure_bucket=000000", "figure_bucket=000001", "figure_bucket=000002"])
+        self.assertEqual((parquet.written, parquet.unchanged), (3, 0))
+        with open(Path(PurePath(self.run_dir, "figure_bucket=000001", "part.parquet")), "r") as f:
+            self.assertEqual([row[0] for row in json.load(f)], [12, 12])
+        manifest = self.read_manifest()
+        self.assertEqual(manifest["partition_size"], 10)
+        self.assertEqual({key: p["rows"] for key, p in manifest["partitions"].items()}, {"0": 5, "1": 2, "2": 1})
+
+    def test_skips_unchanged_partitions(self):
+        self.write(rows)
+        digests = {key: p["digest"] for key, p in self.read_manifest()["partitions"].items()}
+
+        parquet, written = self.write(rows)
+        self.assertEqual(written, [])
+        self.assertEqual((parquet.written, parquet.unchanged), (0, 3))
+        self.assertEqual({key: p["digest"] for key, p in self.read_manifest()["partitions"].items()}, digests)
+
+        # only the partition with a changed row is rewritten
+        changed = rows[0:5] + [rows[5][0:7] + ("1957", ) + rows[5][8:]] + rows[6:]
+        parquet, written = self.write(changed)
+        self.assertEqual(written, ["figure_bucket=000001"])
+        self.assertEqual((parquet.written, parquet.unchanged), (1, 2))
+        self.assertNotEqual(self.read_manifest()["partitions"]["1"]["digest"], digests["1"])
+
+    def test_rewrites_missing_partition_files(self):
+        self.write(rows)
+        os.remove(Path(PurePath(self.run_dir, "figure_bucket=000002", "part.parquet")))
+        parquet, written = self.write(rows)
+        self.assertEqual(written, ["figure_bucket=000002"])
+
+    def test_removes_partitions_without_rows(self):
+        self.write(rows)
+        parquet, written = self.write(rows[0:7])
+        self.assertEqual(written, [])
+        self.assertEqual(sorted(self.read_manifest()["partitions"]), ["0", "1"])
+        self.assertFalse(os.path.exists(Path(PurePath(self.run_dir, "figure_bucket=000002"))))
+
+    def test_new_partition_size_rewrites_everything(self):
+        self.write(rows)
+        parquet, written = self.write(rows, partition_size=20)
+        self.assertEqual(written, ["figure_bucket=000000", "figure_bucket=000001"])
+        self.assertEqual(sorted(self.read_manifest()["partitions"]), ["0", "1"])
+        self.assertEqual(sorted(os.listdir(self.run_dir)), ["figure_bucket=000000", "figure_bucket=000001", "manifest.json"])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet(self):
+        parquet = export.PartitionedParquet(self.run_dir, 10)
+        for row in rows:
+            parquet.add(row)
+        parquet.close()
+        table = pyarrow.parquet.read_table(str(Path(PurePath(self.run_dir, "figure_bucket=000000", "part.parquet"))))
+        self.assertEqual(table.column_names, export.COLUMNS)
+        self.assertEqual([tuple(r.values()) for r in table.to_pylist()], rows[0:5])
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.get_pg_conn = export.get_pg_conn
+
+    def tearDown(self):
+        export.get_pg_conn = self.get_pg_conn
+        shutil.rmtree(self.dir)
+
+    def export(self, rows):
+        conn = ExportConnection(rows)
+        export.get_pg_conn = lambda: conn
+        export.export(argparse.Namespace(
+            dir=self.dir, format="gmt", matcher_id=1, ocr_processor_id=2, partition_size=10, min_genes=1))
+        with open(Path(PurePath(self.dir, "pfocr_1_2.gmt")), "r") as f:
+            return conn, f.read()
+
+    def export_parquet(self, rows, attempt_ids=None, export_format="parquet"):
+        conn = ExportConnection(rows, attempt_ids)
+        writer = RecordingWriter()
+        export.get_pg_conn = lambda: conn
+        get_parquet_writer = export.get_parquet_writer
+        export.get_parquet_writer = lambda: writer
+        try:
+            export.export(argparse.Namespace(
+                dir=self.dir, format=export_format, matcher_id=1, ocr_processor_id=2, partition_size=10, min_genes=1))
+        finally:
+            export.get_parquet_writer = get_parquet_writer
+        return conn, sorted(os.path.basename(os.path.dirname(path)) for path in writer.paths)
+
+    def test_unchanged_partitions_arent_read(self):
+        conn, written = self.export_parquet(rows)
+        self.assertEqual(written, ["figure_bucket=000000", "figure_bucket=000001", "figure_bucket=000002"])
+        self.assertEqual(conn.queries[-1], export.PARTITION_ROWS_QUERY)
+
+        # same counts and attempt ids: no rows query at all
+        conn, written = self.export_parquet(rows)
+        self.assertEqual(written, [])
+        self.assertEqual(conn.queries[-1], export.PARTITION_KEYS_QUERY)
+
+        # figure 12 rematched, with new attempt ids: only its partition is read
+        changed = rows[0:5] + [rows[5][0:7] + ("1957", ) + rows[5][8:]] + rows[6:]
+        conn, written = self.export_parquet(changed, attempt_ids={12: 2})
+        self.assertEqual(written, ["figure_bucket=000001"])
+        with open(Path(PurePath(self.dir, "parquet", "matcher_id=1", "ocr_processor_id=2", "manifest.json")), "r") as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["partitions"]["1"]["key"], [2, 2])
+        self.assertEqual(manifest["partitions"]["0"]["key"], [5, 1])
+
+    def test_rematched_to_the_same_rows_isnt_rewritten(self):
+        self.export_parquet(rows)
+        conn, written = self.export_parquet(rows, attempt_ids={3: 5})
+        self.assertEqual(written, [])
+
+    def test_with_gmt_every_row_is_read(self):
+        self.export_parquet(rows, export_format="parquet,gmt")
+        conn, written = self.export_parquet(rows, export_format="parquet,gmt")
+        self.assertEqual(written, [])
+        self.assertEqual(conn.queries[-1], export.ROWS_QUERY)
+        with open(Path(PurePath(self.dir, "pfocr_1_2.gmt")), "r") as f:
+            self.assertEqual(f.read().count("\n"), 4)
+
+    def test_no_match_attempts(self):
+        conn = ExportConnection([], max_ids=(None, None))
+        export.get_pg_conn = lambda: conn
+        with self.assertRaises(SystemExit):
+            export.export(argparse.Namespace(
+                dir=self.dir, format="gmt", matcher_id=None, ocr_processor_id=None, partition_size=10, min_genes=1))
+        self.assertFalse(any("EXISTS" in query for query in conn.queries))
+
+    def test_rows_in_figure_order(self):
+        conn, text = self.export(rows)
+        self.assertEqual(conn.queries[-1], export.ROWS_QUERY)
+        order_by = order_by_re.search(export.ROWS_QUERY).group(1)
+        # grouping by figure (GMT lines, Parquet partitions) needs figure_id first
+        self.assertEqual(order_by.split(",")[0].strip(), "figure_id")
+        self.assertEqual(text.count("\n"), 4)
+
+    def test_same_output_whatever_order_the_rows_are_stored_in(self):
+        shuffled = list(rows)
+        random.Random(0).shuffle(shuffled)
+        self.assertEqual(self.export(shuffled)[1], self.export(rows)[1])
+
+    def test_order_makes_partition_digests_stable(self):
+        # the full ORDER BY fixes the order within a figure too, so a
+        # partition's digest only changes when its rows do
+        shuffled = list(rows)
+        random.Random(1).shuffle(shuffled)
+        digests = []
+        for i, stored in enumerate([rows, shuffled]):
+            cur = ExportConnection(stored).cursor()
+            cur.execute(export.ROWS_QUERY, (1, 2))
+            parquet = export.PartitionedParquet(Path(PurePath(self.dir, str(i))), 10, write_partition=RecordingWriter())
+            for row in cur:
+                parquet.add(row)
+            parquet.close()
+            digests.append({key: p["digest"] for key, p in parquet.manifest["partitions"].items()})
+        self.assertEqual(digests[0], digests[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
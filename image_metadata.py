@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import hashlib
+import struct
+
+# Per-image work for loading figures: the content hash (figures.hash) and
+# the resolution (figures.resolution). probe_figure takes and returns only
+# picklable values, so it can run in a multiprocessing pool.
+#
+# Resolution and dimensions come from the PNG/JPEG headers when they're
+# there, so the pixels never need decoding. Otherwise, Wand reads the image.
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# JPEG start-of-frame markers, i.e., the ones with the image dimensions
+# (not DHT, JPG or DAC, which share the range)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# x_resolution and y_resolution are None when the header doesn't say
+ImageHeader = namedtuple("ImageHeader", ["format", "width", "height", "x_resolution", "y_resolution"])
+
+
+def hash_file(filepath, chunk_size=HASH_CHUNK_SIZE):
+    # sha256 of the file, read a chunk at a time instead of all at once
+    m = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def read_png_header(f):
+    if f.read(8) != PNG_SIGNATURE:
+        return None
+    width = height = x_resolution = y_resolution = None
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", chunk_header)
+        # pHYs has to come before the image data
+        if chunk_type in (b"IDAT", b"IEND"):
+            break
+        data = f.read(length)
+        f.seek(4, 1)  # CRC
+        if chunk_type == b"IHDR":
+            width, height = struct.unpack(">II", data[0:8])
+        elif chunk_type == b"pHYs" and len(data) >= 9:
+            x_ppu, y_ppu, unit = struct.unpack(">IIB", data[0:9])
+            # unit 1 is pixels per meter, which ImageMagick reports as pixels
+            # per centimeter. Without a unit, leave it to Wand.
+            if unit == 1:
+                x_resolution = x_ppu / 100.0
+                y_resolution = y_ppu / 100.0
+    if width is None:
+        return None
+    return ImageHeader("png", width, height, x_resolution, y_resolution)
+
+
+def read_jpeg_header(f):
+    if f.read(2) != b"\xff\xd8":
+        return None
+    width = height = x_resolution = y_resolution = None
+    has_exif = False
+    while True:
+        byte = f.read(1)
+        if not byte:
+            break
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        # fill bytes
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            break
+        marker = marker[0]
+        # markers without a length
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        if marker in (0xD9, 0xDA):
+            break
+        segment_length = f.read(2)
+        if len(segment_length) < 2:
+            break
+        length = struct.unpack(">H", segment_length)[0] - 2
+        data = f.read(length)
+        if marker == 0xE0 and data[0:5] == b"JFIF\x00" and len(data) >= 12:
+            units, x_density, y_density = struct.unpack(">BHH", data[7:12])
+            # units 1 is dots per inch, 2 is dots per cm. 0 only gives the
+            # aspect ratio.
+            if units in (1, 2):
+                x_resolution = float(x_density)
+                y_resolution = float(y_density)
+        elif marker == 0xE1 and data[0:6] == b"Exif\x00\x00":
+            has_exif = True
+        elif marker in JPEG_SOF_MARKERS and len(data) >= 5:
+            height, width = struct.unpack(">HH", data[1:5])
+            break
+    if width is None:
+        return None
+    if has_exif:
+        # ImageMagick may take the resolution from EXIF instead of JFIF
+        x_resolution = y_resolution = None
+    return ImageHeader("jpeg", width, height, x_resolution, y_resolution)
+
+
+def read_header(filepath):
+    # ImageHeader for a PNG or JPEG file, or None for anything else
+    with open(filepath, "rb") as f:
+        start = f.read(8)
+        f.seek(0)
+        if start == PNG_SIGNATURE:
+            return read_png_header(f)
+        if start[0:2] == b"\xff\xd8":
+            return read_jpeg_header(f)
+    return None
+
+
+def get_resolution(filepath):
+    # the smaller of the x and y resolutions, rounded (same as Wand's
+    # img.resolution, which is the fallback)
+    header = read_header(filepath)
+    if header and header.x_resolution is not None:
+        return int(round(min(header.x_resolution, header.y_resolution)))
+    # imported here, so the header-only path doesn't need Wand
+    from wand.image import Image
+    with Image(filename=filepath) as img:
+        return int(round(min(img.resolution)))
+
+
+def probe_figure(filepath):
+    # returns (filepath, hash, resolution, error). An unreadable image gets
+    # an error message instead of failing the whole load.
+    try:
+        return (filepath, hash_file(filepath), get_resolution(filepath), None)
+    except(Exception) as e:
+        return (filepath, None, None, '{filepath}: {error}'.format(filepath=filepath, error=e))
+
+
+def probe_resolution(figure_row):
+    # (figure_id, filepath) => (figure_id, resolution, error), for resolutions.py
+    figure_id, filepath = figure_row
+    try:
+        return (figure_id, get_resolution(filepath), None)
+    except(Exception) as e:
+        return (figure_id, None, '{filepath}: {error}'.format(filepath=filepath, error=e))
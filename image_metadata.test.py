@@ -0,0 +1,95 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from image_metadata import get_resolution, hash_file, read_header
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def make_png(width, height, phys=None):
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    chunks = [png_chunk(b"IHDR", ihdr)]
+    if phys:
+        chunks.append(png_chunk(b"pHYs", struct.pack(">IIB", *phys)))
+    raw = b"".join(b"\x00" + b"\x00" * width for _ in range(height))
+    chunks.append(png_chunk(b"IDAT", zlib.compress(raw)))
+    chunks.append(png_chunk(b"IEND", b""))
+    return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+
+def jpeg_segment(marker, data):
+    return b"\xff" + bytes([marker]) + struct.pack(">H", len(data) + 2) + data
+
+
+def make_jpeg(width, height, jfif_units=1, density=(300, 300), exif=False):
+    segments = [b"\xff\xd8"]
+    segments.append(jpeg_segment(0xE0, b"JFIF\x00\x01\x01" + struct.pack(">BHHBB", jfif_units, density[0], density[1], 0, 0)))
+    if exif:
+        segments.append(jpeg_segment(0xE1, b"Exif\x00\x00" + b"\x00" * 8))
+    segments.append(jpeg_segment(0xDB, b"\x00" * 65))
+    segments.append(jpeg_segment(0xC0, struct.pack(">BHHB", 8, height, width, 1) + b"\x01\x11\x00"))
+    segments.append(jpeg_segment(0xDA, b"\x01\x01\x00\x00\x3f\x00"))
+    segments.append(b"\x00\x00\xff\xd9")
+    return b"".join(segments)
+
+
+class TestImageMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+
+    def write(self, name, data):
+        filepath = os.path.join(self.image_dir, name)
+        with open(filepath, "wb") as f:
+            f.write(data)
+        return filepath
+
+    def test_png_phys_in_meters(self):
+        # 11811 pixels/meter is 300 dpi, which ImageMagick reports as 118.11 pixels/cm
+        filepath = self.write("a.png", make_png(3, 2, phys=(11811, 11811, 1)))
+        header = read_header(filepath)
+        self.assertEqual((header.format, header.width, header.height), ("png", 3, 2))
+        self.assertAlmostEqual(header.x_resolution, 118.11)
+        self.assertEqual(get_resolution(filepath), 118)
+
+    def test_png_without_resolution(self):
+        for phys in [None, (2, 1, 0)]:
+            filepath = self.write("b.png", make_png(4, 5, phys=phys))
+            header = read_header(filepath)
+            self.assertEqual((header.width, header.height), (4, 5))
+            self.assertIsNone(header.x_resolution)
+
+    def test_jpeg_jfif_density(self):
+        filepath = self.write("c.jpg", make_jpeg(640, 480, jfif_units=1, density=(300, 150)))
+        self.assertEqual(read_header(filepath), ("jpeg", 640, 480, 300.0, 150.0))
+        self.assertEqual(get_resolution(filepath), 150)
+
+    def test_jpeg_without_usable_density(self):
+        # aspect ratio only, or EXIF that ImageMagick might prefer: leave it to Wand
+        for kwargs in [{"jfif_units": 0}, {"exif": True}]:
+            filepath = self.write("d.jpg", make_jpeg(20, 10, **kwargs))
+            header = read_header(filepath)
+            self.assertEqual((header.width, header.height), (20, 10))
+            self.assertIsNone(header.x_resolution)
+
+    def test_not_an_image(self):
+        self.assertIsNone(read_header(self.write("e.png", b"GIF89a...")))
+        self.assertIsNone(read_header(self.write("f.png", b"")))
+
+    def test_hash_file_in_chunks(self):
+        data = os.urandom(3000)
+        filepath = self.write("g.bin", data)
+        self.assertEqual(hash_file(filepath, chunk_size=1024), hashlib.sha256(data).hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
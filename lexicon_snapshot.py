@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from array import array
+import mmap
+import os
+from pathlib import Path, PurePath
+import struct
+import sys
+
+# Compiled, read-only copy of match.py's symbol_ids_by_symbol (normalized
+# symbol => symbol id), so a run doesn't have to re-normalize every symbol.
+#
+# File layout (native byte order):
+#   header: magic, version, symbol count, size of the string blob
+#   offsets: count + 1 uint64 offsets of each key into the blob
+#   ids: symbol ids as int32, in key order
+#   blob: the keys, UTF-8 encoded and sorted (i.e., by code point)
+#
+# A LexiconSnapshot works like the dict for lookups (in, [], get), with a
+# binary search of the mmap'd file, so opening one doesn't read the keys,
+# and forked workers share its pages. items() and to_dict() do read them
+# all, e.g., for match.py's aho_corasick automaton.
+
+MAGIC = b"PFOCRLEX"
+VERSION = 1
+HEADER = struct.Struct("=8sIIQ")
+
+
+def get_snapshot_path(snapshot_dir, key):
+    return Path(PurePath(snapshot_dir, key + ".lex"))
+
+
+def write_snapshot(path, symbol_ids_by_symbol):
+    items = sorted(
+        (symbol.encode("utf8"), symbol_id)
+        for symbol, symbol_id in symbol_ids_by_symbol.items()
+        # skip anything that isn't a string key, e.g., the bound str.upper
+        # keys match.build_symbol_ids_by_symbol adds. Those never match.
+        if isinstance(symbol, str))
+    ids = array("i", (symbol_id for _, symbol_id in items))
+    offsets = array("Q", [0])
+    for encoded, _ in items:
+        offsets.append(offsets[-1] + len(encoded))
+    blob = b"".join(encoded for encoded, _ in items)
+
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(ids), len(blob)))
+        offsets.tofile(f)
+        ids.tofile(f)
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+class LexiconSnapshot:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, blob_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError("%s is not a version %s lexicon snapshot" % (path, VERSION))
+        self.count = count
+        view = memoryview(self.mm)
+        offsets_start = HEADER.size
+        ids_start = offsets_start + 8 * (count + 1)
+        blob_start = ids_start + 4 * count
+        self.offsets = view[offsets_start:ids_start].cast("Q")
+        self.ids = view[ids_start:blob_start].cast("i")
+        self.blob = view[blob_start:blob_start + blob_size]
+
+    def close(self):
+        self.ids.release()
+        self.offsets.release()
+        self.blob.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def key_at(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def find(self, symbol):
+        if not isinstance(symbol, str):
+            return -1
+        encoded = symbol.encode("utf8")
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_at(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.key_at(lo) == encoded:
+            return lo
+        return -1
+
+    def __contains__(self, symbol):
+        return self.find(symbol) >= 0
+
+    def __getitem__(self, symbol):
+        i = self.find(symbol)
+        if i < 0:
+            raise KeyError(symbol)
+        return self.ids[i]
+
+    def get(self, symbol, default=None):
+        i = self.find(symbol)
+        return self.ids[i] if i >= 0 else default
+
+    def keys(self):
+        blob = bytes(self.blob).decode("utf8")
+        offsets = self.offsets
+        # offsets are into the UTF-8 bytes, so only slice the str directly
+        # when the blob is all ASCII
+        if len(blob) == len(self.blob):
+            return [sys.intern(blob[offsets[i]:offsets[i + 1]]) for i in range(self.count)]
+        return [sys.intern(self.key_at(i).decode("utf8")) for i in range(self.count)]
+
+    def items(self):
+        return zip(self.keys(), self.ids.tolist())
+
+    def to_dict(self):
+        return dict(self.items())
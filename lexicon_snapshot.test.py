@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+from lexicon_snapshot import LexiconSnapshot, get_snapshot_path, write_snapshot
+
+import match
+from transform_chain import apply_transforms
+
+symbol_ids_by_symbol = {"TP53": 1, "p53": 1, "NF-κB": 2, "NFKB": 2, "ß-catenin": 3, "AKT1": 4, "".upper: 5}
+
+
+class TestLexiconSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.path = get_snapshot_path(self.snapshot_dir, "abc")
+        write_snapshot(self.path, symbol_ids_by_symbol)
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_round_trip(self):
+        expected = {k: v for k, v in symbol_ids_by_symbol.items() if isinstance(k, str)}
+        with LexiconSnapshot(self.path) as snapshot:
+            self.assertEqual(len(snapshot), len(expected))
+            self.assertEqual(snapshot.to_dict(), expected)
+
+    def test_lookups(self):
+        with LexiconSnapshot(self.path) as snapshot:
+            self.assertEqual(snapshot["NF-κB"], 2)
+            self.assertEqual(snapshot.get("AKT1"), 4)
+            self.assertIn("ß-catenin", snapshot)
+            self.assertNotIn("AKT", snapshot)
+            self.assertNotIn("".upper, snapshot)
+            self.assertIsNone(snapshot.get("ZZZ"))
+            self.assertRaises(KeyError, lambda: snapshot["ZZZ"])
+
+    def test_ascii_keys(self):
+        path = get_snapshot_path(self.snapshot_dir, "ascii")
+        write_snapshot(path, {"B": 2, "A": 1, "CC": 3})
+        with LexiconSnapshot(path) as snapshot:
+            self.assertEqual(snapshot.keys(), ["A", "B", "CC"])
+
+    def test_items(self):
+        with LexiconSnapshot(self.path) as snapshot:
+            self.assertEqual(sorted(snapshot.items()),
+                             sorted((k, v) for k, v in symbol_ids_by_symbol.items() if isinstance(k, str)))
+
+    def test_in_place_of_the_dict(self):
+        # match.py hands the snapshot itself to the transform chain and the
+        # automaton, without building a dict
+        transforms_to_apply = [
+            {"name": "upper", "category": "normalize", "transform": lambda word: [word.upper()]},
+            {"name": "alphanumeric", "category": "normalize", "transform": lambda word: [word.replace("-", "")]}]
+        with LexiconSnapshot(self.path) as snapshot:
+            for word in ["nf-κb", "p53", "akt1", "AKT"]:
+                self.assertEqual(apply_transforms(word, transforms_to_apply, snapshot),
+                                 apply_transforms(word, transforms_to_apply, symbol_ids_by_symbol))
+            found = [m[2:] for m in match.build_automaton(snapshot).iter("NF-κB/AKT1")]
+        self.assertEqual(sorted(found), [("AKT1", 4), ("NF-κB", 2)])
+
+    def test_rejects_other_files(self):
+        path = os.path.join(self.snapshot_dir, "other.lex")
+        with open(path, "wb") as f:
+            f.write(b"not a snapshot" * 4)
+        self.assertRaises(ValueError, LexiconSnapshot, path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,77 +2,326 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
+from itertools import islice
 import json
+import multiprocessing
+import os
 import psycopg2
 import psycopg2.extras
 import re
 import transforms
-import signal
 import sys
+import warnings
+from aho_corasick import Automaton, get_segments, iter_segments, map_segments, select_longest, sub_segments
 from get_pg_conn import get_pg_conn
+from lexicon_snapshot import LexiconSnapshot, get_snapshot_path, write_snapshot
+from match_writer import MatchAttemptsWriter
+from summarize import refresh_matched_figures__xrefs
+from transform_chain import (
+    FIGURE_SECONDS, MAX_OUTPUTS, WORD_SECONDS, Budget, FigureBudgetExceeded, TransformCache, TransformStats, WordBudgetExceeded)
 
 
-# see https://filosophy.org/code/python-function-execution-deadlines---in-simple-examples/
-class TimedOutExc(Exception):
-    pass
-
-def deadline(timeout, *args):
-    def decorate(f):
-        def handler(signum, frame):
-            raise TimedOutExc()
-
-        def new_f(*args):
-            signal.signal(signal.SIGALRM, handler)
-            signal.alarm(timeout)
-            return f(*args)
-            signal.alarm(0)
-
-        new_f.__name__ = f.__name__
-        return new_f
-    return decorate
-
-@deadline(5)
-def attempt_match(args, matcher_id, transformed_word_ids_by_transformed_word, matches, transforms_applied, match_attempts_cur, transformed_words_cur, ocr_processor_id, figure_id, word, symbol_id, transformed_word):
+def attempt_match(matcher, matches, transforms_applied, match_attempts_writer, ocr_processor_id, figure_id, word, symbol_id, transformed_word):
     if transformed_word:
         matches.add(transformed_word)
-        if transformed_word not in transformed_word_ids_by_transformed_word: 
-            # This might not be the best way to insert. TODO: look at the proper way to handle this.
-            transformed_words_cur.execute(
-                '''
-                INSERT INTO transformed_words (transformed_word)
-                VALUES (%s)
-                ON CONFLICT (transformed_word) DO UPDATE SET transformed_word = EXCLUDED.transformed_word
-                RETURNING id;
-                ''',
-                (transformed_word, )
-            )
-            transformed_word_id = transformed_words_cur.fetchone()[0]
-            transformed_word_ids_by_transformed_word[transformed_word] = transformed_word_id
-        else:
-            transformed_word_id = transformed_word_ids_by_transformed_word[transformed_word]
-    else:
-        transformed_word_id = None
-
-    transform_args = []
-    for t in args[0:len(transforms_applied)]:
-        transform_args.append("-" + t["category"][0] + " " + t["name"])
 
     if not word == '':
-        match_attempts_cur.execute('''
-            INSERT INTO match_attempts (ocr_processor_id, matcher_id, figure_id, word, transformed_word_id, symbol_id, transforms_applied)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT DO NOTHING;
+        match_attempts_writer.add(ocr_processor_id, matcher["id"], figure_id, word, transformed_word, symbol_id, transforms_applied)
+
+def build_symbol_ids_by_symbol(symbol_rows, normalizations):
+    # original symbol incl/
+    symbol_ids_by_symbol = {}
+    for s in symbol_rows:
+        symbol_id = s["id"]
+        symbol = s["symbol"]
+        normalized_results = [symbol]
+        for normalization in normalizations:
+            for normalized in normalized_results:
+                normalized_results = []
+                for n in normalization["transform"](normalized):
+                    normalized_results.append(n)
+                    if n not in symbol_ids_by_symbol: 
+                        symbol_ids_by_symbol[n] = symbol_id
+                    # Also collect unique uppercased symbols for matching
+                    if n.upper() not in symbol_ids_by_symbol:
+                        symbol_ids_by_symbol[n.upper] = symbol_id
+    return symbol_ids_by_symbol
+
+def build_automaton(symbol_ids_by_symbol):
+    automaton = Automaton()
+    for symbol, symbol_id in symbol_ids_by_symbol.items():
+        # skip the bound str.upper keys build_symbol_ids_by_symbol adds
+        if isinstance(symbol, str):
+            automaton.add(symbol, symbol_id)
+    automaton.build()
+    return automaton
+
+# Word-level normalizations, which only make sense for whole lexicon symbols
+LEXICON_ONLY_NORMALIZATIONS = ["stop", "root"]
+
+def get_line_normalization(t):
+    # The normalization t as a function of a line's segments (see
+    # aho_corasick.py), so a line can be normalized like the lexicon keys
+    # were and still be matched back to its raw text. None when t doesn't
+    # apply to lines.
+    name = t["name"]
+    if name in LEXICON_ONLY_NORMALIZATIONS:
+        return None
+    if name == "swaps":
+        def swap_segments(segments):
+            # looked up when called, since load_swap_tables replaces them
+            return sub_segments(map_segments(segments, str.upper), transforms.swaps.swap_re, transforms.swaps.replace)
+        return swap_segments
+    transform = t["transform"]
+    def transform_chars(text):
+        # whitespace is kept, so a key doesn't match across words
+        if text.isspace():
+            return text
+        results = transform(text)
+        return results[0] if results else ""
+    return lambda segments: map_segments(segments, transform_chars)
+
+def get_line_normalizations(normalizations):
+    return [f for f in (get_line_normalization(t) for t in normalizations) if f is not None]
+
+def split_words(line):
+    words = set()
+    words.add(line.replace(" ", ""))
+    for w in line.split(" "):
+        words.add(w)
+    # sorted so that results don't depend on set order (PYTHONHASHSEED),
+    # e.g., when diffing a serial run against a --workers run
+    return sorted(words)
+
+def match_figure(matcher, match_attempts_writer, ocr_processor_id, figure_id, paragraph):
+    transforms_to_apply = matcher["transforms_to_apply"]
+    symbol_ids_by_symbol = matcher["symbol_ids_by_symbol"]
+    transform_cache = matcher["transform_cache"]
+    transforms_applied_by_count = matcher["transforms_applied_by_count"]
+    # Words over budget are skipped (no match attempts). A figure over budget
+    # keeps the attempts for the words before it. Both are quarantined.
+    budget = matcher["budget"]
+    figure_budget = budget.start_figure()
+    successes = []
+    fails = []
+    word = None
+    if paragraph:
+        try:
+            words_by_line = [(line, split_words(line)) for line in paragraph.split("\n")]
+            # transform the figure's new words together, one batch per transform
+            transform_cache.prefetch(
+                [word for line, words in words_by_line for word in words], transforms_to_apply, symbol_ids_by_symbol, figure_budget)
+            for line, words in words_by_line:
+                matches = set()
+                for word in words:
+                    try:
+                        figure_budget.start_word(word)
+                        hits, intermediates = transform_cache.apply(word, transforms_to_apply, symbol_ids_by_symbol, figure_budget)
+                    except(WordBudgetExceeded) as e:
+                        budget.quarantine(figure_id, word, e)
+                        continue
+                    except(FigureBudgetExceeded):
+                        raise
+                    except(Exception):
+                        print('figure_id:', figure_id)
+                        raise
+
+                    for transform_count, symbol_id, transformed_word in hits:
+                        attempt_match(
+                            matcher, matches,
+                            transforms_applied_by_count[transform_count], match_attempts_writer, ocr_processor_id,
+                            figure_id, word, symbol_id, transformed_word)
+
+                    if len(matches) == 0:
+                        attempt_match(matcher, matches, transforms_applied_by_count[-1], match_attempts_writer, ocr_processor_id, figure_id, word, None, None)
+                if len(matches) > 0:
+                    successes.append(line + ' => ' + ' & '.join(sorted(matches)))
+                else:
+                    fails.append(line)
+        except(FigureBudgetExceeded) as e:
+            budget.quarantine(figure_id, word, e)
+    return successes, fails
+
+def match_figure_aho_corasick(matcher, match_attempts_writer, ocr_processor_id, figure_id, paragraph):
+    # Scans whole lines for lexicon symbols instead of transforming words.
+    # Offsets are into the paragraph, i.e., textAnnotations[0].description.
+    automaton = matcher["automaton"]
+    boundary = matcher["boundary"]
+    line_normalizations = matcher["line_normalizations"]
+    transforms_applied = matcher["transforms_applied_by_count"][-1]
+    budget = matcher["budget"]
+    figure_budget = budget.start_figure()
+    successes = []
+    fails = []
+    if paragraph:
+        line_offset = 0
+        for line in paragraph.split("\n"):
+            try:
+                figure_budget.check_figure()
+            except(FigureBudgetExceeded) as e:
+                budget.quarantine(figure_id, line, e)
+                break
+            matches = set()
+            if line_normalizations:
+                segments = get_segments(line)
+                for line_normalization in line_normalizations:
+                    segments = line_normalization(segments)
+                found = iter_segments(automaton, line, segments, boundary)
+            else:
+                found = automaton.iter(line, boundary)
+            for start, end, symbol, symbol_id in select_longest(found):
+                attempt_match(
+                    matcher, matches, transforms_applied, match_attempts_writer,
+                    ocr_processor_id, figure_id, line[start:end], symbol_id, symbol)
+                match_attempts_writer.add_offset(
+                    ocr_processor_id, matcher["id"], figure_id, symbol, line_offset + start, line_offset + end)
+
+            if len(matches) > 0:
+                successes.append(line + ' => ' + ' & '.join(sorted(matches)))
+            else:
+                for word in split_words(line):
+                    attempt_match(matcher, matches, transforms_applied, match_attempts_writer, ocr_processor_id, figure_id, word, None, None)
+                fails.append(line)
+            line_offset += len(line) + 1
+    return successes, fails
+
+# Set by match() before the worker pool is created, so forked workers share the
+# (large) lexicon and transformed_words maps copy-on-write instead of pickling them.
+worker_state = {}
+
+def init_worker():
+    worker_state["conn"] = get_pg_conn()
+
+def match_shard(shard):
+    conn = worker_state["conn"]
+    matcher = worker_state["matcher"]
+    ocr_processors__figures_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    match_attempts_writer = MatchAttemptsWriter(conn, worker_state["transformed_word_ids_by_transformed_word"])
+    transform_cache = matcher["transform_cache"]
+    successes = []
+    fails = []
+    try:
+        ocr_processors__figures_cur.execute(
+            '''
+            SELECT ocr_processor_id, figure_id, jsonb_extract_path(result, 'textAnnotations', '0', 'description') AS description
+            FROM ocr_processors__figures
+            INNER JOIN unnest(%s::integer[], %s::integer[]) AS shard(ocr_processor_id, figure_id)
+                USING (ocr_processor_id, figure_id)
+            ORDER BY ocr_processor_id, figure_id;
             ''',
-            (ocr_processor_id, matcher_id, figure_id, word, transformed_word_id, symbol_id, " ".join(transform_args))
+            ([k[0] for k in shard], [k[1] for k in shard])
         )
+        for row in ocr_processors__figures_cur:
+            figure_successes, figure_fails = matcher["match_figure"](
+                matcher, match_attempts_writer,
+                row["ocr_processor_id"], row["figure_id"], row["description"])
+            successes.extend(figure_successes)
+            fails.extend(figure_fails)
+        match_attempts_writer.flush()
+        # Commit per shard: workers insert overlapping transformed_words, and
+        # holding those row locks across shards could deadlock the workers.
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        ocr_processors__figures_cur.close()
+    return (successes, fails, transform_cache.drain_new(), transform_cache.take_stats(), transform_cache.stats.take(),
+            matcher["budget"].take_quarantined())
 
-def match(args):
+def save_transform_stats(conn, matcher_id, transform_stats):
+    # one row per stage of the matcher's transform chain, for its latest run
+    cur = conn.cursor()
+    try:
+        for position, name, category, calls, seconds, p95, outputs, hits in transform_stats.rows():
+            cur.execute('''
+                INSERT INTO transform_stats (matcher_id, position, name, category, calls, total_seconds, p95_seconds, outputs, hits)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (matcher_id, position) DO UPDATE
+                SET calls = EXCLUDED.calls, total_seconds = EXCLUDED.total_seconds, p95_seconds = EXCLUDED.p95_seconds,
+                    outputs = EXCLUDED.outputs, hits = EXCLUDED.hits, updated = CURRENT_TIMESTAMP;
+                ''', (matcher_id, position + 1, name, category, calls, seconds, p95, outputs, hits))
+        conn.commit()
+    finally:
+        cur.close()
+
+class LineLog:
+    # Appends lines to a log file as they come in. The result is the same as
+    # appending '\n'.join(all_lines) at the end (no trailing newline).
+    def __init__(self, path):
+        self.path = path
+        self.first = True
+
+    def __enter__(self):
+        self.f = open(self.path, "a+")
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def write(self, lines):
+        for line in lines:
+            if not self.first:
+                self.f.write('\n')
+            self.f.write(line)
+            self.first = False
+
+def format_quarantined(quarantined):
+    # figure_id, scope (word or figure), reason, word
+    return ["\t".join([str(figure_id), scope, reason, (word or "").replace("\t", " ")])
+            for figure_id, scope, reason, word in quarantined]
+
+def chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def get_figures_filter(matcher_id, incremental=False, since=None, until=None):
+    # WHERE clause (and params) for the ocr_processors__figures rows to match
+    conditions = ["TRUE"]
+    params = []
+    if incremental:
+        # skip what this matcher has already done. Uses the
+        # (ocr_processor_id, matcher_id, figure_id, ...) unique index.
+        conditions.append('''NOT EXISTS (
+                SELECT 1 FROM match_attempts
+                WHERE match_attempts.ocr_processor_id = ocr_processors__figures.ocr_processor_id
+                    AND match_attempts.matcher_id = %s
+                    AND match_attempts.figure_id = ocr_processors__figures.figure_id)''')
+        params.append(matcher_id)
+    if since is not None:
+        conditions.append("ocr_processors__figures.figure_id >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("ocr_processors__figures.figure_id <= %s")
+        params.append(until)
+    return " AND ".join(conditions), params
+
+def add_matched_figure(figure_ids_by_ocr_processor_id, ocr_processor_id, figure_id, partial):
+    # what refresh_matched_figures__xrefs should refresh: each figure of a
+    # partial (--incremental, --since or --until) run, else everything for
+    # each ocr_processor the run matched
+    figure_ids = figure_ids_by_ocr_processor_id.setdefault(ocr_processor_id, [] if partial else None)
+    if figure_ids is not None:
+        figure_ids.append(figure_id)
+
+def match(args, workers=None, shard_size=50, cache_size=100000, cache_dir=None, mode="transforms", boundary="alnum", lexicon_dir=None, incremental=False, since=None, until=None, itersize=2000, word_seconds=WORD_SECONDS, figure_seconds=FIGURE_SECONDS, max_outputs=MAX_OUTPUTS):
     conn = get_pg_conn()
-    ocr_processors__figures_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     symbols_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     matchers_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     transformed_words_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    match_attempts_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    if mode == "aho_corasick":
+        # only normalizations (which apply to the lexicon) make sense here
+        mutations = [arg["name"] for arg in args if arg["category"] == "mutate"]
+        if mutations:
+            warnings.warn("aho_corasick mode ignores mutations: %s" % ", ".join(mutations))
+        args = [arg for arg in args if arg["category"] == "normalize"]
+    elif mode != "transforms":
+        raise Exception('match mode "%s" not recognized' % mode)
 
     # transforms_to_apply includes both mutations and normalizations
     transforms_to_apply = []
@@ -80,7 +329,7 @@ def match(args):
         category = arg["category"]
         name = arg["name"]
         t = getattr(getattr(transforms, name), name)
-        transforms_to_apply.append({"transform": t, "name": name, "category": category})
+        transforms_to_apply.append({"transform": t, "batch": transforms.get_batch(name), "name": name, "category": category})
 
     transforms_json = []
     for t in transforms_to_apply:
@@ -91,8 +340,29 @@ def match(args):
         with open("./transforms/" + name + ".py", "r") as f:
             code = f.read().encode()
             transform_json["code_hash"] = hashlib.sha224(code).hexdigest()
+        # e.g., extra swap tables
+        get_data_hash = getattr(getattr(transforms, name), "get_data_hash", None)
+        data_hash = get_data_hash() if get_data_hash else None
+        if data_hash:
+            transform_json["data_hash"] = data_hash
         transforms_json.append(transform_json)
 
+    # e.g., ["", "-n stop", "-n stop -m expand", ...]
+    transforms_applied_by_count = []
+    for i in range(len(args) + 1):
+        transforms_applied_by_count.append(" ".join("-" + t["category"][0] + " " + t["name"] for t in args[0:i]))
+
+    if mode == "aho_corasick":
+        with open("./aho_corasick.py", "r") as f:
+            code = f.read().encode()
+        transforms_json.append({
+            "category": "match",
+            "name": "aho_corasick",
+            "boundary": boundary,
+            "code_hash": hashlib.sha224(code).hexdigest()})
+        # transforms_applied can't be empty
+        transforms_applied_by_count[-1] = (transforms_applied_by_count[-1] + " -a aho_corasick:" + boundary).strip()
+
     transforms_json_str = json.dumps(transforms_json)
     matchers_cur.execute(
         '''
@@ -125,35 +395,48 @@ def match(args):
         if t_category == "normalize":
             normalizations.append(t)
 
+    snapshot = None
     try:
-        ocr_processors__figures_query = '''
-        SELECT ocr_processor_id, figure_id, jsonb_extract_path(result, 'textAnnotations', '0', 'description') AS description
-        FROM ocr_processors__figures ORDER BY ocr_processor_id, figure_id;
-        '''
-        ocr_processors__figures_cur.execute(ocr_processors__figures_query)
-
-        symbols_query = '''
-        SELECT id, symbol
-        FROM symbols;
-        '''
-        symbols_cur.execute(symbols_query)
-
-        # original symbol incl/
-        symbol_ids_by_symbol = {}
-        for s in symbols_cur:
-            symbol_id = s["id"]
-            symbol = s["symbol"]
-            normalized_results = [symbol]
-            for normalization in normalizations:
-                for normalized in normalized_results:
-                    normalized_results = []
-                    for n in normalization["transform"](normalized):
-                        normalized_results.append(n)
-                        if n not in symbol_ids_by_symbol: 
-                            symbol_ids_by_symbol[n] = symbol_id
-                        # Also collect unique uppercased symbols for matching
-                        if n.upper() not in symbol_ids_by_symbol:
-                            symbol_ids_by_symbol[n.upper] = symbol_id
+        symbols_checksum = None
+        if cache_dir or lexicon_dir:
+            symbols_cur.execute("SELECT md5(string_agg(id || ':' || symbol, E'\\n' ORDER BY id)) FROM symbols;")
+            symbols_checksum = symbols_cur.fetchone()[0] or ""
+
+        symbol_ids_by_symbol = None
+        if lexicon_dir:
+            # Only the normalizations (and the symbols table) go into
+            # symbol_ids_by_symbol, so matchers that differ only in their
+            # mutations can share a snapshot.
+            normalizations_json = [t for t in transforms_json if t["category"] == "normalize"]
+            snapshot_key = hashlib.sha224((json.dumps(normalizations_json) + symbols_checksum).encode()).hexdigest()
+            snapshot_path = get_snapshot_path(lexicon_dir, snapshot_key)
+            if snapshot_path.exists():
+                # looked up in place (and closed when the run is done)
+                snapshot = LexiconSnapshot(snapshot_path)
+                symbol_ids_by_symbol = snapshot
+                print('loaded lexicon snapshot %s' % snapshot_path)
+
+        if symbol_ids_by_symbol is None:
+            symbols_query = '''
+            SELECT id, symbol
+            FROM symbols;
+            '''
+            symbols_cur.execute(symbols_query)
+            symbol_ids_by_symbol = build_symbol_ids_by_symbol(symbols_cur, normalizations)
+            if lexicon_dir:
+                os.makedirs(lexicon_dir, exist_ok=True)
+                write_snapshot(snapshot_path, symbol_ids_by_symbol)
+                print('saved lexicon snapshot %s' % snapshot_path)
+
+        # A cached result depends on the transforms and, via the symbol ids,
+        # on the lexicon. Only a cache that outlives this run needs the latter.
+        transform_cache_key = transforms_json_str
+        if cache_dir:
+            transform_cache_key += symbols_checksum
+        transform_cache = TransformCache(
+            hashlib.sha224(transform_cache_key.encode()).hexdigest(), maxsize=cache_size, cache_dir=cache_dir,
+            stats=TransformStats(transforms_to_apply))
+        transform_cache.load()
 
         #with open("./symbol_ids_by_symbol.json", "a+") as symbol_ids_by_symbol_file:
         #    symbol_ids_by_symbol_file.write(json.dumps(symbol_ids_by_symbol))
@@ -170,69 +453,111 @@ def match(args):
             transformed_word = row["transformed_word"]
             transformed_word_ids_by_transformed_word[transformed_word] = transformed_word_id
 
-        successes = []
-        fails = []
-        for row in ocr_processors__figures_cur:
-            ocr_processor_id = row["ocr_processor_id"]
-            figure_id = row["figure_id"]
-            paragraph = row["description"]
-            if paragraph:
-                for line in paragraph.split("\n"):
-                    words = set()
-                    words.add(line.replace(" ", ""))
-                    matches = set()
-                    for w in line.split(" "):
-                        words.add(w)
-                    for word in words:
-                        transforms_applied = []
-                        transformed_words = [word]
-                        for transform_to_apply in transforms_to_apply:
-                            transforms_applied.append(transform_to_apply["name"])
-                            for transformed_word_prev in transformed_words:
-                                transformed_words = []
-                                for transformed_word in transform_to_apply["transform"](transformed_word_prev):
-                                    # perform match for original and uppercased words (see elif)
-
-                                    try:
-                                        if transformed_word in symbol_ids_by_symbol: 
-                                            attempt_match(
-                                                args, matcher_id, transformed_word_ids_by_transformed_word, matches,
-                                                transforms_applied, match_attempts_cur, transformed_words_cur, ocr_processor_id,
-                                                figure_id, word, symbol_ids_by_symbol[transformed_word], transformed_word)
-                                        elif transformed_word.upper() in symbol_ids_by_symbol:
-                                            attempt_match(
-                                                args, matcher_id, transformed_word_ids_by_transformed_word, matches,
-                                                transforms_applied, match_attempts_cur, transformed_words_cur, ocr_processor_id,
-                                                figure_id, word, symbol_ids_by_symbol[transformed_word.upper()], transformed_word.upper())
-                                        else:
-                                            transformed_words.append(transformed_word)
-
-                                #    except TimedOutExc as e:
-                                #        print "took too long"
-
-                                    except(Exception) as e:
-                                        print('Unexpected Error:', e)
-                                        print('figure_id:', figure_id)
-                                        print('word:', word)
-                                        print('transformed_word:', transformed_word)
-                                        print('transforms_applied:', transforms_applied)
-                                        raise
-
-
-                        if len(matches) == 0:
-                            attempt_match(args, matcher_id, transformed_word_ids_by_transformed_word, matches, transforms_applied, match_attempts_cur, transformed_words_cur, ocr_processor_id, figure_id, word, None, None)
-                    if len(matches) > 0:
-                        successes.append(line + ' => ' + ' & '.join(matches))
-                    else:
-                        fails.append(line)
-
+        matcher = {
+            "id": matcher_id,
+            "transforms_to_apply": transforms_to_apply,
+            "transforms_applied_by_count": transforms_applied_by_count,
+            "symbol_ids_by_symbol": symbol_ids_by_symbol,
+            "transform_cache": transform_cache,
+            "budget": Budget(word_seconds=word_seconds, figure_seconds=figure_seconds, max_outputs=max_outputs),
+            "match_figure": match_figure,
+        }
+        if mode == "aho_corasick":
+            matcher["automaton"] = build_automaton(symbol_ids_by_symbol)
+            matcher["boundary"] = boundary
+            # the lexicon keys are normalized, so the lines need to be too
+            matcher["line_normalizations"] = get_line_normalizations(normalizations)
+            matcher["match_figure"] = match_figure_aho_corasick
+
+        figures_filter, figures_filter_params = get_figures_filter(matcher_id, incremental, since, until)
+        partial = incremental or since is not None or until is not None
+        figure_ids_by_ocr_processor_id = {}
+
+        # The OCR results are read through a server-side (named) cursor,
+        # itersize rows at a time, and the logs are written as we go, so
+        # memory use doesn't grow with the number of figures.
+        ocr_processors__figures_stream = conn.cursor("ocr_processors__figures_stream", cursor_factory=psycopg2.extras.DictCursor)
+        ocr_processors__figures_stream.itersize = itersize
+        budget = matcher["budget"]
+        with LineLog("./outputs/successes.txt") as successes_log, LineLog("./outputs/fails.txt") as fails_log, \
+                LineLog("./outputs/quarantine.tsv") as quarantine_log:
+            if workers and workers > 1:
+                # the matcher row must be visible to the workers' connections
+                conn.commit()
+
+                ocr_processors__figures_stream.execute('''
+                SELECT ocr_processor_id, figure_id
+                FROM ocr_processors__figures
+                WHERE %s
+                ORDER BY ocr_processor_id, figure_id;
+                ''' % figures_filter, figures_filter_params)
+                def get_keys():
+                    for row in ocr_processors__figures_stream:
+                        add_matched_figure(figure_ids_by_ocr_processor_id, row["ocr_processor_id"], row["figure_id"], partial)
+                        yield (row["ocr_processor_id"], row["figure_id"])
+                keys = get_keys()
+
+                worker_state.update({
+                    "matcher": matcher,
+                    "transformed_word_ids_by_transformed_word": transformed_word_ids_by_transformed_word,
+                })
+                with multiprocessing.get_context("fork").Pool(workers, initializer=init_worker) as pool:
+                    # Pool.imap would queue up every shard at once, so hand
+                    # out a few per worker at a time. imap keeps shard order,
+                    # so the logs come out as in a serial run.
+                    all_shards = chunked(keys, shard_size)
+                    while True:
+                        shards = list(islice(all_shards, workers * 4))
+                        if not shards:
+                            break
+                        for shard_successes, shard_fails, new_cache_entries, cache_stats, transform_stats, quarantined in pool.imap(match_shard, shards):
+                            successes_log.write(shard_successes)
+                            fails_log.write(shard_fails)
+                            quarantine_log.write(format_quarantined(quarantined))
+                            budget.count(quarantined)
+                            transform_cache.merge(new_cache_entries, cache_stats)
+                            transform_cache.stats.merge(transform_stats)
+            else:
+                match_attempts_writer = MatchAttemptsWriter(conn, transformed_word_ids_by_transformed_word)
+
+                ocr_processors__figures_query = '''
+                SELECT ocr_processor_id, figure_id, jsonb_extract_path(result, 'textAnnotations', '0', 'description') AS description
+                FROM ocr_processors__figures
+                WHERE %s
+                ORDER BY ocr_processor_id, figure_id;
+                ''' % figures_filter
+                ocr_processors__figures_stream.execute(ocr_processors__figures_query, figures_filter_params)
+                for row in ocr_processors__figures_stream:
+                    add_matched_figure(figure_ids_by_ocr_processor_id, row["ocr_processor_id"], row["figure_id"], partial)
+                    figure_successes, figure_fails = matcher["match_figure"](
+                        matcher, match_attempts_writer,
+                        row["ocr_processor_id"], row["figure_id"], row["description"])
+                    successes_log.write(figure_successes)
+                    fails_log.write(figure_fails)
+                    quarantine_log.write(format_quarantined(budget.take_quarantined()))
+
+                match_attempts_writer.flush()
+            ocr_processors__figures_stream.close()
+            conn.commit()
+
+        # keep the materialized figures__xrefs (used by summarize) up to date,
+        # for just the figures this run matched
+        figures__xrefs_cur = conn.cursor()
+        row_counts = refresh_matched_figures__xrefs(figures__xrefs_cur, matcher_id, figure_ids_by_ocr_processor_id)
+        figures__xrefs_cur.close()
         conn.commit()
+        for ocr_processor_id, row_count in row_counts.items():
+            print('figures__xrefs_materialized: {row_count} rows for matcher {matcher_id}, ocr_processor {ocr_processor_id}{scope}'.format(
+                row_count=row_count, matcher_id=matcher_id, ocr_processor_id=ocr_processor_id,
+                scope=" (%s figures)" % len(figure_ids_by_ocr_processor_id[ocr_processor_id]) if partial else ""))
 
-        with open("./outputs/successes.txt", "a+") as successesfile:
-            successesfile.write('\n'.join(successes))
+        if mode == "transforms":
+            save_transform_stats(conn, matcher_id, transform_cache.stats)
+            print(transform_cache.stats.report())
 
-        with open("./outputs/fails.txt", "a+") as failsfile:
-            failsfile.write('\n'.join(fails))
+        transform_cache.save()
+        print(transform_cache.report())
+        print(budget.report())
 
         print('match: SUCCESS')
 
@@ -247,5 +572,7 @@ def match(args):
         raise
 
     finally:
+        if snapshot is not None:
+            snapshot.close()
         if conn:
             conn.close()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+
+# Buffers rows for transformed_words, match_attempts and match_offsets and writes them in
+# batches: COPY into a temp staging table, then one set-based upsert.
+#
+# Conflict semantics are the same as the old row-at-a-time inserts:
+# * transformed_words: existing words keep their id.
+# * match_attempts: ON CONFLICT DO NOTHING, applied in the order the rows
+#   were added, so the first attempt for a key still wins. Rows with a NULL
+#   transformed_word_id only conflict via match_attempts_null_unique_idx,
+#   and we don't dedupe them ourselves, so that index behaves as before.
+
+
+def format_copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cur, table, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(format_copy_value(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert("COPY %s (%s) FROM STDIN;" % (table, ", ".join(columns)), buf)
+
+
+class MatchAttemptsWriter:
+    def __init__(self, conn, transformed_word_ids_by_transformed_word, batch_size=50000):
+        self.conn = conn
+        self.transformed_word_ids_by_transformed_word = transformed_word_ids_by_transformed_word
+        self.batch_size = batch_size
+        self.new_transformed_words = set()
+        self.match_attempts = []
+        self.match_offsets = []
+        self.staging_created = False
+
+    def add(self, ocr_processor_id, matcher_id, figure_id, word, transformed_word, symbol_id, transforms_applied):
+        if transformed_word and transformed_word not in self.transformed_word_ids_by_transformed_word:
+            self.new_transformed_words.add(transformed_word)
+        self.match_attempts.append(
+            (ocr_processor_id, matcher_id, figure_id, word, transformed_word, symbol_id, transforms_applied))
+        if len(self.match_attempts) >= self.batch_size:
+            self.flush()
+
+    def add_offset(self, ocr_processor_id, matcher_id, figure_id, transformed_word, start_offset, end_offset):
+        if transformed_word not in self.transformed_word_ids_by_transformed_word:
+            self.new_transformed_words.add(transformed_word)
+        self.match_offsets.append(
+            (ocr_processor_id, matcher_id, figure_id, transformed_word, start_offset, end_offset))
+
+    def create_staging(self, cur):
+        if self.staging_created:
+            return
+        cur.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS transformed_words_staging (
+                transformed_word text NOT NULL
+            );
+            CREATE TEMP TABLE IF NOT EXISTS match_attempts_staging (
+                seq serial,
+                ocr_processor_id integer,
+                matcher_id integer,
+                figure_id integer,
+                word text,
+                transformed_word_id integer,
+                symbol_id integer,
+                transforms_applied text
+            );
+            CREATE TEMP TABLE IF NOT EXISTS match_offsets_staging (
+                ocr_processor_id integer,
+                matcher_id integer,
+                figure_id integer,
+                transformed_word_id integer,
+                start_offset integer,
+                end_offset integer
+            );
+            ''')
+        self.staging_created = True
+
+    def flush_transformed_words(self, cur):
+        if not self.new_transformed_words:
+            return
+        cur.execute("TRUNCATE transformed_words_staging;")
+        # sorted so concurrent writers take row locks in the same order
+        copy_rows(cur, "transformed_words_staging", ["transformed_word"],
+                  ((w, ) for w in sorted(self.new_transformed_words)))
+        cur.execute('''
+            INSERT INTO transformed_words (transformed_word)
+            SELECT transformed_word FROM transformed_words_staging
+            ORDER BY transformed_word
+            ON CONFLICT (transformed_word) DO NOTHING;
+            ''')
+        cur.execute('''
+            SELECT transformed_words.id, transformed_words.transformed_word
+            FROM transformed_words
+            INNER JOIN transformed_words_staging
+                ON transformed_words.transformed_word = transformed_words_staging.transformed_word;
+            ''')
+        for transformed_word_id, transformed_word in cur:
+            self.transformed_word_ids_by_transformed_word[transformed_word] = transformed_word_id
+        self.new_transformed_words = set()
+
+    def flush(self):
+        if not self.match_attempts and not self.match_offsets and not self.new_transformed_words:
+            return
+        cur = self.conn.cursor()
+        try:
+            self.create_staging(cur)
+            self.flush_transformed_words(cur)
+
+            ids = self.transformed_word_ids_by_transformed_word
+            cur.execute("TRUNCATE match_attempts_staging RESTART IDENTITY;")
+            copy_rows(
+                cur,
+                "match_attempts_staging",
+                ["ocr_processor_id", "matcher_id", "figure_id", "word", "transformed_word_id", "symbol_id", "transforms_applied"],
+                ((ocr_processor_id, matcher_id, figure_id, word, ids[transformed_word] if transformed_word else None, symbol_id, transforms_applied)
+                    for (ocr_processor_id, matcher_id, figure_id, word, transformed_word, symbol_id, transforms_applied) in self.match_attempts))
+            cur.execute('''
+                INSERT INTO match_attempts (ocr_processor_id, matcher_id, figure_id, word, transformed_word_id, symbol_id, transforms_applied)
+                SELECT ocr_processor_id, matcher_id, figure_id, word, transformed_word_id, symbol_id, transforms_applied
+                FROM match_attempts_staging
+                ORDER BY seq
+                ON CONFLICT DO NOTHING;
+                ''')
+            self.match_attempts = []
+
+            if self.match_offsets:
+                cur.execute("TRUNCATE match_offsets_staging;")
+                copy_rows(
+                    cur,
+                    "match_offsets_staging",
+                    ["ocr_processor_id", "matcher_id", "figure_id", "transformed_word_id", "start_offset", "end_offset"],
+                    ((ocr_processor_id, matcher_id, figure_id, ids[transformed_word], start_offset, end_offset)
+                        for (ocr_processor_id, matcher_id, figure_id, transformed_word, start_offset, end_offset) in self.match_offsets))
+                cur.execute('''
+                    INSERT INTO match_offsets (ocr_processor_id, matcher_id, figure_id, transformed_word_id, start_offset, end_offset)
+                    SELECT ocr_processor_id, matcher_id, figure_id, transformed_word_id, start_offset, end_offset
+                    FROM match_offsets_staging
+                    ON CONFLICT DO NOTHING;
+                    ''')
+                self.match_offsets = []
+        finally:
+            cur.close()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Runs a blocking OCR call over many items with bounded concurrency, a
+# token-bucket rate limit and retries with exponential backoff.
+#
+# The OCR calls themselves run in a thread pool (the engines use requests,
+# which is blocking), while scheduling, rate limiting and result handling
+# happen on the asyncio event loop, i.e., in the calling thread. That means
+# on_result can safely use the caller's database connection.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    # Allows `rate` acquisitions per second on average, with bursts of up to
+    # `capacity`.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ThreadTokenBucket:
+    # TokenBucket for worker threads, e.g., inside perform, where acquire
+    # blocks instead of awaiting.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    # "full jitter": a random delay up to base_delay * 2^attempt
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def is_transient_default(e):
+    return isinstance(e, (ConnectionError, TimeoutError))
+
+
+def call_with_retries_blocking(perform, item, bucket=None, max_retries=5, is_transient=is_transient_default,
+                               base_delay=1.0, max_delay=60.0):
+    # call_with_retries for inside perform, e.g., for each of the requests
+    # one batch of images is sent as, so one failing doesn't throw away the
+    # results of the others. bucket is a ThreadTokenBucket.
+    attempt = 0
+    while True:
+        if bucket:
+            bucket.acquire()
+        try:
+            return perform(item)
+        except Exception as e:
+            if attempt >= max_retries or not is_transient(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print('Transient OCR error (attempt %s of %s), retrying in %.1fs: %s' % (attempt + 1, max_retries + 1, delay, e))
+            time.sleep(delay)
+            attempt += 1
+
+
+def get_base64_size(filepath):
+    # base64 makes the image 4/3 as big
+    return (os.path.getsize(filepath) + 2) // 3 * 4
+
+
+def pack_batches(filepaths, max_images, max_bytes):
+    # Splits filepaths, in order, into batches of at most max_images images
+    # and max_bytes of base64 image data (an image bigger than max_bytes gets
+    # a batch of its own).
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for filepath in filepaths:
+        size = get_base64_size(filepath)
+        if batch and (len(batch) >= max_images or batch_bytes + size > max_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(filepath)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def call_with_retries(loop, executor, perform, item, bucket=None, max_retries=5,
+                            is_transient=is_transient_default, base_delay=1.0, max_delay=60.0):
+    attempt = 0
+    while True:
+        if bucket:
+            await bucket.acquire()
+        try:
+            return await loop.run_in_executor(executor, perform, item)
+        except Exception as e:
+            if attempt >= max_retries or not is_transient(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print('Transient OCR error (attempt %s of %s), retrying in %.1fs: %s' % (attempt + 1, max_retries + 1, delay, e))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def run_concurrently_async(items, perform, on_result, concurrency=8, rate=None, max_retries=5,
+                                 is_transient=is_transient_default, base_delay=1.0, max_delay=60.0,
+                                 on_error=None):
+    # perform(item) runs in a worker thread. on_result(item, result) and
+    # on_error(item, exception) run on the event loop, one at a time. Without
+    # on_error, the first error that survives its retries stops the run.
+    loop = asyncio.get_running_loop()
+    bucket = TokenBucket(rate) if rate else None
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        async def worker():
+            # each worker pulls the next item when it's done with the last,
+            # so at most `concurrency` items are in flight
+            for item in items:
+                try:
+                    result = await call_with_retries(
+                        loop, executor, perform, item, bucket=bucket, max_retries=max_retries,
+                        is_transient=is_transient, base_delay=base_delay, max_delay=max_delay)
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    on_error(item, e)
+                    continue
+                on_result(item, result)
+
+        tasks = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+
+def run_concurrently(items, perform, on_result, **kwargs):
+    return asyncio.run(run_concurrently_async(items, perform, on_result, **kwargs))
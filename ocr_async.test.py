@@ -0,0 +1,297 @@
+import asyncio
+import base64
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from ocr_async import call_with_retries_blocking, pack_batches, run_concurrently, ThreadTokenBucket, TokenBucket
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+
+class StubAnnotateHandler(http.server.BaseHTTPRequestHandler):
+    # Mimics POST /v1/images:annotate. A request is rejected with a 429 if any
+    # of its images has been sent fewer than `fail_first` times before. Then
+    # each image's content is "recognized" as the text of the image file,
+    # except that an image containing BAD gets a per-image error.
+    fail_first = 1
+    attempts = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        contents = [r["image"]["content"] for r in body["requests"]]
+        with self.lock:
+            rejected = False
+            for content in contents:
+                attempt = self.attempts.get(content, 0)
+                self.attempts[content] = attempt + 1
+                rejected = rejected or attempt < self.fail_first
+        if rejected:
+            self.send_response(429)
+            self.end_headers()
+            return
+        responses = []
+        for content in contents:
+            text = base64.b64decode(content).decode("utf8")
+            if "BAD" in text:
+                responses.append({"error": {"code": 3, "message": "Bad image data."}})
+            else:
+                responses.append({"textAnnotations": [{"description": text}]})
+        response = json.dumps({"responses": responses}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        StubAnnotateHandler.attempts = {}
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubAnnotateHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%s/v1/images:annotate?key=test" % self.server.server_port
+        self.image_dir = tempfile.mkdtemp()
+        self.filepaths = []
+        for i in range(12):
+            filepath = os.path.join(self.image_dir, "PMC%s__fig1.png" % i)
+            with open(filepath, "w") as f:
+                f.write("WNT%s" % i)
+            self.filepaths.append(filepath)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.image_dir)
+
+
+class TestRunConcurrently(StubServerTestCase):
+
+    def annotate(self, filepath):
+        with open(filepath, "rb") as f:
+            body = json.dumps({"requests": [{"image": {"content": base64.b64encode(f.read()).decode("utf8")}}]})
+        request = urllib.request.Request(self.url, data=body.encode(), headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as r:
+            return json.loads(r.read())["responses"][0]
+
+    def test_retries_rate_limited_requests(self):
+        results = {}
+        run_concurrently(
+            self.filepaths, self.annotate, lambda filepath, result: results.update({filepath: result}),
+            concurrency=4, base_delay=0.01, max_retries=3,
+            is_transient=lambda e: isinstance(e, urllib.error.HTTPError) and e.code == 429)
+        self.assertEqual(len(results), len(self.filepaths))
+        for i, filepath in enumerate(self.filepaths):
+            self.assertEqual(results[filepath]["textAnnotations"][0]["description"], "WNT%s" % i)
+        self.assertTrue(all(attempts == 2 for attempts in StubAnnotateHandler.attempts.values()))
+
+    def test_gives_up_after_max_retries(self):
+        StubAnnotateHandler.fail_first = 10
+        try:
+            with self.assertRaises(urllib.error.HTTPError):
+                run_concurrently(
+                    self.filepaths[0:2], self.annotate, lambda filepath, result: None,
+                    concurrency=2, base_delay=0.01, max_retries=2,
+                    is_transient=lambda e: isinstance(e, urllib.error.HTTPError) and e.code == 429)
+        finally:
+            StubAnnotateHandler.fail_first = 1
+
+    def test_on_error(self):
+        errors = []
+        run_concurrently(
+            self.filepaths[0:3], self.annotate, lambda filepath, result: None,
+            concurrency=2, max_retries=0,
+            on_error=lambda filepath, e: errors.append(filepath))
+        self.assertEqual(sorted(errors), sorted(self.filepaths[0:3]))
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class TestGcvEngine(StubServerTestCase):
+
+    def test_gcv_against_stub(self):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from ocr_engines import gcv
+        gcv.URL = self.url
+        results = {}
+        run_concurrently(
+            self.filepaths, gcv.gcv, lambda filepath, result: results.update({filepath: result}),
+            concurrency=4, base_delay=0.01, is_transient=gcv.is_transient_error)
+        self.assertEqual(results[self.filepaths[3]]["textAnnotations"][0]["description"], "WNT3")
+
+    def test_gcv_batch_keeps_order_and_per_image_errors(self):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from ocr_engines import gcv
+        gcv.URL = self.url
+        bad_filepath = os.path.join(self.image_dir, "PMC99__BAD.png")
+        with open(bad_filepath, "w") as f:
+            f.write("BAD")
+        filepaths = self.filepaths[0:5] + [bad_filepath] + self.filepaths[5:]
+
+        batches = [filepaths[0:7], filepaths[7:]]
+        results = {}
+        run_concurrently(
+            batches, lambda batch: gcv.gcv_batch(batch, base_delay=0.01),
+            lambda batch, batch_results: results.update(zip(batch, batch_results)),
+            concurrency=2, base_delay=0.01, is_transient=gcv.is_transient_error)
+        self.assertIn("error", results[bad_filepath])
+        for i, filepath in enumerate(self.filepaths):
+            self.assertEqual(results[filepath]["textAnnotations"][0]["description"], "WNT%s" % i)
+
+    def test_gcv_batch_retries_each_request(self):
+        # one call, sent as three requests, each rejected once: no image is
+        # sent again because a later request was rejected
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from ocr_engines import gcv
+        gcv.URL = self.url
+        max_batch_images = gcv.MAX_BATCH_IMAGES
+        gcv.MAX_BATCH_IMAGES = 5
+        try:
+            results = gcv.gcv_batch(self.filepaths, base_delay=0.01)
+        finally:
+            gcv.MAX_BATCH_IMAGES = max_batch_images
+        for i, result in enumerate(results):
+            self.assertEqual(result["textAnnotations"][0]["description"], "WNT%s" % i)
+        self.assertEqual(set(StubAnnotateHandler.attempts.values()), {2})
+
+    def test_gcv_batch_keeps_results_of_requests_that_succeeded(self):
+        # the first request's images are let through, the other requests
+        # are rate limited every time
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from ocr_engines import gcv
+        gcv.URL = self.url
+        for filepath in self.filepaths[0:5]:
+            with open(filepath, "rb") as f:
+                StubAnnotateHandler.attempts[base64.b64encode(f.read()).decode("utf8")] = 10
+        bucket = CountingBucket()
+        max_batch_images = gcv.MAX_BATCH_IMAGES
+        gcv.MAX_BATCH_IMAGES = 5
+        StubAnnotateHandler.fail_first = 10
+        try:
+            results = gcv.gcv_batch(self.filepaths, max_retries=1, base_delay=0.01, bucket=bucket)
+        finally:
+            gcv.MAX_BATCH_IMAGES = max_batch_images
+            StubAnnotateHandler.fail_first = 1
+        self.assertEqual(len(results), len(self.filepaths))
+        for i, result in enumerate(results[0:5]):
+            self.assertEqual(result["textAnnotations"][0]["description"], "WNT%s" % i)
+        for result in results[5:]:
+            self.assertEqual(result["error"]["code"], 429)
+        # sent once
+        self.assertEqual(set(list(StubAnnotateHandler.attempts.values())[0:5]), {11})
+        # a token per HTTP request: 1 for the first, 2 (with the retry) for each other
+        self.assertEqual(bucket.count, 5)
+
+
+class CountingBucket:
+
+    def __init__(self):
+        self.count = 0
+
+    def acquire(self):
+        self.count += 1
+
+
+class TestPackBatches(unittest.TestCase):
+
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp()
+        self.filepaths = []
+        # 3 bytes (4 in base64), then 4 and 5 bytes (8 in base64)
+        for i, content in enumerate(["BAD", "WNT1", "WNT1", "WNT10", "WNT10", "WNT1", "WNT1"]):
+            filepath = os.path.join(self.image_dir, "PMC%s__fig1.png" % i)
+            with open(filepath, "w") as f:
+                f.write(content)
+            self.filepaths.append(filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+
+    def test_max_images(self):
+        self.assertEqual([len(b) for b in pack_batches(self.filepaths, 3, 1000)], [3, 3, 1])
+        self.assertEqual(sum(pack_batches(self.filepaths, 3, 1000), []), self.filepaths)
+
+    def test_max_bytes(self):
+        self.assertEqual([len(b) for b in pack_batches(self.filepaths, 16, 16)], [2, 2, 2, 1])
+        self.assertEqual([len(b) for b in pack_batches(self.filepaths, 16, 20)], [3, 2, 2])
+        # an image over max_bytes still gets sent, on its own
+        self.assertEqual([len(b) for b in pack_batches(self.filepaths, 16, 6)], [1, 1, 1, 1, 1, 1, 1])
+
+    def test_empty(self):
+        self.assertEqual(pack_batches([], 16, 16), [])
+
+
+class TestCallWithRetriesBlocking(unittest.TestCase):
+
+    def test_retries_transient_errors(self):
+        attempts = []
+
+        def perform(item):
+            attempts.append(item)
+            if len(attempts) < 3:
+                raise ConnectionError()
+            return item * 2
+
+        self.assertEqual(call_with_retries_blocking(perform, 21, base_delay=0.001), 42)
+        self.assertEqual(attempts, [21, 21, 21])
+
+    def test_gives_up(self):
+        def perform(item):
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            call_with_retries_blocking(perform, 1, max_retries=2, base_delay=0.001)
+        with self.assertRaises(ValueError):
+            call_with_retries_blocking(lambda item: int("x"), 1, base_delay=0.001)
+
+    def test_bucket_per_try(self):
+        bucket = CountingBucket()
+        attempts = []
+
+        def perform(item):
+            attempts.append(item)
+            if len(attempts) < 2:
+                raise ConnectionError()
+            return item
+
+        call_with_retries_blocking(perform, 1, bucket=bucket, base_delay=0.001)
+        self.assertEqual(bucket.count, 2)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate(self):
+        async def acquire_all():
+            bucket = TokenBucket(rate=100, capacity=1)
+            for _ in range(11):
+                await bucket.acquire()
+        start = time.monotonic()
+        asyncio.run(acquire_all())
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_thread_rate(self):
+        bucket = ThreadTokenBucket(rate=100, capacity=1)
+        start = time.monotonic()
+        threads = [threading.Thread(target=bucket.acquire) for _ in range(11)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+if __name__ == '__main__':
+    unittest.main()
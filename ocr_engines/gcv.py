@@ -1,18 +1,52 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+# Run from the repo root, e.g., python -m ocr_engines.gcv FILE
+#
 # See also
 # https://github.com/GoogleCloudPlatform/python-docs-samples/blob/master/vision/cloud-client/detect/detect.py#L272
 
 import argparse
 import base64
 import json
+import os
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
 
-p = Path('/home/ariutta/.credentials/GCV_API_KEY')
-API_KEY = p.read_text().strip()
-URL = "https://vision.googleapis.com/v1/images:annotate?key=%s" % (API_KEY)
+import ocr_async
+
+API_KEY_PATH = Path('/home/ariutta/.credentials/GCV_API_KEY')
+# GCV_URL overrides the endpoint, e.g., to point at a local stub server
+URL = os.environ.get("GCV_URL")
+
+# One session for every request, so concurrent OCR calls (see ocr_async.py)
+# reuse pooled keep-alive connections.
+session = requests.Session()
+
+TRANSIENT_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+def get_url():
+    global URL
+    if not URL:
+        API_KEY = API_KEY_PATH.read_text().strip()
+        URL = "https://vision.googleapis.com/v1/images:annotate?key=%s" % (API_KEY)
+    return URL
+
+
+def set_pool_size(pool_size):
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def is_transient_error(e):
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code in TRANSIENT_STATUS_CODES
+    return False
 
 
 def gcv_raw(
@@ -30,7 +64,10 @@ def gcv_raw(
         headers = {
             'Content-Type': 'application/json',
         }
-        r = requests.post(URL, data=body, headers=headers)
+        r = session.post(get_url(), data=body, headers=headers, timeout=120)
+        # rate limits and server errors are worth retrying (see is_transient_error)
+        if r.status_code in TRANSIENT_STATUS_CODES:
+            r.raise_for_status()
         return r.json()
 
 
@@ -61,6 +98,73 @@ def gcv(prepared_filepath):
     return gcv_result_raw['responses'][0]
 
 
+# The annotate endpoint takes at most 16 images per request, and the whole
+# JSON request must stay under ~10 MB.
+MAX_BATCH_IMAGES = 16
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+
+def gcv_raw_batch(
+        filepaths=None,
+        type=None):
+    image_requests = []
+    for filepath in filepaths:
+        with open(filepath, "rb") as image_file:
+            image_b64 = base64.b64encode(image_file.read()).decode('utf8')
+        image_requests.append({
+            "image": {"content": image_b64},
+            "features": [{"type": type}]
+        })
+    body = json.dumps({"requests": image_requests})
+    headers = {
+        'Content-Type': 'application/json',
+    }
+    r = session.post(get_url(), data=body, headers=headers, timeout=300)
+    if r.status_code in TRANSIENT_STATUS_CODES:
+        r.raise_for_status()
+    return r.json()
+
+
+def get_error(e):
+    # an exception as a GCV-style per-image error
+    error = {"message": str(e)}
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        error["code"] = e.response.status_code
+    return {"error": error}
+
+
+def gcv_batch(prepared_filepaths, max_retries=5, base_delay=1.0, bucket=None):
+    # Like gcv, but for a list of images, sent several per request.
+    # Returns one result per image, in order. A result for an image that GCV
+    # couldn't handle is {"error": {...}}, as in GCV's own responses, and
+    # doesn't affect the other results.
+    # The images may not fit in one request. Each request is retried on its
+    # own (up to max_retries times, taking a token from bucket, an
+    # ocr_async.ThreadTokenBucket, for each try), and one that still fails
+    # only fails its own images. So this doesn't raise for a failed request,
+    # and the caller never has to re-send (and pay for) the other images.
+    results = []
+    for batch in ocr_async.pack_batches(prepared_filepaths, MAX_BATCH_IMAGES, MAX_BATCH_BYTES):
+        try:
+            gcv_result_raw = ocr_async.call_with_retries_blocking(
+                lambda filepaths: gcv_raw_batch(filepaths=filepaths, type='TEXT_DETECTION'), batch, bucket=bucket,
+                max_retries=max_retries, is_transient=is_transient_error, base_delay=base_delay)
+        except Exception as e:
+            print('GCV request for {count} images failed: {e}'.format(count=len(batch), e=e))
+            results.extend(get_error(e) for filepath in batch)
+            continue
+        responses = gcv_result_raw.get('responses')
+        if responses is not None and len(responses) == len(batch):
+            results.extend(responses)
+        elif len(batch) == 1:
+            results.append({"error": gcv_result_raw.get('error', gcv_result_raw)})
+        else:
+            # The whole request was rejected, e.g., because of one bad image.
+            # Send the images one at a time so only that one fails.
+            for filepath in batch:
+                results.extend(gcv_batch([filepath], max_retries=max_retries, base_delay=base_delay, bucket=bucket))
+    return results
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='''OCR an image.''')
@@ -3,24 +3,76 @@
 
 import image_preprocessors
 import ocr_engines
+from itertools import islice
 import json
+import os
 from pathlib import Path
 import psycopg2
 import psycopg2.extras
 import re
 import hashlib
+import signal
+import socket
 import sys
+import time
 from dill.source import getsource
 
 from get_pg_conn import get_pg_conn
+from ocr_async import is_transient_default, run_concurrently, ThreadTokenBucket
 
 def get_engines():
     return ocr_engines.__all__
 
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Checkpointer:
+    # Commits after every `every` handled figures or `seconds` seconds,
+    # whichever comes first, so a crash only loses the work since the last
+    # checkpoint.
+    def __init__(self, conn, every=100, seconds=60.0):
+        self.conn = conn
+        self.every = every
+        self.seconds = seconds
+        self.pending = 0
+        self.committed = 0
+        self.last_commit = time.monotonic()
+
+    def handled(self, count=1):
+        self.pending += count
+        if (self.every and self.pending >= self.every) or \
+                (self.seconds and time.monotonic() - self.last_commit >= self.seconds):
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.last_commit = time.monotonic()
+        if self.pending:
+            self.committed += self.pending
+            self.pending = 0
+            print('checkpoint: {committed} figures committed'.format(committed=self.committed))
+
 def ocr_pmc(
         engine,
         preprocessor="noop",
         limit=None,
+        concurrency=None,
+        rate=None,
+        max_retries=5,
+        batch_size=None,
+        checkpoint_every=100,
+        checkpoint_seconds=60.0,
+        skip_failed=False,
+        queue=False,
+        lease_size=10,
+        lease_seconds=600,
         *args,
         **kwargs):
     conn = get_pg_conn()
@@ -62,22 +114,161 @@ def ocr_pmc(
             ocr_processor_id = ocr_processors_cur.fetchone()[0]
             ocr_processor_hash_to_id[ocr_processor_hash] = ocr_processor_id
 
-        # Find figures that haven't been handled by this processor already
-        figures_cur.execute('''
-            SELECT figures.id, filepath FROM figures
-            LEFT OUTER JOIN ocr_processors__figures ON figures.id = ocr_processors__figures.figure_id
-            WHERE ((ocr_processors__figures.ocr_processor_id IS NULL OR ocr_processors__figures.ocr_processor_id <> %s)
-                AND figures.id NOT IN (SELECT figure_id FROM ocr_processors__figures WHERE ocr_processor_id = %s));
-            ''', (ocr_processor_id, ocr_processor_id))
-        figure_rows = figures_cur.fetchall()
+        # The same image can be in several papers or get loaded under
+        # several filenames. If this processor already has a result for a
+        # figure with the same hash, reuse it instead of calling the engine.
+        def reuse_results(figure_ids=None):
+            ocr_processors__figures_cur.execute('''
+                INSERT INTO ocr_processors__figures (ocr_processor_id, figure_id, result)
+                SELECT DISTINCT ON (pending.id) %(ocr_processor_id)s, pending.id, done.result
+                FROM figures AS pending
+                INNER JOIN figures AS done_figures ON done_figures.hash = pending.hash
+                INNER JOIN ocr_processors__figures AS done ON done.figure_id = done_figures.id AND done.ocr_processor_id = %(ocr_processor_id)s
+                WHERE pending.hash IS NOT NULL
+                    AND (%(figure_ids)s::integer[] IS NULL OR pending.id = ANY(%(figure_ids)s::integer[]))
+                    AND NOT EXISTS (
+                        SELECT 1 FROM ocr_processors__figures
+                        WHERE ocr_processor_id = %(ocr_processor_id)s AND figure_id = pending.id)
+                ORDER BY pending.id, done_figures.id
+                ON CONFLICT DO NOTHING
+                RETURNING figure_id;
+                ''', {"ocr_processor_id": ocr_processor_id, "figure_ids": figure_ids})
+            reused_figure_ids = set(row[0] for row in ocr_processors__figures_cur)
+            if reused_figure_ids:
+                ocr_processors__figures_cur.execute('''
+                    DELETE FROM ocr_failures
+                    WHERE ocr_processor_id = %s AND figure_id = ANY(%s);
+                    ''', (ocr_processor_id, list(reused_figure_ids)))
+                failed_figure_ids.difference_update(reused_figure_ids)
+                counts["reused"] += len(reused_figure_ids)
+            return reused_figure_ids
+
+        # Only OCR one figure per hash. Its result is saved for the others too.
+        duplicate_rows_by_figure_id = dict()
+
+        def group_by_hash(figure_rows):
+            figure_rows_by_hash = dict()
+            unique_figure_rows = list()
+            for figure_row in figure_rows:
+                figure_hash = figure_row["hash"]
+                if figure_hash is not None and figure_hash in figure_rows_by_hash:
+                    duplicate_rows_by_figure_id[figure_rows_by_hash[figure_hash]["id"]].append(figure_row)
+                    continue
+                if figure_hash is not None:
+                    figure_rows_by_hash[figure_hash] = figure_row
+                duplicate_rows_by_figure_id[figure_row["id"]] = []
+                unique_figure_rows.append(figure_row)
+            return unique_figure_rows
+
+        # when this run started, by the database's clock. A failure since then
+        # is from this run (of any worker), so it isn't retried until the next.
+        figures_cur.execute("SELECT now();")
+        started_at = figures_cur.fetchone()[0]
+
+        # Figures that haven't been handled by this processor already
+        # (NOT EXISTS uses the primary keys of ocr_processors__figures and
+        # ocr_failures). Failed ones are retried once per run, unless
+        # retry_failed is false. With queue, also skip figures another
+        # worker has a live lease on, and lock the rows being claimed,
+        # skipping any that another worker is claiming right now.
+        remaining_figures_sql = '''
+            SELECT figures.id, filepath, hash FROM figures
+            WHERE NOT EXISTS (
+                    SELECT 1 FROM ocr_processors__figures
+                    WHERE ocr_processor_id = %(ocr_processor_id)s AND figure_id = figures.id)
+                AND NOT EXISTS (
+                    SELECT 1 FROM ocr_failures
+                    WHERE ocr_processor_id = %(ocr_processor_id)s AND figure_id = figures.id
+                        AND NOT (%(retry_failed)s AND failed_at < %(started_at)s))
+            '''
+        lease_sql = '''
+            WITH claimable AS (
+                ''' + remaining_figures_sql + '''
+                    AND NOT EXISTS (
+                        SELECT 1 FROM ocr_leases
+                        WHERE ocr_processor_id = %(ocr_processor_id)s AND figure_id = figures.id
+                            AND leased_until > now())
+                ORDER BY figures.id
+                LIMIT %(limit)s
+                FOR UPDATE OF figures SKIP LOCKED
+            ),
+            leased AS (
+                INSERT INTO ocr_leases (ocr_processor_id, figure_id, worker, leased_until)
+                SELECT %(ocr_processor_id)s, id, %(worker)s, now() + %(lease_seconds)s * interval '1 second'
+                FROM claimable
+                ON CONFLICT (ocr_processor_id, figure_id)
+                DO UPDATE SET worker = EXCLUDED.worker, leased_until = EXCLUDED.leased_until
+                -- a lease taken since this statement started isn't ours
+                WHERE ocr_leases.leased_until <= now()
+                RETURNING figure_id
+            )
+            SELECT claimable.* FROM claimable
+            INNER JOIN leased ON claimable.id = leased.figure_id
+            ORDER BY claimable.id;
+            '''
+        worker = '{hostname}:{pid}'.format(hostname=socket.gethostname(), pid=os.getpid())
+
+        def lease_figure_rows():
+            # Claims up to lease_size figures at a time until there are none
+            # left (or limit is reached). A claim is committed right away, so
+            # other workers see it. If this worker dies, its leases expire
+            # after lease_seconds and other workers pick the figures up.
+            leased_count = 0
+            while limit is None or leased_count < limit:
+                lease_limit = lease_size if limit is None else min(lease_size, limit - leased_count)
+                figures_cur.execute(lease_sql, {
+                    "ocr_processor_id": ocr_processor_id, "retry_failed": not skip_failed, "started_at": started_at,
+                    "limit": lease_limit, "worker": worker, "lease_seconds": lease_seconds})
+                figure_rows = figures_cur.fetchall()
+                reused_figure_ids = reuse_results([figure_row["id"] for figure_row in figure_rows])
+                checkpointer.commit()
+                if not figure_rows:
+                    return
+                print('leased {count} figures'.format(count=len(figure_rows)))
+                leased_count += len(figure_rows)
+                yield from group_by_hash(figure_row for figure_row in figure_rows if figure_row["id"] not in reused_figure_ids)
+
+        # A worker keeps the leases of the figures it saved until it's done.
+        # (A failed figure's lease is dropped right away by save_failure, and
+        # the lease query skips it for the rest of the run.)
+        def release_leases():
+            figures_cur.execute("DELETE FROM ocr_leases WHERE ocr_processor_id = %s AND worker = %s;", (ocr_processor_id, worker))
+            conn.commit()
+
+        # figures that failed on an earlier run. If one succeeds this time, its
+        # failure is cleared.
+        ocr_processors__figures_cur.execute("SELECT figure_id FROM ocr_failures WHERE ocr_processor_id = %s;", (ocr_processor_id, ))
+        failed_figure_ids = set(row[0] for row in ocr_processors__figures_cur)
 
         print('limit: {}'.format(limit))
 
-        print('number of figures yet to be processed by ocr_processor {ocr_processor_id}: {remaining_figure_count}'.format(ocr_processor_id=ocr_processor_id, remaining_figure_count=len(figure_rows)))
+        checkpointer = Checkpointer(conn, every=checkpoint_every, seconds=checkpoint_seconds)
+        # reused: figures given an earlier result for the same image
+        # deduplicated: figures saved with the result of another figure in this run
+        counts = {"saved": 0, "failed": 0, "reused": 0, "deduplicated": 0}
+        stop_requested = []
+        previous_handlers = {}
+
+        if queue:
+            print('running as OCR queue worker {worker}, leasing {lease_size} figures at a time'.format(worker=worker, lease_size=lease_size))
+            figure_rows = lease_figure_rows()
+        else:
+            reuse_results()
+            conn.commit()
+            print('reused existing results for {reused_count} figures with an already OCR\'d hash'.format(reused_count=counts["reused"]))
+
+            figures_cur.execute(remaining_figures_sql + '''
+                ORDER BY figures.id
+                LIMIT %(limit)s;
+                ''', {"ocr_processor_id": ocr_processor_id, "retry_failed": not skip_failed, "started_at": started_at, "limit": limit})
+            figure_rows = figures_cur.fetchall()
+            unique_figure_rows = group_by_hash(figure_rows)
 
-        for figure_row in figure_rows[0:limit]:
+            print('number of figures to be processed by ocr_processor {ocr_processor_id}: {remaining_figure_count} (plus {duplicate_count} with the same hash as one of those)'.format(ocr_processor_id=ocr_processor_id, remaining_figure_count=len(unique_figure_rows), duplicate_count=len(figure_rows) - len(unique_figure_rows)))
+            figure_rows = unique_figure_rows
+
+        def ocr_figure(figure_row):
             print('Processing ' + figure_row["filepath"])
-            figure_id = figure_row["id"]
             raw_filepath = figure_row["filepath"]
             prepared_filepath = prepare_image(raw_filepath)
             ocr_result = perform_ocr(prepared_filepath)
@@ -87,11 +278,144 @@ def ocr_pmc(
                     ocr_pmc.py expects the result from the ocr engine to not be empty,
                     but the result above indicates that assumption was incorrect.
                     """)
-            ocr_processors__figures_cur.execute("INSERT INTO ocr_processors__figures (ocr_processor_id, figure_id, result) VALUES (%s, %s, %s);", (ocr_processor_id, figure_id, json.dumps(ocr_result)))
-            # TODO: should we commit here to avoid losing OCR work we've done in case there's an error or something?
+            return ocr_result
+
+        def save_result(figure_row, ocr_result):
+            result = json.dumps(ocr_result)
+            for same_figure_row in [figure_row] + duplicate_rows_by_figure_id[figure_row["id"]]:
+                figure_id = same_figure_row["id"]
+                # DO NOTHING: with queue, another worker may have reused a result for it
+                ocr_processors__figures_cur.execute("INSERT INTO ocr_processors__figures (ocr_processor_id, figure_id, result) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;", (ocr_processor_id, figure_id, result))
+                if figure_id in failed_figure_ids:
+                    ocr_processors__figures_cur.execute("DELETE FROM ocr_failures WHERE ocr_processor_id = %s AND figure_id = %s;", (ocr_processor_id, figure_id))
+                    failed_figure_ids.discard(figure_id)
+                counts["saved"] += 1
+            counts["deduplicated"] += len(duplicate_rows_by_figure_id[figure_row["id"]])
+            checkpointer.handled()
+
+        def save_failure(figure_row, error):
+            # record the failure and keep going, instead of aborting the run
+            print('OCR failed for {filepath}: {error}'.format(filepath=figure_row["filepath"], error=error))
+            for same_figure_row in [figure_row] + duplicate_rows_by_figure_id[figure_row["id"]]:
+                ocr_processors__figures_cur.execute('''
+                    INSERT INTO ocr_failures (ocr_processor_id, figure_id, error) VALUES (%s, %s, %s)
+                    ON CONFLICT (ocr_processor_id, figure_id)
+                    DO UPDATE SET error = EXCLUDED.error, attempts = ocr_failures.attempts + 1, failed_at = now();
+                    ''', (ocr_processor_id, same_figure_row["id"], str(error)))
+                if queue:
+                    ocr_processors__figures_cur.execute(
+                        "DELETE FROM ocr_leases WHERE ocr_processor_id = %s AND figure_id = %s AND worker = %s;",
+                        (ocr_processor_id, same_figure_row["id"], worker))
+                failed_figure_ids.add(same_figure_row["id"])
+                counts["failed"] += 1
+            checkpointer.handled()
+
+        def ocr_figures(figure_rows_batch):
+            prepared_filepaths = []
+            for figure_row in figure_rows_batch:
+                print('Processing ' + figure_row["filepath"])
+                prepared_filepaths.append(prepare_image(figure_row["filepath"]))
+            ocr_results = perform_ocr_batch(prepared_filepaths, max_retries=max_retries, bucket=batch_bucket)
+            if len(ocr_results) != len(figure_rows_batch):
+                raise ValueError("""
+                    ocr_pmc.py expects one result per image from the ocr engine,
+                    but got {result_count} results for {figure_count} images.
+                    """.format(result_count=len(ocr_results), figure_count=len(figure_rows_batch)))
+            return ocr_results
+
+        def save_results(figure_rows_batch, ocr_results):
+            # a failed image doesn't fail the rest of its batch
+            for figure_row, ocr_result in zip(figure_rows_batch, ocr_results):
+                if ocr_result is None or "error" in ocr_result:
+                    save_failure(figure_row, json.dumps(ocr_result))
+                    continue
+                save_result(figure_row, ocr_result)
+
+        def save_batch_failure(figure_rows_batch, error):
+            for figure_row in figure_rows_batch:
+                save_failure(figure_row, error)
+
+        engine_module = getattr(ocr_engines, engine)
+        if batch_size and batch_size > 1:
+            # e.g., ocr_engines.gcv.gcv_batch. The ocr_processor hash still comes
+            # from the single-image function, because batching doesn't change
+            # the results.
+            perform_ocr_batch = getattr(engine_module, engine + "_batch", None)
+            if not perform_ocr_batch:
+                raise Exception('OCR engine "%s" has no batch mode.' % engine)
+            # The engine retries and rate limits each of its requests itself,
+            # since one batch can take several.
+            batch_bucket = ThreadTokenBucket(rate) if rate else None
+            run_rate = None
+            run_max_retries = 0
+            items = chunked(figure_rows, batch_size)
+            perform = ocr_figures
+            on_result = save_results
+            on_error = save_batch_failure
+        else:
+            run_rate = rate
+            run_max_retries = max_retries
+            items = figure_rows
+            perform = ocr_figure
+            on_result = save_result
+            on_error = save_failure
+
+        # On SIGINT/SIGTERM, stop taking new figures, let the ones in flight
+        # finish and commit everything completed. A second signal quits
+        # right away (still committing completed results, for SIGINT).
+        def request_stop(signum, frame):
+            print('Received signal {signum}. Finishing figures in progress, then stopping. Send again to stop now.'.format(signum=signum))
+            stop_requested.append(signum)
+            signal.signal(signum, previous_handlers[signum])
+
+        def until_stopped(items):
+            for item in items:
+                if stop_requested:
+                    return
+                yield item
+
+        try:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                previous_handlers[signum] = signal.signal(signum, request_stop)
 
-        conn.commit()
-        print('ocr_pmc successfully completed')
+            if concurrency and concurrency > 1:
+                if hasattr(engine_module, "set_pool_size"):
+                    engine_module.set_pool_size(concurrency)
+                run_concurrently(
+                    until_stopped(items), perform, on_result,
+                    concurrency=concurrency, rate=run_rate, max_retries=run_max_retries,
+                    is_transient=getattr(engine_module, "is_transient_error", is_transient_default),
+                    on_error=on_error)
+            else:
+                for item in until_stopped(items):
+                    try:
+                        ocr_result = perform(item)
+                    except(Exception) as e:
+                        on_error(item, e)
+                        continue
+                    on_result(item, ocr_result)
+
+        except(KeyboardInterrupt):
+            checkpointer.commit()
+            if queue:
+                release_leases()
+            print('ocr_pmc interrupted after {saved} results and {failed} failures. Run it again to resume.'.format(**counts))
+            raise
+
+        finally:
+            for signum, previous_handler in previous_handlers.items():
+                signal.signal(signum, previous_handler)
+
+        checkpointer.commit()
+        if queue:
+            # leases on figures this worker didn't get to, e.g., when stopped
+            release_leases()
+        if stop_requested:
+            print('ocr_pmc stopped after {saved} results and {failed} failures. Run it again to resume.'.format(**counts))
+        else:
+            print('ocr_pmc successfully completed: {saved} results, {failed} failures'.format(**counts))
+        print('engine calls saved by reusing results for identical images: {saved_calls}'.format(
+            saved_calls=counts["reused"] + counts["deduplicated"]))
 
     except(psycopg2.DatabaseError) as e:
         print('Error %s' % e)
@@ -3,26 +3,31 @@
 
 import argparse
 import json
+import multiprocessing
 from pathlib import Path, PurePath
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 import re
 import os
 import subprocess
 import sys
 import warnings
-from itertools import zip_longest
-import hashlib
-from wand.image import Image
 
+from aho_corasick import BOUNDARY_RULES
+import db
+from export import export
+from image_metadata import probe_figure
 from match import match
 from ocr_pmc import get_engines, ocr_pmc
 from summarize import summarize
+from transform_chain import FIGURE_SECONDS, MAX_OUTPUTS, WORD_SECONDS
+from transforms import swaps
 from get_pg_conn import get_pg_conn
 
 
 CURRENT_SCRIPT_PATH = os.path.dirname(sys.argv[0])
 CURRENT_DB_PATH = Path(PurePath(CURRENT_SCRIPT_PATH, "CURRENT_DB"))
-CURRENT_DB = open(CURRENT_DB_PATH, "r").read().splitlines()[0]
 
 pmcid_re = re.compile('^(PMC\d+)__(.+)')
 
@@ -82,6 +87,10 @@ def clear(args):
                 open(FAILS_FILE_PATH, 'w').close()
                 open(Path(PurePath(LOGS_DIR, "results.tsv")), 'w').close()
 
+                # figures__xrefs_materialized references figures and has
+                # rows from the matches, so it goes first
+                match_attempts_cur.execute("DELETE FROM figures__xrefs_materialized;")
+                match_attempts_cur.execute("DELETE FROM match_offsets;")
                 match_attempts_cur.execute("DELETE FROM match_attempts;")
                 transformed_words_cur.execute("DELETE FROM transformed_words;")
 
@@ -100,6 +109,10 @@ def clear(args):
             figures_cur = conn.cursor()
 
             try:
+                ocr_processors__figures_cur.execute(
+                    "DELETE FROM ocr_leases;")
+                ocr_processors__figures_cur.execute(
+                    "DELETE FROM ocr_failures;")
                 ocr_processors__figures_cur.execute(
                     "DELETE FROM ocr_processors__figures;")
                 figures_cur.execute("DELETE FROM figures;")
@@ -136,11 +149,25 @@ def ocr(args):
     if not preprocessor:
         preprocessor = "noop"
     limit = args.limit
-    ocr_pmc(engine, preprocessor, limit)
+    ocr_pmc(engine, preprocessor, limit,
+            concurrency=args.concurrency, rate=args.rate, max_retries=args.max_retries,
+            batch_size=args.batch_size, checkpoint_every=args.checkpoint_every,
+            checkpoint_seconds=args.checkpoint_seconds, skip_failed=args.skip_failed,
+            queue=args.queue, lease_size=args.lease_size, lease_seconds=args.lease_seconds)
+
+
+def insert_figures(figures_cur, figure_rows):
+    return db.execute_batches(
+        figures_cur,
+        "INSERT INTO figures (filepath, figure_number, paper_id, resolution, hash) VALUES %s ON CONFLICT (filepath) DO NOTHING;",
+        figure_rows,
+        page_size=len(figure_rows))
 
 
 def load_figures(args):
     figures_dir = args.dir
+    workers = args.workers or os.cpu_count()
+    batch_size = args.batch_size
 
     figure_paths = list()
     for x in os.listdir(PurePath(cwd, figures_dir)):
@@ -150,7 +177,6 @@ def load_figures(args):
     conn = get_pg_conn()
     papers_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     figures_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    organism_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     pmcs_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     pmcid_to_paper_id = dict()
@@ -169,8 +195,26 @@ def load_figures(args):
         for row in pmcs_cur_all:
             pmcids.add(row[0])
 
+        # A reload only needs to handle new files. Figures already loaded
+        # from another path (same paper, same hash) are skipped after hashing.
+        figures_cur.execute("SELECT filepath, paper_id, hash FROM figures;")
+        loaded_filepaths = set()
+        loaded_paper_hashes = set()
+        for row in figures_cur:
+            loaded_filepaths.add(row["filepath"])
+            loaded_paper_hashes.add((row["paper_id"], row["hash"]))
+
+        skipped_count = 0
+        # filepath => (figure_number, pmcid)
+        figures_to_load = dict()
+        # pmcid => (organism, filepath) for the first new figure of each paper
+        # not in papers yet. organism is only set for WikiPathways figures.
+        new_papers = dict()
         for figure_path in figure_paths:
             filepath = str(figure_path.resolve())
+            if filepath in loaded_filepaths:
+                skipped_count += 1
+                continue
             filename_stem = figure_path.stem
             paper_filename_components = pmcid_re.match(filename_stem)
             wp_filename_components = wp_re.match(filename_stem)
@@ -201,52 +245,92 @@ def load_figures(args):
                     failsfile.write('\n' + msg)
                 continue
 
-            paper_id = None
-            if pmcid in pmcid_to_paper_id:
-                paper_id = pmcid_to_paper_id[pmcid]
-            else:
-                if organism:
-                    papers_cur.execute(
-                        "INSERT INTO papers (pmcid, organism_id) VALUES (%s, (SELECT organism_id FROM organism_names WHERE name = %s AND name_class = 'scientific name')) RETURNING id;", (pmcid, organism))
-                else:
-                    # TODO: getting the organism in these next few steps could probably all be done in one SQL query
-                    organism_cur.execute("SELECT organism_id FROM organism2pubtator INNER JOIN pmcs ON organism2pubtator.pmid = pmcs.pmid WHERE pmcs.pmcid = %s LIMIT 1;", (pmcid, ))
-                    organism_id = None
-                    organism_ids = organism_cur.fetchone()
-                    if organism_ids:
-                        organism_id=organism_ids[0]
-                    else:
-                        organism_cur.execute("SELECT organism_id FROM organism2pubmed INNER JOIN pmcs ON organism2pubmed.pmid = pmcs.pmid WHERE pmcs.pmcid = %s LIMIT 1;", (pmcid, ))
-                        organism_ids = organism_cur.fetchone()
-                        if organism_ids:
-                            organism_id=organism_ids[0]
-                        else:
-                            organism_id = 1
-                            msg='Failed to identify organism for {filepath}. Setting organism_id to value of "1" (all).'.format(filepath=filepath)
-                            warnings.warn(msg)
-                            with open(FAILS_FILE_PATH, "a+") as failsfile:
-                                failsfile.write('\n' + msg)
-
-                    papers_cur.execute(
-                        "INSERT INTO papers (pmcid, organism_id) VALUES (%s, %s) RETURNING id;", (pmcid, organism_id))
-
-                paper_id = papers_cur.fetchone()[0]
-                pmcid_to_paper_id[pmcid] = paper_id
-
-            m = hashlib.sha256()
-            with open(filepath, "rb") as image_file:
-                m.update(image_file.read())
-            figure_hash = m.hexdigest()
-
-            with Image(filename=filepath) as img:
-                resolution = int(round(min(img.resolution)))
-                figures_cur.execute(
-                    "INSERT INTO figures (filepath, figure_number, paper_id, resolution, hash) VALUES (%s, %s, %s, %s, %s);",
-                    (filepath, figure_number, paper_id, resolution, figure_hash)
+            if pmcid not in pmcid_to_paper_id and pmcid not in new_papers:
+                new_papers[pmcid] = (organism, filepath)
+
+            figures_to_load[filepath] = (figure_number, pmcid)
+
+        # Create all the missing papers at once. WikiPathways figures get
+        # the organism from their filenames. For the others, it's the first
+        # organism from pubtator, else from pubmed, else "1" (all).
+        wp_papers = [(pmcid, organism) for pmcid, (organism, filepath) in new_papers.items() if organism]
+        if wp_papers:
+            papers_cur.execute('''
+                INSERT INTO papers (pmcid, organism_id)
+                SELECT new_papers.pmcid, (
+                    SELECT organism_id FROM organism_names
+                    WHERE name = new_papers.organism AND name_class = 'scientific name')
+                FROM unnest(%s::text[], %s::text[]) AS new_papers (pmcid, organism)
+                RETURNING id, pmcid;
+                ''', ([pmcid for pmcid, organism in wp_papers], [organism for pmcid, organism in wp_papers]))
+            for row in papers_cur.fetchall():
+                pmcid_to_paper_id[row["pmcid"]] = row["id"]
+
+        pmc_papers = [pmcid for pmcid, (organism, filepath) in new_papers.items() if not organism]
+        if pmc_papers:
+            papers_cur.execute('''
+                WITH resolved AS (
+                    SELECT new_papers.pmcid,
+                        (SELECT organism_id FROM organism2pubtator INNER JOIN pmcs ON organism2pubtator.pmid = pmcs.pmid
+                            WHERE pmcs.pmcid = new_papers.pmcid LIMIT 1) AS pubtator_organism_id,
+                        (SELECT organism_id FROM organism2pubmed INNER JOIN pmcs ON organism2pubmed.pmid = pmcs.pmid
+                            WHERE pmcs.pmcid = new_papers.pmcid LIMIT 1) AS pubmed_organism_id
+                    FROM unnest(%s::text[]) AS new_papers (pmcid)
+                ),
+                inserted AS (
+                    INSERT INTO papers (pmcid, organism_id)
+                    SELECT pmcid, COALESCE(pubtator_organism_id, pubmed_organism_id, 1) FROM resolved
+                    RETURNING id, pmcid
                 )
-
+                SELECT inserted.id, inserted.pmcid,
+                    resolved.pubtator_organism_id IS NULL AND resolved.pubmed_organism_id IS NULL AS unidentified
+                FROM inserted
+                INNER JOIN resolved ON inserted.pmcid = resolved.pmcid;
+                ''', (pmc_papers, ))
+            for row in papers_cur.fetchall():
+                pmcid_to_paper_id[row["pmcid"]] = row["id"]
+                if row["unidentified"]:
+                    msg='Failed to identify organism for {filepath}. Setting organism_id to value of "1" (all).'.format(filepath=new_papers[row["pmcid"]][1])
+                    warnings.warn(msg)
+                    with open(FAILS_FILE_PATH, "a+") as failsfile:
+                        failsfile.write('\n' + msg)
+
+        print('load_figures: {new_paper_count} new papers'.format(new_paper_count=len(new_papers)))
+
+        print('load_figures: {new_count} new files, {skipped_count} already loaded'.format(new_count=len(figures_to_load), skipped_count=skipped_count))
+
+        # Hash and probe the images in parallel, inserting batch_size figures
+        # at a time (imap keeps the insert order the same as the file order).
+        inserted_count = 0
+        figure_rows = list()
+        with multiprocessing.Pool(workers) as pool:
+            for filepath, figure_hash, resolution, error in pool.imap(probe_figure, list(figures_to_load), chunksize=16):
+                if error:
+                    msg = 'Failed to read image {error}'.format(error=error)
+                    warnings.warn(msg)
+                    with open(FAILS_FILE_PATH, "a+") as failsfile:
+                        failsfile.write('\n' + msg)
+                    continue
+
+                figure_number, pmcid = figures_to_load[filepath]
+                paper_id = pmcid_to_paper_id[pmcid]
+                if (paper_id, figure_hash) in loaded_paper_hashes:
+                    skipped_count += 1
+                    continue
+                loaded_paper_hashes.add((paper_id, figure_hash))
+
+                figure_rows.append((filepath, figure_number, paper_id, resolution, figure_hash))
+                if len(figure_rows) >= batch_size:
+                    inserted_count += insert_figures(figures_cur, figure_rows)
+                    conn.commit()
+                    figure_rows = list()
+                    print('load_figures: {inserted_count} figures inserted'.format(inserted_count=inserted_count))
+
+        if figure_rows:
+            inserted_count += insert_figures(figures_cur, figure_rows)
         conn.commit()
 
+        print('load_figures: {inserted_count} figures inserted, {skipped_count} skipped as already loaded'.format(inserted_count=inserted_count, skipped_count=skipped_count))
         print('load_figures: SUCCESS')
 
     except(psycopg2.DatabaseError) as e:
@@ -263,7 +347,15 @@ def load_figures(args):
 
 def db_copy(args):
     name = args.name
-    subprocess.run(["createdb", "-Opfocr", "-T%s" % CURRENT_DB, name])
+    # the template is the database in use, however it was chosen (see db.get_dsn)
+    dsn_params = psycopg2.extensions.parse_dsn(db.get_dsn())
+    if not dsn_params.get("dbname"):
+        raise Exception('db_copy: no dbname in the DSN "%s"' % db.get_dsn())
+    createdb_args = ["createdb", "-Opfocr", "-T%s" % dsn_params["dbname"]]
+    for option, key in [("-h", "host"), ("-p", "port"), ("-U", "user")]:
+        if dsn_params.get(key):
+            createdb_args.extend([option, dsn_params[key]])
+    subprocess.run(createdb_args + [name])
     with open(CURRENT_DB_PATH, 'w') as f:
         f.write(name)
 
@@ -272,12 +364,25 @@ def db_copy(args):
 parser = argparse.ArgumentParser(
     prog='pfocr',
     description='''Process figures to extract pathway data.''')
+parser.add_argument('--dsn',
+                    help='libpq connection string, e.g., "host=db1 dbname=pfocr20200224". default: $PFOCR_DSN, else dbname from CURRENT_DB')
+parser.add_argument('--db-stats',
+                    action='store_true',
+                    help='at the end, print the slowest database statements of the run')
+# --db-stats also works after the subcommand, e.g., pfocr.py match --db-stats.
+# SUPPRESS keeps a subcommand from resetting it when given before.
+db_stats_parser = argparse.ArgumentParser(add_help=False)
+db_stats_parser.add_argument('--db-stats',
+                             action='store_true',
+                             default=argparse.SUPPRESS,
+                             help='at the end, print the slowest database statements of the run')
 subparsers = parser.add_subparsers(title='subcommands',
                                    description='valid subcommands',
                                    help='additional help')
 
 # create the parser for the "clear" command
 parser_clear = subparsers.add_parser('clear',
+                                     parents=[db_stats_parser],
                                      help='Clear specified data from database.')
 parser_clear.add_argument('target',
                           help='What to clear',
@@ -286,6 +391,7 @@ parser_clear.set_defaults(func=clear)
 
 # create the parser for the "db_copy" command
 parser_db_copy = subparsers.add_parser('db_copy',
+                                       parents=[db_stats_parser],
                                      help='Create copy of current database and set as current.')
 parser_db_copy.add_argument('name',
                           type=str,
@@ -295,6 +401,7 @@ parser_db_copy.set_defaults(func=db_copy)
 
 # create the parser for the "ocr" command
 parser_ocr = subparsers.add_parser('ocr',
+                                   parents=[db_stats_parser],
                                    help='Run OCR on PMC figures and save results to database.')
 parser_ocr.add_argument('engine',
         help='OCR engine to use. Specify one: {}'.format(','.join(get_engines())))
@@ -303,17 +410,61 @@ parser_ocr.add_argument('--preprocessor',
 parser_ocr.add_argument('--limit',
                         type=int,
                         help='limit number of figures to process')
+parser_ocr.add_argument('--concurrency',
+                        type=int,
+                        help='number of OCR requests to run at once. default: one at a time.')
+parser_ocr.add_argument('--rate',
+                        type=float,
+                        help='with --concurrency or --batch-size, max OCR requests per second')
+parser_ocr.add_argument('--max-retries',
+                        type=int,
+                        default=5,
+                        help='with --concurrency or --batch-size, how many times to retry a request after a transient error (e.g., HTTP 429). default: 5')
+parser_ocr.add_argument('--batch-size',
+                        type=int,
+                        help='send up to this many images per OCR request, if the engine supports it (gcv: up to 16). default: one image per request.')
+parser_ocr.add_argument('--checkpoint-every',
+                        type=int,
+                        default=100,
+                        help='commit after this many figures. default: 100')
+parser_ocr.add_argument('--checkpoint-seconds',
+                        type=float,
+                        default=60.0,
+                        help='commit at least this often, in seconds. default: 60')
+parser_ocr.add_argument('--skip-failed',
+                        action='store_true',
+                        help='skip figures that failed on an earlier run (see table ocr_failures). default: retry them, once per run.')
+parser_ocr.add_argument('--queue',
+                        action='store_true',
+                        help='claim figures in small leases, so several machines can run ocr at once without duplicating work')
+parser_ocr.add_argument('--lease-size',
+                        type=int,
+                        default=10,
+                        help='with --queue, how many figures to claim at a time. default: 10')
+parser_ocr.add_argument('--lease-seconds',
+                        type=int,
+                        default=600,
+                        help='with --queue, how long until a claimed figure can be claimed by another worker (e.g., if this one dies). default: 600')
 parser_ocr.set_defaults(func=ocr)
 
 # create the parser for the "load_figures" command
 parser_load_figures = subparsers.add_parser('load_figures',
+                                            parents=[db_stats_parser],
                                             help='Load figures and optionally papers from specified dir')
 parser_load_figures.add_argument('dir',
                                  help='Directory containing figures and optionally papers')
+parser_load_figures.add_argument('--workers',
+                                 type=int,
+                                 help='number of processes for hashing and reading images. default: number of CPUs')
+parser_load_figures.add_argument('--batch-size',
+                                 type=int,
+                                 default=1000,
+                                 help='number of figures to insert (and commit) at a time. default: 1000')
 parser_load_figures.set_defaults(func=load_figures)
 
 # create the parser for the "match" command
 parser_match = subparsers.add_parser('match',
+                                     parents=[db_stats_parser],
                                      help='Extract data from OCR result and put into DB tables. (See also run.sh)')
 parser_match.add_argument('-n', '--normalize',
                           action='append',
@@ -321,42 +472,131 @@ parser_match.add_argument('-n', '--normalize',
 parser_match.add_argument('-m', '--mutate',
                           action='append',
                           help='transform only OCR result')
+parser_match.add_argument('--workers',
+                          type=int,
+                          help='number of worker processes. default: match serially.')
+parser_match.add_argument('--mode',
+                          default='transforms',
+                          choices=['transforms', 'aho_corasick'],
+                          help='transforms: transform each OCR word and look it up in the lexicon. aho_corasick: scan each OCR line for lexicon symbols. default: transforms')
+parser_match.add_argument('--boundary',
+                          default='alnum',
+                          choices=BOUNDARY_RULES,
+                          help='aho_corasick mode: what may surround a symbol. none: anything, alpha: no letters, alnum: no letters or digits, token: only whitespace. default: alnum')
+parser_match.add_argument('--incremental',
+                          action='store_true',
+                          help='skip figures this matcher already has match attempts for (instead of clearing matches first)')
+parser_match.add_argument('--since',
+                          type=int,
+                          metavar='FIGURE_ID',
+                          help='only match figures with id >= FIGURE_ID')
+parser_match.add_argument('--until',
+                          type=int,
+                          metavar='FIGURE_ID',
+                          help='only match figures with id <= FIGURE_ID')
+parser_match.add_argument('--itersize',
+                          type=int,
+                          default=2000,
+                          help='number of OCR results to fetch from the database at a time. default: 2000')
+parser_match.add_argument('--lexicon-dir',
+                          help='directory for compiled lexicon snapshots. reuses the snapshot for these normalizations and symbols if there is one.')
+parser_match.add_argument('--cache-size',
+                          type=int,
+                          default=100000,
+                          help='max number of words to keep in the transform cache. 0 disables it.')
+parser_match.add_argument('--cache-dir',
+                          help='directory to persist the transform cache in, so later runs start warm.')
+parser_match.add_argument('--swap-table',
+                          action='append',
+                          metavar='FILE',
+                          help='extra swaps for the swaps transform: a tab-separated file, one "FROM<TAB>TO" per line. repeatable.')
+parser_match.add_argument('--word-seconds',
+                          type=float,
+                          default=WORD_SECONDS,
+                          help='skip (and quarantine) an OCR word that takes longer to transform. 0: no limit. default: %s' % WORD_SECONDS)
+parser_match.add_argument('--figure-seconds',
+                          type=float,
+                          default=FIGURE_SECONDS,
+                          help='skip (and quarantine) the rest of a figure that takes longer to match. 0: no limit. default: %s' % FIGURE_SECONDS)
+parser_match.add_argument('--max-outputs',
+                          type=int,
+                          default=MAX_OUTPUTS,
+                          help='skip (and quarantine) an OCR word when one transform turns it into more words than this. 0: no limit. default: %s' % MAX_OUTPUTS)
+
+# create the parser for the "export" command
+parser_export = subparsers.add_parser('export',
+                                      parents=[db_stats_parser],
+                                      help='Write figure => gene results as partitioned Parquet and/or a GMT file.')
+parser_export.add_argument('dir',
+                           help='output directory')
+parser_export.add_argument('--format',
+                           default='parquet,gmt',
+                           help='parquet, gmt or both, comma-separated. default: parquet,gmt')
+parser_export.add_argument('--matcher-id',
+                           type=int,
+                           help='default: the latest matcher with match attempts')
+parser_export.add_argument('--ocr-processor-id',
+                           type=int,
+                           help='default: the latest ocr_processor with match attempts for the matcher')
+parser_export.add_argument('--partition-size',
+                           type=int,
+                           default=10000,
+                           help='number of figure ids per Parquet partition. default: 10000')
+parser_export.add_argument('--min-genes',
+                           type=int,
+                           default=1,
+                           help='only write GMT gene sets for figures with at least this many genes. default: 1')
+parser_export.set_defaults(func=export)
 
 # create the parser for the "summarize" command
-parser_summarize = subparsers.add_parser('summarize')
+parser_summarize = subparsers.add_parser('summarize',
+                                         parents=[db_stats_parser])
+parser_summarize.add_argument('--gzip',
+                              action='store_true',
+                              help='write outputs/results.tsv.gz instead of outputs/results.tsv')
 parser_summarize.set_defaults(func=summarize)
 
 parser_match.set_defaults(func=match)
 
-args = parser.parse_args()
-
-# from python docs
-def grouper(iterable, n, fillvalue=None):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
-
-
-raw = sys.argv
-normalization_flags = ["-n", "--normalize"]
-mutation_flags = ["-m", "--mutate"]
-if len(raw) <= 1:
-    parser.print_help()
-elif raw[1] == "match":
-    transforms = []
-    for arg_pair in grouper(raw[2:], 2, 'x'):
-        category_raw = arg_pair[0]
-        category_parsed = ""
-        if category_raw in normalization_flags:
-            category_parsed = "normalize"
-        elif category_raw in mutation_flags:
-            category_parsed = "mutate"
-
-        if category_parsed:
-            transforms.append(
-                {"name": arg_pair[1], "category": category_parsed})
-
-    args.func(transforms)
-else:
-    args.func(args)
+if __name__ == "__main__":
+    args = parser.parse_args()
+    db.configure(dsn=args.dsn)
+
+    raw = sys.argv
+    normalization_flags = ["-n", "--normalize"]
+    mutation_flags = ["-m", "--mutate"]
+    if not hasattr(args, "func"):
+        parser.print_help()
+    elif args.func is match:
+        # argparse can't tell us the relative order of -n and -m, so we read
+        # the transforms straight from argv. Other options come from args.
+        transforms = []
+        for i, category_raw in enumerate(raw[1:-1], start=1):
+            category_parsed = ""
+            if category_raw in normalization_flags:
+                category_parsed = "normalize"
+            elif category_raw in mutation_flags:
+                category_parsed = "mutate"
+
+            if category_parsed:
+                transforms.append(
+                    {"name": raw[i + 1], "category": category_parsed})
+
+        if args.swap_table:
+            swaps.load_swap_tables(args.swap_table)
+
+        try:
+            args.func(transforms, workers=args.workers, cache_size=args.cache_size, cache_dir=args.cache_dir,
+                        mode=args.mode, boundary=args.boundary, lexicon_dir=args.lexicon_dir,
+                        incremental=args.incremental, since=args.since, until=args.until, itersize=args.itersize,
+                        word_seconds=args.word_seconds or None, figure_seconds=args.figure_seconds or None,
+                        max_outputs=args.max_outputs or None)
+        finally:
+            if args.db_stats:
+                print(db.report())
+    else:
+        try:
+            args.func(args)
+        finally:
+            if args.db_stats:
+                print(db.report())
@@ -0,0 +1,169 @@
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path, PurePath
+
+import psycopg2
+
+import db
+import pfocr
+import summarize
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+create_table_re = re.compile(r"CREATE TABLE (\w+)\s*\((.*?)\n\);", re.S)
+references_re = re.compile(r"REFERENCES (\w+)")
+
+
+def get_references():
+    # table => tables it has (non-cascading) foreign keys to, from create_tables.sql
+    with open(Path(PurePath(REPO_DIR, "database", "create_tables.sql")), "r") as f:
+        sql = f.read()
+    return {table: set(references_re.findall(body)) for table, body in create_table_re.findall(sql)}
+
+
+class TablesCursor:
+    # executes just enough SQL to track which tables have rows, and fails a
+    # DELETE like Postgres would if rows in another table still refer to it
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def execute(self, statement, params=None):
+        self.conn.statements.append(statement)
+        m = re.match(r"\s*INSERT INTO (\w+)", statement)
+        if m:
+            self.conn.populated.add(m.group(1))
+            self.rowcount = 1
+            return
+        m = re.match(r"\s*DELETE FROM (\w+)\s*(WHERE)?", statement)
+        if m:
+            table = m.group(1)
+            if m.group(2):
+                return
+            for other in self.conn.populated:
+                if table in self.conn.references.get(other, set()):
+                    raise psycopg2.IntegrityError(
+                        'update or delete on table "%s" violates foreign key constraint on table "%s"' % (table, other))
+            self.conn.populated.discard(table)
+
+    def close(self):
+        pass
+
+
+class TablesConnection:
+
+    def __init__(self, populated):
+        self.references = get_references()
+        self.populated = set(populated)
+        self.statements = []
+        self.committed = False
+        self.rolled_back = False
+
+    def cursor(self):
+        return TablesCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        pass
+
+
+class TestClear(unittest.TestCase):
+
+    def setUp(self):
+        self.logs_dir = tempfile.mkdtemp()
+        self.saved = (pfocr.LOGS_DIR, pfocr.FAILS_FILE_PATH, pfocr.get_pg_conn)
+        pfocr.LOGS_DIR = self.logs_dir
+        pfocr.FAILS_FILE_PATH = Path(PurePath(self.logs_dir, "fails.txt"))
+
+        # a matched and refreshed run
+        self.conn = TablesConnection([
+            "papers", "figures", "ocr_processors", "ocr_processors__figures", "matchers",
+            "symbols", "xrefs", "lexicon", "transformed_words", "match_attempts", "match_offsets"])
+        summarize.refresh_figures__xrefs(self.conn.cursor(), 1, 1)
+        self.assertIn("figures__xrefs_materialized", self.conn.populated)
+        pfocr.get_pg_conn = lambda: self.conn
+
+    def tearDown(self):
+        pfocr.LOGS_DIR, pfocr.FAILS_FILE_PATH, pfocr.get_pg_conn = self.saved
+        shutil.rmtree(self.logs_dir)
+
+    def test_clear_matches_after_refresh(self):
+        pfocr.clear(argparse.Namespace(target="matches"))
+        self.assertTrue(self.conn.committed)
+        self.assertFalse(self.conn.rolled_back)
+        self.assertNotIn("figures__xrefs_materialized", self.conn.populated)
+        self.assertNotIn("match_attempts", self.conn.populated)
+        self.assertIn("figures", self.conn.populated)
+
+    def test_clear_figures_after_refresh(self):
+        pfocr.clear(argparse.Namespace(target="figures"))
+        self.assertTrue(self.conn.committed)
+        self.assertFalse(self.conn.rolled_back)
+        for table in ["figures__xrefs_materialized", "match_attempts", "ocr_processors__figures", "figures"]:
+            self.assertNotIn(table, self.conn.populated)
+
+    def test_references_include_materialized_xrefs(self):
+        self.assertEqual(get_references()["figures__xrefs_materialized"],
+                         {"figures", "matchers", "ocr_processors"})
+
+
+class TestDbStatsFlag(unittest.TestCase):
+
+    def test_before_or_after_the_subcommand(self):
+        for argv in [["--db-stats", "clear", "matches"], ["clear", "--db-stats", "matches"],
+                     ["match", "-n", "upper", "--db-stats"], ["--db-stats", "summarize"], ["summarize", "--db-stats"]]:
+            self.assertTrue(pfocr.parser.parse_args(argv).db_stats, argv)
+
+    def test_default(self):
+        self.assertFalse(pfocr.parser.parse_args(["clear", "matches"]).db_stats)
+        self.assertFalse(pfocr.parser.parse_args(["export", "out"]).db_stats)
+
+
+class TestDsnOnly(unittest.TestCase):
+
+    def test_import_without_current_db(self):
+        # e.g., a setup that only uses PFOCR_DSN or --dsn
+        work_dir = tempfile.mkdtemp()
+        try:
+            completed = subprocess.run(
+                [sys.executable, "-c", "import sys; sys.path.insert(0, %r); import pfocr" % REPO_DIR],
+                cwd=work_dir, env=dict(os.environ, PFOCR_DSN="dbname=pfocr_test"),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        finally:
+            shutil.rmtree(work_dir)
+        self.assertEqual(completed.returncode, 0, completed.stdout.decode())
+
+    def test_db_copy_uses_the_dsn(self):
+        calls = []
+        run = pfocr.subprocess.run
+        current_db_path = pfocr.CURRENT_DB_PATH
+        work_dir = tempfile.mkdtemp()
+        pfocr.subprocess.run = calls.append
+        pfocr.CURRENT_DB_PATH = Path(PurePath(work_dir, "CURRENT_DB"))
+        db.configure(dsn="host=db1 dbname=pfocr20200224")
+        try:
+            pfocr.db_copy(argparse.Namespace(name="pfocr_copy"))
+            with open(pfocr.CURRENT_DB_PATH, "r") as f:
+                self.assertEqual(f.read(), "pfocr_copy")
+        finally:
+            pfocr.subprocess.run = run
+            pfocr.CURRENT_DB_PATH = current_db_path
+            db.configure(dsn=None)
+            shutil.rmtree(work_dir)
+        self.assertEqual(calls, [["createdb", "-Opfocr", "-Tpfocr20200224", "-h", "db1", "pfocr_copy"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
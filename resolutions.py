@@ -1,31 +1,63 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from wand.image import Image
+# Fills in figures.resolution where it's missing. Only figures with a NULL
+# resolution are read, so rerunning it after an interruption (or after
+# loading more figures) only handles what's left.
+
+import multiprocessing
 import psycopg2
 import psycopg2.extras
+import sys
+import db
 from get_pg_conn import get_pg_conn
+from image_metadata import probe_resolution
+
+BATCH_SIZE = 1000
+
+
+def update_resolutions(cur, resolutions):
+    # one set-based UPDATE for the whole batch
+    db.execute_batches(cur, '''
+        UPDATE figures SET resolution = v.resolution
+        FROM (VALUES %s) AS v (id, resolution)
+        WHERE figures.id = v.id;
+        ''', resolutions, page_size=len(resolutions))
 
 
+conn = None
 try:
     conn = get_pg_conn()
-    figures_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    figures_cur.execute("SELECT * FROM figures;")
-    for figure_row in figures_cur.fetchall():
-        print('Processing ' + figure_row["filepath"])
-        figure_id = figure_row["id"]
-        filepath = figure_row["filepath"]
-        with Image(filename=filepath) as img:
-            resolution = int(round(min(img.resolution)))
-            print("resolution: %s figure_id: %s" % (resolution, figure_id))
-            figures_cur.execute("UPDATE figures SET resolution = (%s) WHERE id = (%s);", (resolution, figure_id))
-            #  UPDATE figures SET resolution = 0 WHERE id = 2;
+    figures_cur = conn.cursor()
+    figures_cur.execute("SELECT id, filepath FROM figures WHERE resolution IS NULL ORDER BY id;")
+    figure_rows = figures_cur.fetchall()
+    print('figures without a resolution: %s' % len(figure_rows))
+
+    updated_count = 0
+    resolutions = []
+    with multiprocessing.Pool() as pool:
+        for figure_id, resolution, error in pool.imap(probe_resolution, figure_rows, chunksize=16):
+            if error:
+                print('Error reading %s' % error)
+                continue
+            resolutions.append((figure_id, resolution))
+            if len(resolutions) >= BATCH_SIZE:
+                update_resolutions(figures_cur, resolutions)
+                conn.commit()
+                updated_count += len(resolutions)
+                resolutions = []
+                print('updated: %s' % updated_count)
+
+    if resolutions:
+        update_resolutions(figures_cur, resolutions)
+        updated_count += len(resolutions)
     conn.commit()
+    print('updated: %s' % updated_count)
 
 except(psycopg2.DatabaseError) as e:
     print('Error %s' % e)
     sys.exit(1)
-    
+
 finally:
     if conn:
         conn.close()
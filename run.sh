@@ -23,6 +23,9 @@ trap 'finish $LINENO' SIGINT SIGTERM ERR
 
 ./pfocr.py match -n stop -n nfkc -n deburr -m expand -m root -n swaps -n alphanumeric
 
+# To only match newly loaded figures, skip the clear step above and use:
+#./pfocr.py match --incremental -n stop -n nfkc -n deburr -m expand -m root -n swaps -n alphanumeric
+
 ./pfocr.py summarize
 
 # Generate curated optimization datasets
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import json
-import csv
+import gzip
 import os
 import psycopg2
 import psycopg2.extras
@@ -11,6 +11,161 @@ import sys
 
 from get_pg_conn import get_pg_conn
 
+
+# figures__xrefs for one run, plus whether each xref is in xrefs_wp_hs
+REFRESH_INSERT_SQL = '''
+        INSERT INTO figures__xrefs_materialized (matcher_id, ocr_processor_id, figure_id, pmcid, figure_filepath, word, transformed_word, symbol, hgnc_symbol, xref, in_wp_hs, source, transforms_applied)
+        WITH hgnc AS (
+            SELECT xref_id, symbol
+            FROM lexicon
+            INNER JOIN symbols ON lexicon.symbol_id = symbols.id
+            WHERE source = 'hgnc_symbol')
+        SELECT DISTINCT match_attempts.matcher_id,
+            match_attempts.ocr_processor_id,
+            figures.id,
+            pmcid,
+            figures.filepath,
+            match_attempts.word,
+            transformed_words.transformed_word,
+            symbols.symbol,
+            hgnc.symbol,
+            xrefs.xref,
+            EXISTS (SELECT 1 FROM xrefs_wp_hs WHERE xrefs_wp_hs.xref = xrefs.xref),
+            lexicon.source,
+            match_attempts.transforms_applied
+        FROM match_attempts
+        INNER JOIN figures ON match_attempts.figure_id = figures.id
+        INNER JOIN papers ON figures.paper_id = papers.id
+        INNER JOIN transformed_words ON match_attempts.transformed_word_id = transformed_words.id
+        INNER JOIN symbols ON match_attempts.symbol_id = symbols.id
+        INNER JOIN lexicon ON symbols.id = lexicon.symbol_id
+        INNER JOIN xrefs ON lexicon.xref_id = xrefs.id
+        INNER JOIN hgnc ON lexicon.xref_id = hgnc.xref_id
+        WHERE match_attempts.matcher_id = %s AND match_attempts.ocr_processor_id = %s{figure_filter};
+        '''
+# figure ids per refresh statement, when refreshing just some figures
+REFRESH_CHUNK_SIZE = 10000
+
+
+def refresh_figures__xrefs(cur, matcher_id, ocr_processor_id, figure_ids=None):
+    # Replaces the figures__xrefs_materialized rows for one run, or with
+    # figure_ids, only those figures' rows, with the rows the figures__xrefs
+    # view gives for them. Returns the number of rows inserted.
+    if figure_ids is None:
+        cur.execute(
+            "DELETE FROM figures__xrefs_materialized WHERE matcher_id = %s AND ocr_processor_id = %s;",
+            (matcher_id, ocr_processor_id))
+        cur.execute(REFRESH_INSERT_SQL.format(figure_filter=""), (matcher_id, ocr_processor_id))
+        return cur.rowcount
+
+    row_count = 0
+    figure_ids = sorted(set(figure_ids))
+    for i in range(0, len(figure_ids), REFRESH_CHUNK_SIZE):
+        chunk = figure_ids[i:i + REFRESH_CHUNK_SIZE]
+        cur.execute(
+            "DELETE FROM figures__xrefs_materialized WHERE matcher_id = %s AND ocr_processor_id = %s AND figure_id = ANY(%s);",
+            (matcher_id, ocr_processor_id, chunk))
+        cur.execute(
+            REFRESH_INSERT_SQL.format(figure_filter=" AND match_attempts.figure_id = ANY(%s)"),
+            (matcher_id, ocr_processor_id, chunk))
+        row_count += cur.rowcount
+    return row_count
+
+
+def refresh_matched_figures__xrefs(cur, matcher_id, figure_ids_by_ocr_processor_id):
+    # Refreshes what a match run touched: for each ocr_processor_id, its
+    # figure ids, or None for all of that ocr_processor's figures (a full
+    # run). Returns the number of rows inserted per ocr_processor_id.
+    row_counts = {}
+    for ocr_processor_id, figure_ids in sorted(figure_ids_by_ocr_processor_id.items()):
+        row_counts[ocr_processor_id] = refresh_figures__xrefs(cur, matcher_id, ocr_processor_id, figure_ids)
+    return row_counts
+
+
+def get_stats(cur, matcher_id, ocr_processor_id):
+    # Same numbers as the stats view, but for one run: one pass over its
+    # match attempts and one over its figures__xrefs_materialized rows.
+    cur.execute('''
+        WITH attempts AS (
+            SELECT COUNT(DISTINCT papers.pmcid) FILTER (WHERE hits.is_hit) AS nonwordless_paper_count,
+                COUNT(DISTINCT figures.filepath) FILTER (WHERE hits.is_hit) AS nonwordless_figure_count,
+                COUNT(DISTINCT CONCAT(match_attempts.word, '\t', match_attempts.figure_id)) AS word_count_gross,
+                COUNT(DISTINCT match_attempts.word) FILTER (WHERE hits.is_hit) AS word_count_unique
+            FROM match_attempts
+            INNER JOIN figures ON match_attempts.figure_id = figures.id
+            INNER JOIN papers ON figures.paper_id = papers.id
+            CROSS JOIN LATERAL (
+                SELECT match_attempts.transformed_word_id IS NOT NULL AND EXISTS (
+                    SELECT 1 FROM lexicon WHERE lexicon.symbol_id = match_attempts.symbol_id) AS is_hit
+            ) AS hits
+            WHERE match_attempts.matcher_id = %(matcher_id)s AND match_attempts.ocr_processor_id = %(ocr_processor_id)s
+        ),
+        xref_hits AS (
+            SELECT COUNT(DISTINCT CONCAT(transformed_word, '\t', figure_filepath)) AS hit_count_gross,
+                COUNT(DISTINCT transformed_word) AS hit_count_unique,
+                COUNT(DISTINCT CONCAT(xref, '\t', figure_filepath)) AS xref_count_gross,
+                COUNT(DISTINCT xref) AS xref_count_unique,
+                COUNT(DISTINCT xref) FILTER (WHERE NOT in_wp_hs) AS xref_not_in_wp_hs_count
+            FROM figures__xrefs_materialized
+            WHERE matcher_id = %(matcher_id)s AND ocr_processor_id = %(ocr_processor_id)s
+        )
+        SELECT (SELECT COUNT(id) FROM papers) AS paper_count,
+            (SELECT COUNT(id) FROM figures) AS figure_count,
+            attempts.*,
+            xref_hits.*
+        FROM attempts, xref_hits;
+        ''', {"matcher_id": matcher_id, "ocr_processor_id": ocr_processor_id})
+    return cur.fetchone()
+
+
+class CrlfRows:
+    # File for copy_expert, which writes each row (and the header) with one
+    # write(): ends them with \r\n, like csv's excel-tab dialect did. A \n
+    # inside a (quoted) value is left alone, like csv did too.
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        if data.endswith(b'\n'):
+            data = data[:-1] + b'\r\n'
+        return self.f.write(data)
+
+
+def export_results(cur, matcher_id, ocr_processor_id, results_path):
+    # Streams the run's results from Postgres straight into the TSV (or
+    # gzipped TSV, if results_path ends in .gz) with COPY ... TO STDOUT, so
+    # memory use stays the same no matter how many rows there are.
+    # figure is the basename of figure_filepath.
+    #
+    # The output is what csv.DictWriter(dialect='excel-tab') wrote: COPY's
+    # CSV format quotes the same values (ones with a tab, a " or a line
+    # break, with " doubled), and NULLIF makes empty strings NULLs, which
+    # COPY writes unquoted, like csv wrote both. (The ORDER BY names the
+    # table's columns, not the NULLIF ones, so the order is the same too.)
+    results_query = cur.mogrify('''
+        SELECT NULLIF(pmcid, '') AS pmcid,
+            NULLIF(regexp_replace(figure_filepath, '^.*/', ''), '') AS figure,
+            NULLIF(word, '') AS word,
+            NULLIF(symbol, '') AS symbol,
+            NULLIF(source, '') AS source,
+            NULLIF(hgnc_symbol, '') AS hgnc_symbol,
+            NULLIF(xref, '') AS entrez,
+            NULLIF(transforms_applied, '') AS transforms_applied
+        FROM figures__xrefs_materialized
+        WHERE matcher_id = %s AND ocr_processor_id = %s AND figure_filepath <> ''
+        ORDER BY figures__xrefs_materialized.pmcid, figure_filepath, figures__xrefs_materialized.word
+        ''', (matcher_id, ocr_processor_id)).decode()
+    copy_sql = "COPY (%s) TO STDOUT WITH (FORMAT csv, DELIMITER E'\\t', NULL '', QUOTE '\"', HEADER);" % results_query
+    if results_path.endswith('.gz'):
+        with gzip.open(results_path, 'wb') as resultsfile:
+            cur.copy_expert(copy_sql, CrlfRows(resultsfile))
+    else:
+        with open(results_path, 'wb') as resultsfile:
+            cur.copy_expert(copy_sql, CrlfRows(resultsfile))
+    return cur.rowcount
+
+
 def summarize(args):
     conn = get_pg_conn()
     summary_cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -19,42 +174,6 @@ def summarize(args):
 
 
     try:
-        results_query = '''
-        SELECT pmcid, figure_filepath, word, symbol, source, hgnc_symbol, xref as entrez, transforms_applied
-        FROM figures__xrefs
-        ORDER BY pmcid, figure_filepath, word;
-        '''
-        results_cur.execute(results_query)
-
-        results = []
-        for row in results_cur:
-            pmcid = row["pmcid"]
-            figure_filepath = row["figure_filepath"]
-            word = row["word"]
-            symbol = row["symbol"]
-            source = row["source"]
-            hgnc_symbol = row["hgnc_symbol"]
-            entrez = row["entrez"]
-            transforms_applied = row["transforms_applied"]
-
-            if figure_filepath != "":
-                results.append({
-                    "pmcid": pmcid,
-                    "figure": os.path.basename(figure_filepath),
-                    "word": word,
-                    "symbol": symbol,
-                    "source": source,
-                    "hgnc_symbol": hgnc_symbol,
-                    "entrez": entrez,
-                    "transforms_applied": transforms_applied
-                })
-
-        stats_query = '''
-        SELECT paper_count, nonwordless_paper_count, figure_count, nonwordless_figure_count, word_count_gross, word_count_unique, hit_count_gross, hit_count_unique, xref_count_gross, xref_count_unique, xref_not_in_wp_hs_count
-        FROM stats;
-        '''
-        stats_cur.execute(stats_query)
-            
         # TODO are there any cases when the max ocr_processor_id value from match_attempts wouldn't be the ocr_processor we want to summarize?
         summary_cur.execute("SELECT max(ocr_processor_id) FROM match_attempts;")
         #summary_cur.execute("SELECT id FROM ocr_processors;")
@@ -72,34 +191,41 @@ def summarize(args):
         if matcher_id != matcher_id_alt:
             raise Exception("Error! matcher_id mismatch in summarize.py: %s != %s" % (matcher_id, matcher_id_alt))
 
-        for row in stats_cur:
-            paper_count = row["paper_count"]
-            nonwordless_paper_count = row["nonwordless_paper_count"]
-            figure_count = row["figure_count"]
-            nonwordless_figure_count = row["nonwordless_figure_count"]
-            word_count_gross = row["word_count_gross"]
-            word_count_unique = row["word_count_unique"]
-            hit_count_gross = row["hit_count_gross"]
-            hit_count_unique = row["hit_count_unique"]
-            xref_count_gross = row["xref_count_gross"]
-            xref_count_unique = row["xref_count_unique"]
-            xref_not_in_wp_hs_count = row["xref_not_in_wp_hs_count"]
-
-            summary_cur.execute("DELETE FROM summaries WHERE matcher_id=%s;", (matcher_id, ))
-            summary_cur.execute('''
-                    INSERT INTO summaries (matcher_id, ocr_processor_id, paper_count, nonwordless_paper_count, figure_count, nonwordless_figure_count, word_count_gross, word_count_unique, hit_count_gross, hit_count_unique, xref_count_gross, xref_count_unique, xref_not_in_wp_hs_count)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);''',
-                    (matcher_id, ocr_processor_id, paper_count, nonwordless_paper_count, figure_count, nonwordless_figure_count, word_count_gross, word_count_unique, hit_count_gross, hit_count_unique, xref_count_gross, xref_count_unique, xref_not_in_wp_hs_count)
-                    )
+        # match refreshes figures__xrefs_materialized when it finishes. Runs
+        # from before that table existed get it filled in here.
+        summary_cur.execute(
+            "SELECT EXISTS (SELECT 1 FROM figures__xrefs_materialized WHERE matcher_id = %s AND ocr_processor_id = %s);",
+            (matcher_id, ocr_processor_id))
+        if not summary_cur.fetchone()[0]:
+            refresh_figures__xrefs(summary_cur, matcher_id, ocr_processor_id)
+
+        row = get_stats(stats_cur, matcher_id, ocr_processor_id)
+        paper_count = row["paper_count"]
+        nonwordless_paper_count = row["nonwordless_paper_count"]
+        figure_count = row["figure_count"]
+        nonwordless_figure_count = row["nonwordless_figure_count"]
+        word_count_gross = row["word_count_gross"]
+        word_count_unique = row["word_count_unique"]
+        hit_count_gross = row["hit_count_gross"]
+        hit_count_unique = row["hit_count_unique"]
+        xref_count_gross = row["xref_count_gross"]
+        xref_count_unique = row["xref_count_unique"]
+        xref_not_in_wp_hs_count = row["xref_not_in_wp_hs_count"]
+
+        summary_cur.execute("DELETE FROM summaries WHERE matcher_id=%s;", (matcher_id, ))
+        summary_cur.execute('''
+                INSERT INTO summaries (matcher_id, ocr_processor_id, paper_count, nonwordless_paper_count, figure_count, nonwordless_figure_count, word_count_gross, word_count_unique, hit_count_gross, hit_count_unique, xref_count_gross, xref_count_unique, xref_not_in_wp_hs_count)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);''',
+                (matcher_id, ocr_processor_id, paper_count, nonwordless_paper_count, figure_count, nonwordless_figure_count, word_count_gross, word_count_unique, hit_count_gross, hit_count_unique, xref_count_gross, xref_count_unique, xref_not_in_wp_hs_count)
+                )
 
         conn.commit()
 
-        with open('./outputs/results.tsv', 'w', newline='') as resultsfile:
-            fieldnames = ["pmcid", "figure", "word", "symbol", "source", "hgnc_symbol", "entrez", "transforms_applied"]
-            writer = csv.DictWriter(resultsfile, fieldnames=fieldnames, dialect='excel-tab')
-            writer.writeheader()
-            for result in results:
-                writer.writerow(result)
+        results_path = './outputs/results.tsv'
+        if getattr(args, "gzip", False):
+            results_path += '.gz'
+        row_count = export_results(results_cur, matcher_id, ocr_processor_id, results_path)
+        print('summarize: {row_count} results written to {results_path}'.format(row_count=row_count, results_path=results_path))
 
 #        header_entries = ["pmcid", "figure", "word", "symbol", "source", "hgnc_symbol", "entrez", "transforms_applied"]
 #        header_length = len(header_entries)
@@ -0,0 +1,156 @@
+import csv
+import gzip
+import io
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import match
+import summarize
+
+
+class RecordingCursor:
+
+    def __init__(self):
+        self.statements = []
+        self.rowcount = 0
+
+    def execute(self, statement, params=None):
+        self.statements.append((" ".join(statement.split()), params))
+        # one row per figure refreshed
+        self.rowcount = len(params[2]) if params and len(params) > 2 else 100
+
+
+class TestRefresh(unittest.TestCase):
+
+    def test_whole_run(self):
+        cur = RecordingCursor()
+        self.assertEqual(summarize.refresh_figures__xrefs(cur, 1, 2), 100)
+        (delete, delete_params), (insert, insert_params) = cur.statements
+        self.assertEqual(delete, "DELETE FROM figures__xrefs_materialized WHERE matcher_id = %s AND ocr_processor_id = %s;")
+        self.assertEqual(delete_params, (1, 2))
+        self.assertTrue(insert.startswith("INSERT INTO figures__xrefs_materialized"))
+        self.assertNotIn("ANY", insert)
+        self.assertEqual(insert_params, (1, 2))
+
+    def test_some_figures(self):
+        cur = RecordingCursor()
+        summarize.REFRESH_CHUNK_SIZE, chunk_size = 2, summarize.REFRESH_CHUNK_SIZE
+        try:
+            self.assertEqual(summarize.refresh_figures__xrefs(cur, 1, 2, [9, 3, 5, 3]), 3)
+        finally:
+            summarize.REFRESH_CHUNK_SIZE = chunk_size
+        self.assertEqual([params for statement, params in cur.statements],
+                         [(1, 2, [3, 5]), (1, 2, [3, 5]), (1, 2, [9]), (1, 2, [9])])
+        for statement, params in cur.statements:
+            if statement.startswith("DELETE"):
+                self.assertTrue(statement.endswith("AND figure_id = ANY(%s);"))
+            else:
+                self.assertTrue(statement.endswith("AND match_attempts.figure_id = ANY(%s);"))
+
+    def test_only_what_the_run_matched(self):
+        figure_ids_by_ocr_processor_id = {}
+        for ocr_processor_id, figure_id in [(2, 10), (2, 11), (4, 10)]:
+            match.add_matched_figure(figure_ids_by_ocr_processor_id, ocr_processor_id, figure_id, True)
+        self.assertEqual(figure_ids_by_ocr_processor_id, {2: [10, 11], 4: [10]})
+
+        cur = RecordingCursor()
+        self.assertEqual(summarize.refresh_matched_figures__xrefs(cur, 1, figure_ids_by_ocr_processor_id), {2: 2, 4: 1})
+        self.assertEqual([params for statement, params in cur.statements if statement.startswith("DELETE")],
+                         [(1, 2, [10, 11]), (1, 4, [10])])
+
+    def test_full_run_refreshes_whole_ocr_processors(self):
+        figure_ids_by_ocr_processor_id = {}
+        for ocr_processor_id, figure_id in [(2, 10), (2, 11)]:
+            match.add_matched_figure(figure_ids_by_ocr_processor_id, ocr_processor_id, figure_id, False)
+        self.assertEqual(figure_ids_by_ocr_processor_id, {2: None})
+
+        cur = RecordingCursor()
+        self.assertEqual(summarize.refresh_matched_figures__xrefs(cur, 1, figure_ids_by_ocr_processor_id), {2: 100})
+        self.assertEqual([params for statement, params in cur.statements], [(1, 2), (1, 2)])
+
+    def test_nothing_matched(self):
+        cur = RecordingCursor()
+        self.assertEqual(summarize.refresh_matched_figures__xrefs(cur, 1, {}), {})
+        self.assertEqual(cur.statements, [])
+
+
+FIELDNAMES = ["pmcid", "figure", "word", "symbol", "source", "hgnc_symbol", "entrez", "transforms_applied"]
+
+
+def pg_csv_value(value):
+    # how COPY ... (FORMAT csv, DELIMITER E'\t', NULL '') writes a value
+    if value is None:
+        return ""
+    if value == "" or any(c in value for c in '\t"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+class CopyCursor:
+    # copy_expert writes the rows like Postgres does, one write() per row
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.rowcount = -1
+
+    def mogrify(self, statement, params):
+        return (statement % params).encode()
+
+    def copy_expert(self, sql, f):
+        nullif_count = len(re.findall(r"NULLIF\(", sql))
+        self.sql = sql
+        f.write(("\t".join(FIELDNAMES) + "\n").encode())
+        for row in self.rows:
+            values = [row[name] for name in FIELDNAMES]
+            if nullif_count == len(FIELDNAMES):
+                values = [None if value == "" else value for value in values]
+            f.write(("\t".join(pg_csv_value(value) for value in values) + "\n").encode())
+        self.rowcount = len(self.rows)
+
+
+class TestExportResults(unittest.TestCase):
+
+    rows = [
+        {"pmcid": "PMC1", "figure": "PMC1__fig1.jpg", "word": "AKT", "symbol": "AKT1", "source": "alias_symbol",
+         "hgnc_symbol": "AKT1", "entrez": "207", "transforms_applied": "-n upper"},
+        {"pmcid": "PMC1", "figure": "PMC1__fig1.jpg", "word": "", "symbol": "TP53", "source": None,
+         "hgnc_symbol": "TP53", "entrez": "7157", "transforms_applied": None},
+        {"pmcid": "PMC2", "figure": "PMC2__fig1.jpg", "word": 'say "NF-\tkB"\nhere', "symbol": "NFKB1",
+         "source": "hgnc_symbol", "hgnc_symbol": "NFKB1", "entrez": "4790", "transforms_applied": "-n swaps"},
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def dict_writer_output(self):
+        # what summarize wrote before it used COPY
+        f = io.StringIO(newline="")
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES, dialect="excel-tab")
+        writer.writeheader()
+        for row in self.rows:
+            writer.writerow(row)
+        return f.getvalue().encode()
+
+    def test_same_as_dict_writer(self):
+        path = os.path.join(self.dir, "results.tsv")
+        cur = CopyCursor(self.rows)
+        self.assertEqual(summarize.export_results(cur, 1, 2, path), 3)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.dict_writer_output())
+        self.assertIn("matcher_id = 1 AND ocr_processor_id = 2", cur.sql)
+
+    def test_gzip(self):
+        path = os.path.join(self.dir, "results.tsv.gz")
+        summarize.export_results(CopyCursor(self.rows), 1, 2, path)
+        with gzip.open(path, "rb") as f:
+            self.assertEqual(f.read(), self.dict_writer_output())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import math
+import os
+from pathlib import Path, PurePath
+import pickle
+import time
+
+# TransformStats keeps a histogram of call times in log-spaced buckets, from
+# HISTOGRAM_MIN_SECONDS up, each HISTOGRAM_BASE times wider than the last.
+HISTOGRAM_MIN_SECONDS = 1e-6
+HISTOGRAM_BASE = 1.25
+HISTOGRAM_BUCKETS = 100
+
+# Budget defaults. WORD_SECONDS is the old attempt_match deadline.
+WORD_SECONDS = 5.0
+FIGURE_SECONDS = 120.0
+MAX_OUTPUTS = 1000
+
+
+def get_bucket(seconds):
+    if seconds <= HISTOGRAM_MIN_SECONDS:
+        return 0
+    return min(HISTOGRAM_BUCKETS - 1, 1 + int(math.log(seconds / HISTOGRAM_MIN_SECONDS, HISTOGRAM_BASE)))
+
+
+class TransformStats:
+    # Per stage of the transform chain: how many words went in (calls), how
+    # long the calls took (total and a p95 from the histogram), how many
+    # words came out, and how many symbol hits were found at that stage.
+    # Calls are only counted for words not already in the TransformCache,
+    # i.e., for the work actually done. Hits are counted for every word.
+    def __init__(self, transforms_to_apply):
+        self.stages = [
+            {"name": t["name"], "category": t["category"], "calls": 0, "seconds": 0.0,
+             "histogram": [0] * HISTOGRAM_BUCKETS, "outputs": 0, "hits": 0}
+            for t in transforms_to_apply]
+
+    def record_call(self, position, seconds, output_count):
+        stage = self.stages[position]
+        stage["calls"] += 1
+        stage["seconds"] += seconds
+        stage["outputs"] += output_count
+        stage["histogram"][get_bucket(seconds)] += 1
+
+    def record_batch(self, position, seconds, calls, output_count):
+        # one batch call, i.e., calls words in at once. Its calls go in the
+        # histogram at their average time.
+        if calls == 0:
+            return
+        stage = self.stages[position]
+        stage["calls"] += calls
+        stage["seconds"] += seconds
+        stage["outputs"] += output_count
+        stage["histogram"][get_bucket(seconds / calls)] += calls
+
+    def record_hits(self, hits):
+        for transform_count, symbol_id, transformed_word in hits:
+            self.stages[transform_count - 1]["hits"] += 1
+
+    def p95(self, position):
+        # upper edge of the bucket the 95th percentile falls in
+        stage = self.stages[position]
+        threshold = 0.95 * stage["calls"]
+        cumulative = 0
+        for bucket, count in enumerate(stage["histogram"]):
+            cumulative += count
+            if count and cumulative >= threshold:
+                return HISTOGRAM_MIN_SECONDS * HISTOGRAM_BASE ** bucket
+        return 0.0
+
+    def take(self):
+        # the counts so far, e.g., to send back from a worker, and a reset
+        stages = self.stages
+        self.stages = [
+            dict(stage, calls=0, seconds=0.0, histogram=[0] * HISTOGRAM_BUCKETS, outputs=0, hits=0)
+            for stage in stages]
+        return stages
+
+    def merge(self, stages):
+        for stage, other in zip(self.stages, stages):
+            for key in ["calls", "seconds", "outputs", "hits"]:
+                stage[key] += other[key]
+            stage["histogram"] = [a + b for a, b in zip(stage["histogram"], other["histogram"])]
+
+    def rows(self):
+        # (position, name, category, calls, seconds, p95 seconds, outputs, hits)
+        return [
+            (position, stage["name"], stage["category"], stage["calls"], stage["seconds"],
+             self.p95(position), stage["outputs"], stage["hits"])
+            for position, stage in enumerate(self.stages)]
+
+    def report(self):
+        lines = ['transform stats (calls are for uncached words):']
+        lines.append('{:>3} {:<20} {:>10} {:>10} {:>10} {:>8} {:>10}'.format(
+            "#", "transform", "calls", "total(s)", "p95(ms)", "fan-out", "hits"))
+        for position, name, category, calls, seconds, p95, outputs, hits in self.rows():
+            fan_out = outputs / calls if calls else 0.0
+            lines.append('{:>3} {:<20} {:>10} {:>10.3f} {:>10.3f} {:>8.2f} {:>10}'.format(
+                position + 1, "%s (%s)" % (name, category[0]), calls, seconds, p95 * 1000, fan_out, hits))
+        return '\n'.join(lines)
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, scope, reason):
+        super().__init__("%s budget exceeded: %s" % (scope, reason))
+        self.scope = scope
+        self.reason = reason
+
+
+class WordBudgetExceeded(BudgetExceeded):
+    def __init__(self, reason):
+        super().__init__("word", reason)
+
+
+class FigureBudgetExceeded(BudgetExceeded):
+    def __init__(self, reason):
+        super().__init__("figure", reason)
+
+
+class Budget:
+    # Time (and fan-out) limits for matching: word_seconds per OCR word,
+    # figure_seconds per figure and max_outputs words out of any one
+    # transform call. None means no limit.
+    #
+    # The limits are checked with time.monotonic between transform calls,
+    # instead of interrupting them with a signal, so they work in threads as
+    # well as processes, at the cost of a word overrunning by up to one call.
+    # Words and figures over budget are skipped and added to quarantined, as
+    # (figure_id, scope, reason, word). A word skipped once is skipped for
+    # the rest of the run without trying it again.
+    def __init__(self, word_seconds=WORD_SECONDS, figure_seconds=FIGURE_SECONDS, max_outputs=MAX_OUTPUTS):
+        self.word_seconds = word_seconds
+        self.figure_seconds = figure_seconds
+        self.max_outputs = max_outputs
+        self.quarantined = []
+        self.quarantined_words = set()
+        self.counts = {"word": 0, "figure": 0}
+
+    def start_figure(self):
+        return FigureBudget(self)
+
+    def quarantine(self, figure_id, word, e):
+        self.quarantined.append((figure_id, e.scope, e.reason, word))
+        self.count([self.quarantined[-1]])
+
+    def count(self, quarantined):
+        # also for the entries sent back from a worker (see take_quarantined)
+        for figure_id, scope, reason, word in quarantined:
+            self.counts[scope] += 1
+            if scope == "word":
+                self.quarantined_words.add(word)
+
+    def take_quarantined(self):
+        # the entries so far, e.g., to send back from a worker, and a reset
+        quarantined = self.quarantined
+        self.quarantined = []
+        return quarantined
+
+    def report(self):
+        return 'budget: {words} words and {figures} figures quarantined (word: {word_seconds}s, figure: {figure_seconds}s, max outputs: {max_outputs})'.format(
+            words=self.counts["word"], figures=self.counts["figure"], word_seconds=self.word_seconds,
+            figure_seconds=self.figure_seconds, max_outputs=self.max_outputs)
+
+
+class FigureBudget:
+    # The deadlines for one figure (and its current word). One per
+    # match_figure call, so threads matching different figures don't share
+    # any timing state.
+    def __init__(self, budget):
+        self.budget = budget
+        self.figure_deadline = None
+        if budget.figure_seconds is not None:
+            self.figure_deadline = time.monotonic() + budget.figure_seconds
+        self.word_deadline = None
+
+    def check_figure(self):
+        now = time.monotonic()
+        if self.figure_deadline is not None and now > self.figure_deadline:
+            raise FigureBudgetExceeded("took more than %ss" % self.budget.figure_seconds)
+        return now
+
+    def start_word(self, word):
+        now = self.check_figure()
+        if word in self.budget.quarantined_words:
+            raise WordBudgetExceeded("quarantined earlier in this run")
+        if self.budget.word_seconds is not None:
+            self.word_deadline = now + self.budget.word_seconds
+
+    def check(self, transform_name, output_count):
+        # after each transform call
+        max_outputs = self.budget.max_outputs
+        if max_outputs is not None and output_count > max_outputs:
+            raise WordBudgetExceeded("%s returned %s words (max %s)" % (transform_name, output_count, max_outputs))
+        if self.word_deadline is not None and time.monotonic() > self.word_deadline:
+            raise WordBudgetExceeded("took more than %ss, at %s" % (self.budget.word_seconds, transform_name))
+        self.check_figure()
+
+
+def apply_transforms(word, transforms_to_apply, symbol_ids_by_symbol, stats=None, budget=None):
+    # Runs the transform chain over one OCR word.
+    # Returns (hits, intermediates):
+    # * hits: (transform_count, symbol_id, transformed_word) for every lexicon
+    #   hit, in the order match.match has always recorded them
+    # * intermediates: the words carried forward after each transform
+    # With stats (a TransformStats), each transform call is timed.
+    # With budget (a FigureBudget), WordBudgetExceeded or FigureBudgetExceeded
+    # is raised once a transform call goes over it.
+    hits = []
+    intermediates = []
+    transforms_applied = []
+    transformed_words = [word]
+    for transform_to_apply in transforms_to_apply:
+        transforms_applied.append(transform_to_apply["name"])
+        # NOTE: transformed_words is reset for each transformed_word_prev, so
+        # only the last one's output is carried to the next transform. Every
+        # output is still checked against the lexicon.
+        for transformed_word_prev in transformed_words:
+            transformed_words = []
+            if stats is None and budget is None:
+                outputs = transform_to_apply["transform"](transformed_word_prev)
+            else:
+                start = time.perf_counter()
+                outputs = list(transform_to_apply["transform"](transformed_word_prev))
+                if stats is not None:
+                    stats.record_call(len(transforms_applied) - 1, time.perf_counter() - start, len(outputs))
+                if budget is not None:
+                    budget.check(transform_to_apply["name"], len(outputs))
+            for transformed_word in outputs:
+                # perform match for original and uppercased words (see elif)
+                try:
+                    if transformed_word in symbol_ids_by_symbol:
+                        hits.append((len(transforms_applied), symbol_ids_by_symbol[transformed_word], transformed_word))
+                    elif transformed_word.upper() in symbol_ids_by_symbol:
+                        hits.append((len(transforms_applied), symbol_ids_by_symbol[transformed_word.upper()], transformed_word.upper()))
+                    else:
+                        transformed_words.append(transformed_word)
+
+                except(Exception) as e:
+                    print('Unexpected Error:', e)
+                    print('word:', word)
+                    print('transformed_word:', transformed_word)
+                    print('transforms_applied:', transforms_applied)
+                    raise
+        intermediates.append(tuple(transformed_words))
+    return tuple(hits), tuple(intermediates)
+
+
+def call_batch(transform_to_apply, words):
+    # (outputs, parents) from the transform's batch form (see
+    # transforms.get_batch), else from calling it once per word
+    transform_batch = transform_to_apply.get("batch")
+    if transform_batch is not None:
+        return transform_batch(words)
+    outputs = []
+    parents = []
+    for parent, word in enumerate(words):
+        for output in transform_to_apply["transform"](word):
+            outputs.append(output)
+            parents.append(parent)
+    return outputs, parents
+
+
+def apply_transforms_batch(words, transforms_to_apply, symbol_ids_by_symbol, stats=None, budget=None):
+    # Same as [apply_transforms(word, ...) for word in words], for unique
+    # words, but each transform is called once per stage, on all the unique
+    # words still going through the chain (so transforms must be pure).
+    # With budget (a FigureBudget), the figure deadline is checked between
+    # stages. A word that a transform turns into more than max_outputs words
+    # gets None instead of a result, and so does every word if a stage takes
+    # longer than word_seconds, so that the caller can redo them one at a
+    # time with apply_transforms and find the word that's over budget.
+    word_seconds = max_outputs = None
+    if budget is not None:
+        word_seconds = budget.budget.word_seconds
+        max_outputs = budget.budget.max_outputs
+    hits = [[] for _ in words]
+    intermediates = [[] for _ in words]
+    # the words carried forward for each word, or None once it's over budget
+    carried = [[word] for word in words]
+    for position, transform_to_apply in enumerate(transforms_to_apply):
+        if budget is not None:
+            budget.check_figure()
+        input_indices = {}
+        inputs = []
+        for prevs in carried:
+            for prev in prevs or []:
+                if prev not in input_indices:
+                    input_indices[prev] = len(inputs)
+                    inputs.append(prev)
+        start = time.perf_counter()
+        outputs, parents = call_batch(transform_to_apply, inputs)
+        seconds = time.perf_counter() - start
+        if stats is not None:
+            stats.record_batch(position, seconds, len(inputs), len(outputs))
+        if word_seconds is not None and seconds > word_seconds:
+            return [None] * len(words)
+        outputs_by_input = [[] for _ in inputs]
+        for output, parent in zip(outputs, parents):
+            outputs_by_input[parent].append(output)
+
+        transform_count = position + 1
+        for i, prevs in enumerate(carried):
+            if prevs is None:
+                continue
+            # NOTE: as in apply_transforms, only the last prev's outputs are
+            # carried forward, but every output is checked against the lexicon.
+            transformed_words = []
+            for prev in prevs:
+                transformed_words = []
+                prev_outputs = outputs_by_input[input_indices[prev]]
+                if max_outputs is not None and len(prev_outputs) > max_outputs:
+                    transformed_words = None
+                    break
+                for transformed_word in prev_outputs:
+                    if transformed_word in symbol_ids_by_symbol:
+                        hits[i].append((transform_count, symbol_ids_by_symbol[transformed_word], transformed_word))
+                    elif transformed_word.upper() in symbol_ids_by_symbol:
+                        hits[i].append((transform_count, symbol_ids_by_symbol[transformed_word.upper()], transformed_word.upper()))
+                    else:
+                        transformed_words.append(transformed_word)
+            carried[i] = transformed_words
+            if transformed_words is not None:
+                intermediates[i].append(tuple(transformed_words))
+    return [
+        None if carried[i] is None else (tuple(hits[i]), tuple(intermediates[i]))
+        for i in range(len(words))]
+
+
+class TransformCache:
+    # Bounded LRU cache of apply_transforms results, keyed by word.
+    # A cache only holds results for one matcher (see key), so the word alone
+    # identifies an entry. With cache_dir set, the cache is loaded from and
+    # saved to <cache_dir>/<key>.pickle, so later runs start warm.
+    def __init__(self, key, maxsize=100000, cache_dir=None, stats=None):
+        self.key = key
+        self.stats = stats
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.new_entries = {}
+        # added by prefetch and not looked up yet
+        self.prefetched = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_path(self):
+        return Path(PurePath(self.cache_dir, self.key + ".pickle"))
+
+    def get(self, word):
+        value = self.entries.get(word)
+        if value is None:
+            self.misses += 1
+            return None
+        if word in self.prefetched:
+            # computed for this lookup, so it's a miss
+            self.prefetched.discard(word)
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.entries.move_to_end(word)
+        return value
+
+    def put(self, word, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[word] = value
+        self.entries.move_to_end(word)
+        if self.cache_dir:
+            self.new_entries[word] = value
+        while len(self.entries) > self.maxsize:
+            evicted_word, _ = self.entries.popitem(last=False)
+            self.prefetched.discard(evicted_word)
+            self.evictions += 1
+
+    def apply(self, word, transforms_to_apply, symbol_ids_by_symbol, budget=None):
+        # over budget, nothing is cached (see apply_transforms)
+        value = self.get(word)
+        if value is None:
+            value = apply_transforms(word, transforms_to_apply, symbol_ids_by_symbol, self.stats, budget)
+            self.put(word, value)
+        if self.stats is not None:
+            self.stats.record_hits(value[0])
+        return value
+
+    def prefetch(self, words, transforms_to_apply, symbol_ids_by_symbol, budget=None):
+        # Adds the words that aren't in the cache yet, transformed in one
+        # apply_transforms_batch. apply still does the lookups (and counts
+        # them), and handles the words the batch left out.
+        if self.maxsize <= 0:
+            return
+        skipped_words = budget.budget.quarantined_words if budget is not None else ()
+        missing = [word for word in dict.fromkeys(words) if word not in self.entries and word not in skipped_words]
+        # more than would fit would just evict each other
+        missing = missing[0:self.maxsize]
+        if not missing:
+            return
+        values = apply_transforms_batch(missing, transforms_to_apply, symbol_ids_by_symbol, self.stats, budget)
+        for word, value in zip(missing, values):
+            if value is not None:
+                self.put(word, value)
+                self.prefetched.add(word)
+
+    def drain_new(self):
+        # entries added since the last drain, e.g., to send back from a worker
+        new_entries = self.new_entries
+        self.new_entries = {}
+        return new_entries
+
+    def take_stats(self):
+        stats = {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        return stats
+
+    def merge(self, new_entries, stats):
+        for word, value in new_entries.items():
+            self.put(word, value)
+        self.hits += stats["hits"]
+        self.misses += stats["misses"]
+        self.evictions += stats["evictions"]
+
+    def load(self):
+        if not self.cache_dir:
+            return
+        path = self.get_path()
+        if not path.exists():
+            return
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        for word, value in saved.items():
+            self.entries[word] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path()
+        tmp_path = Path(PurePath(self.cache_dir, self.key + ".pickle.tmp"))
+        with open(tmp_path, "wb") as f:
+            pickle.dump(dict(self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.new_entries = {}
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return 'transform cache: {hits} hits, {misses} misses ({hit_rate:.1f}% hit rate), {evictions} evictions, {size} entries'.format(
+            hits=self.hits, misses=self.misses, hit_rate=hit_rate, evictions=self.evictions, size=len(self.entries))
@@ -0,0 +1,227 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from transform_chain import (
+    apply_transforms, apply_transforms_batch, Budget, FigureBudgetExceeded, TransformCache, TransformStats,
+    WordBudgetExceeded)
+
+
+def split(word):
+    return word.split("/")
+
+def upper(word):
+    return [word.upper()]
+
+def drop(word):
+    return []
+
+def slow(word):
+    time.sleep(0.05)
+    return [word]
+
+transforms_to_apply = [
+    {"name": "split", "category": "mutate", "transform": split},
+    {"name": "upper", "category": "normalize", "transform": upper},
+]
+symbol_ids_by_symbol = {"WNT1": 1, "wnt3": 3, "AKT": 7}
+
+
+class TestApplyTransforms(unittest.TestCase):
+
+    def test_hits_and_transform_counts(self):
+        hits, intermediates = apply_transforms("AKT/x", transforms_to_apply, symbol_ids_by_symbol)
+        self.assertEqual(hits, ((1, 7, "AKT"), ))
+        self.assertEqual(intermediates, (("x", ), ("X", )))
+
+    def test_uppercased_hit(self):
+        hits, _ = apply_transforms("akt", transforms_to_apply, symbol_ids_by_symbol)
+        self.assertEqual(hits, ((1, 7, "AKT"), ))
+
+    def test_only_last_output_is_carried_forward(self):
+        # wnt3 would hit after upper only if "wnt3" were carried, but "q" is last
+        hits, intermediates = apply_transforms("WNT1/wnt3/q", transforms_to_apply, symbol_ids_by_symbol)
+        self.assertEqual(hits, ((1, 1, "WNT1"), (1, 3, "wnt3")))
+        self.assertEqual(intermediates[-1], ("Q", ))
+
+    def test_empty_output(self):
+        hits, intermediates = apply_transforms("AKT", [{"name": "drop", "category": "normalize", "transform": drop}], symbol_ids_by_symbol)
+        self.assertEqual(hits, ())
+        self.assertEqual(intermediates, ((), ))
+
+
+class TestApplyTransformsBatch(unittest.TestCase):
+
+    words = ["AKT/x", "akt", "WNT1/wnt3/q", "", "x/AKT/x"]
+
+    def test_same_as_one_at_a_time(self):
+        expected = [apply_transforms(word, transforms_to_apply, symbol_ids_by_symbol) for word in self.words]
+        self.assertEqual(apply_transforms_batch(self.words, transforms_to_apply, symbol_ids_by_symbol), expected)
+        # with batch forms, which get the unique words of each stage
+        calls = []
+
+        def upper_batch(words):
+            calls.append(list(words))
+            return [word.upper() for word in words], list(range(len(words)))
+
+        batch_transforms = [transforms_to_apply[0], dict(transforms_to_apply[1], batch=upper_batch)]
+        self.assertEqual(apply_transforms_batch(self.words, batch_transforms, symbol_ids_by_symbol), expected)
+        self.assertEqual(calls, [["x", "q", ""]])
+
+    def test_max_outputs(self):
+        budget = Budget(max_outputs=2).start_figure()
+        results = apply_transforms_batch(["a/b/c", "AKT/x"], transforms_to_apply, symbol_ids_by_symbol, budget=budget)
+        self.assertIsNone(results[0])
+        self.assertEqual(results[1], apply_transforms("AKT/x", transforms_to_apply, symbol_ids_by_symbol))
+
+    def test_prefetch(self):
+        stats = TransformStats(transforms_to_apply)
+        cache = TransformCache("k", stats=stats)
+        cache.prefetch(["AKT/x", "akt", "AKT/x"], transforms_to_apply, symbol_ids_by_symbol)
+        self.assertEqual([r[3] for r in stats.rows()], [2, 1])
+        self.assertEqual(cache.apply("AKT/x", transforms_to_apply, symbol_ids_by_symbol)[0], ((1, 7, "AKT"), ))
+        cache.apply("AKT/x", transforms_to_apply, symbol_ids_by_symbol)
+        # the first lookup of a prefetched word is still a miss
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual([r[3] for r in stats.rows()], [2, 1])
+
+
+class TestTransformCache(unittest.TestCase):
+
+    def test_hit_rate(self):
+        cache = TransformCache("k", maxsize=10)
+        first = cache.apply("AKT/x", transforms_to_apply, symbol_ids_by_symbol)
+        second = cache.apply("AKT/x", transforms_to_apply, symbol_ids_by_symbol)
+        self.assertEqual(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = TransformCache("k", maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_persistence(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = TransformCache("k", cache_dir=cache_dir)
+            cache.apply("AKT", transforms_to_apply, symbol_ids_by_symbol)
+            cache.save()
+
+            warm = TransformCache("k", cache_dir=cache_dir)
+            warm.load()
+            self.assertEqual(warm.get("AKT"), cache.get("AKT"))
+            self.assertEqual(warm.hits, 1)
+
+            other = TransformCache("other", cache_dir=cache_dir)
+            other.load()
+            self.assertEqual(len(other.entries), 0)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_merge(self):
+        worker = TransformCache("k", cache_dir="unused")
+        worker.apply("AKT", transforms_to_apply, symbol_ids_by_symbol)
+        parent = TransformCache("k")
+        parent.merge(worker.drain_new(), worker.take_stats())
+        self.assertIn("AKT", parent.entries)
+        self.assertEqual(parent.misses, 1)
+        self.assertEqual(worker.drain_new(), {})
+
+
+class TestTransformStats(unittest.TestCase):
+
+    def test_calls_fan_out_and_hits(self):
+        stats = TransformStats(transforms_to_apply)
+        cache = TransformCache("k", stats=stats)
+        cache.apply("WNT1/wnt3/q", transforms_to_apply, symbol_ids_by_symbol)
+        cache.apply("WNT1/wnt3/q", transforms_to_apply, symbol_ids_by_symbol)
+        rows = stats.rows()
+        # calls are only counted for the uncached word, hits for both
+        self.assertEqual([(r[1], r[3], r[6], r[7]) for r in rows], [("split", 1, 3, 4), ("upper", 1, 1, 0)])
+        self.assertGreater(rows[0][5], 0)
+        self.assertIn("split (m)", stats.report())
+
+    def test_take_and_merge(self):
+        worker = TransformStats(transforms_to_apply)
+        apply_transforms("AKT/x", transforms_to_apply, symbol_ids_by_symbol, worker)
+        parent = TransformStats(transforms_to_apply)
+        parent.merge(worker.take())
+        parent.merge(worker.take())
+        self.assertEqual([r[3] for r in parent.rows()], [1, 1])
+        self.assertEqual(sum(parent.stages[0]["histogram"]), 1)
+        self.assertEqual([r[3] for r in worker.rows()], [0, 0])
+
+    def test_p95(self):
+        stats = TransformStats(transforms_to_apply)
+        for _ in range(95):
+            stats.record_call(0, 0.0001, 1)
+        for _ in range(5):
+            stats.record_call(0, 1.0, 1)
+        self.assertTrue(0.0001 <= stats.p95(0) < 0.0001 * 1.25 ** 2)
+        self.assertEqual(stats.p95(1), 0.0)
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_max_outputs(self):
+        budget = Budget(max_outputs=2)
+        figure_budget = budget.start_figure()
+        figure_budget.start_word("a/b/c")
+        with self.assertRaises(WordBudgetExceeded) as cm:
+            apply_transforms("a/b/c", transforms_to_apply, symbol_ids_by_symbol, budget=figure_budget)
+        self.assertIn("split returned 3 words", cm.exception.reason)
+        # within the limit, same results as without a budget
+        figure_budget.start_word("AKT/x")
+        self.assertEqual(
+            apply_transforms("AKT/x", transforms_to_apply, symbol_ids_by_symbol, budget=figure_budget),
+            apply_transforms("AKT/x", transforms_to_apply, symbol_ids_by_symbol))
+
+    def test_word_seconds_in_a_thread(self):
+        # no signals involved, so this works outside the main thread too
+        slow_transforms = [{"name": "slow", "category": "mutate", "transform": slow}] * 3
+        budget = Budget(word_seconds=0.01, figure_seconds=None)
+        errors = []
+
+        def run():
+            figure_budget = budget.start_figure()
+            figure_budget.start_word("x")
+            try:
+                apply_transforms("x", slow_transforms, symbol_ids_by_symbol, budget=figure_budget)
+            except(WordBudgetExceeded) as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertIn("at slow", errors[0].reason)
+
+    def test_figure_seconds(self):
+        budget = Budget(word_seconds=None, figure_seconds=0.0)
+        figure_budget = budget.start_figure()
+        time.sleep(0.001)
+        with self.assertRaises(FigureBudgetExceeded):
+            figure_budget.start_word("x")
+
+    def test_quarantine(self):
+        budget = Budget()
+        budget.quarantine(5, "a/b/c", WordBudgetExceeded("too many"))
+        # a quarantined word is skipped from then on
+        with self.assertRaises(WordBudgetExceeded):
+            budget.start_figure().start_word("a/b/c")
+        quarantined = budget.take_quarantined()
+        self.assertEqual(quarantined, [(5, "word", "too many", "a/b/c")])
+        self.assertEqual(budget.take_quarantined(), [])
+        parent = Budget()
+        parent.count(quarantined)
+        self.assertEqual(parent.counts, {"word": 1, "figure": 0})
+        self.assertIn("a/b/c", parent.quarantined_words)
+
+
+if __name__ == '__main__':
+    unittest.main()
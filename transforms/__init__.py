@@ -1,6 +1,7 @@
 from . import alphanumeric
 from . import deburr
 from . import expand
+from . import expand_gm
 from . import swaps
 from . import nfkc
 from . import noop
@@ -8,5 +9,6 @@ from . import root
 from . import stop
 from . import upper
 from . import homoglyphs2ascii
-__all__ = ["alphanumeric", "deburr", "expand", "swaps", "nfkc",
+from .batch import get_batch
+__all__ = ["alphanumeric", "deburr", "expand", "expand_gm", "swaps", "nfkc",
            "noop", "root", "stop", "upper", "homoglyphs2ascii"]
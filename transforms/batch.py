@@ -0,0 +1,145 @@
+# Batch forms of the transforms: name_batch(words) takes a sequence of unique
+# words and returns (outputs, parents), a flat list of output words and, for
+# each, the index of the word in words it came from. The outputs for a word
+# are the same, and in the same order, as name(word) would return.
+#
+# get_batch(name) finds the batch form of a transform: a name_batch function
+# in the transform's own module, else one of the built-ins below, else a loop
+# over the single-word function, so custom transforms work unchanged.
+#
+# NOTE: match.py identifies a transform by the code hash of transforms/<name>.py,
+# which doesn't cover this file. A built-in here must give exactly the results
+# of the single-word function (see batch.test.py).
+
+import importlib
+import re
+import unicodedata
+
+from . import alphanumeric
+from . import root
+from . import stop
+
+# Several transforms run over all of the words joined by SEPARATOR at once,
+# e.g., one regex sub or one unicodedata.normalize call instead of one per
+# word. None of them produce or remove a SEPARATOR, and none combine the
+# characters on either side of it, so splitting the result gives the
+# per-word results. Words containing SEPARATOR themselves go one at a time.
+SEPARATOR = "\n"
+
+alphanumeric_joined_re = re.compile("[^a-zA-Z0-9" + SEPARATOR + "]")
+
+
+def map_joined(f, words):
+    # [f(word) for word in words], computed as f(SEPARATOR.join(words)) when that works
+    if not words:
+        return []
+    joined = SEPARATOR.join(words)
+    if joined.count(SEPARATOR) == len(words) - 1:
+        results = f(joined).split(SEPARATOR)
+        if len(results) == len(words):
+            return results
+    return [f(word) for word in words]
+
+
+def one_each(words, results):
+    # (outputs, parents) for transforms that return exactly one word per word
+    return results, list(range(len(words)))
+
+
+def from_single(transform):
+    # batch form of a single-word transform
+    def transform_batch(words):
+        outputs = []
+        parents = []
+        for parent, word in enumerate(words):
+            for output in transform(word):
+                outputs.append(output)
+                parents.append(parent)
+        return outputs, parents
+    return transform_batch
+
+
+def noop_batch(words):
+    return one_each(words, list(words))
+
+
+def upper_batch(words):
+    return one_each(words, map_joined(str.upper, words))
+
+
+def nfkc_batch(words):
+    return one_each(words, map_joined(lambda s: unicodedata.normalize("NFKC", s), words))
+
+
+def deburr_joined(s):
+    nfkd_form = unicodedata.normalize("NFKD", s)
+    # nothing to remove from ASCII, which most OCR words are
+    if nfkd_form.isascii():
+        return nfkd_form
+    return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
+
+
+def deburr_batch(words):
+    return one_each(words, map_joined(deburr_joined, words))
+
+
+def alphanumeric_batch(words):
+    if not words:
+        return one_each(words, [])
+    joined = SEPARATOR.join(words)
+    if joined.count(SEPARATOR) == len(words) - 1:
+        return one_each(words, alphanumeric_joined_re.sub("", joined).split(SEPARATOR))
+    return one_each(words, [alphanumeric.normalize_re.sub("", word) for word in words])
+
+
+def stop_batch(words):
+    stop_set = frozenset(stop.stop_list)
+    alphanumerics, _ = alphanumeric_batch(words)
+    outputs = []
+    parents = []
+    for parent, (word, alphanumerics_word) in enumerate(zip(words, alphanumerics)):
+        if alphanumerics_word.upper() not in stop_set:
+            outputs.append(word)
+            parents.append(parent)
+    return outputs, parents
+
+
+def root_batch(words):
+    prefix_sub = root.prefix_re.sub
+    suffix_sub = root.suffix_re.sub
+    plural_sub = root.plural_re.sub
+    outputs = []
+    parents = []
+    for parent, word in enumerate(words):
+        # the same set, built in the same order, as root.root, so the outputs
+        # come out in the same order
+        result = set()
+        result.add(prefix_sub("", word))
+        result.add(suffix_sub("", word))
+        singular = plural_sub("", word)
+        if len(singular) > 2:
+            result.add(singular)
+        outputs.extend(result)
+        parents.extend([parent] * len(result))
+    return outputs, parents
+
+
+BATCH_TRANSFORMS = {
+    "alphanumeric": alphanumeric_batch,
+    "deburr": deburr_batch,
+    "nfkc": nfkc_batch,
+    "noop": noop_batch,
+    "root": root_batch,
+    "stop": stop_batch,
+    "upper": upper_batch,
+}
+
+
+def get_batch(name):
+    module = importlib.import_module("." + name, __package__)
+    transform_batch = getattr(module, name + "_batch", None)
+    if transform_batch is None:
+        transform_batch = BATCH_TRANSFORMS.get(name)
+    if transform_batch is None:
+        transform_batch = from_single(getattr(module, name))
+    return transform_batch
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+# batch.py uses relative imports, so import it through the transforms package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from transforms import batch, get_batch
+
+words = ["WNT1", "wnt1", "p-AKT1", "Flag-MYC-GTP", "cells", "IKKγ", "TGF-β1", "Straße", "ﬁx", "Ⅻ", "é",
+         "CO2", "cAMP", "HR", "type", "a\nb", "", "-", "VEGF-A/B", "5-HT2A/2B", "Ca2+"]
+
+
+def single_results(transform, words):
+    outputs = []
+    parents = []
+    for parent, word in enumerate(words):
+        for output in transform(word):
+            outputs.append(output)
+            parents.append(parent)
+    return outputs, parents
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_built_ins_match_single_word_transforms(self):
+        for name in batch.BATCH_TRANSFORMS:
+            transform = getattr(__import__("transforms." + name, fromlist=[name]), name)
+            self.assertEqual(get_batch(name)(words), single_results(transform, words), name)
+            self.assertEqual(get_batch(name)(words[0:3]), single_results(transform, words[0:3]), name)
+            self.assertEqual(get_batch(name)([]), ([], []), name)
+
+    def test_fallback_to_single_word_transform(self):
+        from transforms import expand
+        self.assertEqual(get_batch("expand")(["WNT9/10", "x"]), single_results(expand.expand, ["WNT9/10", "x"]))
+
+    def test_map_joined_separator_in_word(self):
+        self.assertEqual(batch.map_joined(str.upper, ["a\nb", "c"]), ["A\nB", "C"])
+
+
+if __name__ == '__main__':
+    unittest.main()
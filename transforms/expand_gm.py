@@ -0,0 +1,155 @@
+import re
+
+# Expands gene mentions with ranges and enumerations, like expand, but
+# following the grammar in gene_mentions/gm (gmLexer.g4, gmParser.g4):
+#
+#   gms         : gm (ENUMSEP gm)*
+#   gm          : base INTEGER RANGESEP base INTEGER       e.g., ABC1-ABC3
+#               | base suffix (ENUMSEP suffix)*           e.g., WNT9/10, KDM6A/B, AdipoR1/R2
+#   suffix      : INTEGER RANGESEP INTEGER | INTEGER WORD? | WORD INTEGER?
+#
+# A word is split into chunks at each ENUMSEP. The first chunk, and any later
+# chunk that isn't a short suffix, is a whole symbol (maybe a range, e.g.,
+# HCK1-3). A short suffix (5, 3-5, B, 2B or R2) replaces the same-shaped end
+# of the nearest whole symbol before it, e.g., KDM6A/B => KDM6A, KDM6B and
+# p38/ERK1/2 => p38, ERK1, ERK2.
+#
+# Unlike expand:
+# * words without any separator are returned as they are, after one regex
+#   search, which is most OCR words
+# * each chunk's own shape decides how it's expanded, instead of the last
+#   chunk's shape deciding for all of them
+# * "and"/"or" enumerations work, e.g., TLR1,2 and 5, as do repeated bases,
+#   e.g., ABC1-ABC3
+# * results come out in order (first chunk first), without duplicates
+#
+# Ranges stay capped: one that would give more than MAX_RANGE_SIZE words, or
+# doesn't go up (e.g., 4000-3295), is left as it is.
+
+MAX_RANGE_SIZE = 30
+
+# cheap check for anything to expand
+separator_re = re.compile(r"[-/,&|]|\d(?:and|or)|\s(?:and|or|to|through|thru)\s")
+
+# ENUMSEP: 1/2, 1, 2, 1 & 2, 1|2, 1, and 2, 1 and 2, 1or2. The first form
+# alone is much faster to split on, so the rest are only tried on words
+# that have an "and" or "or".
+enum_char_sep_re = re.compile(r"\s*[/,&|]+\s*")
+enum_sep_re = re.compile(r"\s*[/,&|]+\s*(?:(?:and|or)\s+)?|,?\s+(?:and|or)\s+|(?<=\d)(?:and|or)\s*(?=\d)")
+RANGE_SEP = r"(?:\s*-\s*|\s+(?:to|through|thru)\s+)"
+# symbol ranges: base start RANGESEP [base] end, where base ends in a non-digit
+range_re = re.compile(r"(.+\D)(\d+)" + RANGE_SEP + r"(?:\1)?(\d+)")
+# range suffixes, e.g., the 3-5 in WNT1/3-5
+suffix_range_re = re.compile(r"(\d+)" + RANGE_SEP + r"(\d+)")
+
+ASCII_DIGITS = "0123456789"
+ASCII_LETTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def get_suffix_shape(chunk):
+    # "digits" (5), "range" (3-5), "letter" (B), "digit_letter" (2B) or
+    # "letter_digits" (R2), or None if chunk isn't a short suffix
+    if not chunk.isascii():
+        return None
+    if chunk.isdigit():
+        return "digits"
+    if len(chunk) == 1:
+        return "letter" if chunk.isalpha() else None
+    if chunk[-1].isalpha() and chunk[0:-1].isdigit():
+        return "digit_letter"
+    if chunk[0].isalpha() and chunk[1:].isdigit():
+        return "letter_digits"
+    if suffix_range_re.fullmatch(chunk):
+        return "range"
+    return None
+
+
+def get_base(first_chunk, shape):
+    # first_chunk without the end a suffix of this shape replaces, e.g., the
+    # 1 in WNT1a (digits, range), the A in KDM6A (letter), the 2A in 5-HT2A
+    # (digit_letter) or the R1 in AdipoR1 (letter_digits). "" if it doesn't
+    # end that way.
+    if shape == "letter":
+        end = len(first_chunk) - 1 if first_chunk[-1] in ASCII_LETTERS else len(first_chunk)
+    elif shape == "letter_digits":
+        without_digits = first_chunk.rstrip(ASCII_DIGITS)
+        end = len(without_digits) - 1
+        if without_digits == first_chunk or without_digits[-1:] not in ASCII_LETTERS:
+            end = len(first_chunk)
+    else:
+        without_letters = first_chunk.rstrip(ASCII_LETTERS)
+        end = len(without_letters.rstrip(ASCII_DIGITS))
+        if end == len(without_letters):
+            end = len(first_chunk)
+    if end <= 0 or end == len(first_chunk):
+        return ""
+    return first_chunk[0:end]
+
+
+def expand_range(base, start, end):
+    # [base + start, ..., base + end], or None if it's not a range to expand
+    from_digit = int(start)
+    to_digit = int(end)
+    if from_digit < to_digit and to_digit - from_digit < MAX_RANGE_SIZE:
+        return [base + str(d) for d in range(from_digit, to_digit + 1)]
+    return None
+
+
+def match_range(chunk):
+    # only chunks with a RANGESEP can be ranges
+    if "-" in chunk or " " in chunk:
+        return range_re.fullmatch(chunk)
+    return None
+
+
+def expand_symbol(chunk, m):
+    # m: match_range(chunk)
+    if m:
+        expanded = expand_range(m.group(1), m.group(2), m.group(3))
+        if expanded:
+            return expanded
+    return [chunk]
+
+
+def expand_gm(word):
+    if not word:
+        return []
+    if not separator_re.search(word):
+        return [word]
+
+    word = word.strip("/,&| ")
+    if not word:
+        return []
+    if "and" in word or "or" in word:
+        chunks = enum_sep_re.split(word)
+    else:
+        chunks = enum_char_sep_re.split(word)
+    results = []
+    base_chunk = None
+    bases = {}
+    for chunk in chunks:
+        if not chunk:
+            continue
+        # a short suffix replaces the same-shaped end of the nearest full
+        # chunk before it, e.g., the ERK1 in p38/ERK1/2
+        shape = get_suffix_shape(chunk) if base_chunk else None
+        if shape:
+            base = bases.get(shape)
+            if base is None:
+                base = bases[shape] = get_base(base_chunk, shape)
+            if base:
+                if shape == "range":
+                    start, end = suffix_range_re.fullmatch(chunk).groups()
+                    results.extend(expand_range(base, start, end) or [base + chunk])
+                else:
+                    results.append(base + chunk)
+                continue
+        m = match_range(chunk)
+        results.extend(expand_symbol(chunk, m))
+        # a range (e.g., SMAD1-3/5) is the base for its suffixes
+        base_chunk = m.group(1) + m.group(2) if m else chunk
+        bases = {}
+    if len(results) == 2:
+        # the usual case, e.g., WNT9/10
+        return results if results[0] != results[1] else results[0:1]
+    return list(dict.fromkeys(results))
@@ -0,0 +1,58 @@
+import importlib.util
+import os
+import types
+import unittest
+import expand_gm
+
+# expand.test.py's cases, run against expand_gm (sets, since expand's order
+# isn't defined)
+spec = importlib.util.spec_from_file_location(
+    "expand_test", os.path.join(os.path.dirname(os.path.abspath(__file__)), "expand.test.py"))
+expand_test = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(expand_test)
+expand_test.expand = types.SimpleNamespace(expand=expand_gm.expand_gm)
+
+
+class TestExpandGmWithExpandCases(expand_test.TestExpand):
+    pass
+
+
+class TestExpandGm(unittest.TestCase):
+
+    def test_no_separator(self):
+        self.assertEqual(expand_gm.expand_gm('AKT1'), ['AKT1'])
+        self.assertEqual(expand_gm.expand_gm('cells'), ['cells'])
+        self.assertEqual(expand_gm.expand_gm(''), [])
+
+    def test_enum_words(self):
+        for word in ['TLR1,2, and 5', 'TLR1,2 and 5', 'TLR1,2 or 5', 'TLR1,2or 5']:
+            self.assertEqual(expand_gm.expand_gm(word), ['TLR1', 'TLR2', 'TLR5'], word)
+
+    def test_ranges(self):
+        self.assertEqual(expand_gm.expand_gm('ABC1-ABC3'), ['ABC1', 'ABC2', 'ABC3'])
+        self.assertEqual(expand_gm.expand_gm('SMAD1-3/5'), ['SMAD1', 'SMAD2', 'SMAD3', 'SMAD5'])
+        self.assertEqual(expand_gm.expand_gm('WNT1/3-5'), ['WNT1', 'WNT3', 'WNT4', 'WNT5'])
+        self.assertEqual(expand_gm.expand_gm('ABC1 to 3'), ['ABC1', 'ABC2', 'ABC3'])
+
+    def test_suffix_of_nearest_symbol(self):
+        self.assertEqual(expand_gm.expand_gm('p38/ERK1/2'), ['p38', 'ERK1', 'ERK2'])
+        self.assertEqual(expand_gm.expand_gm('MEK1/2/ERK'), ['MEK1', 'MEK2', 'ERK'])
+        self.assertEqual(expand_gm.expand_gm('MEK1/2/ERK1/2'), ['MEK1', 'MEK2', 'ERK1', 'ERK2'])
+        self.assertEqual(expand_gm.expand_gm('AKT1/HCK1-3/5'), ['AKT1', 'HCK1', 'HCK2', 'HCK3', 'HCK5'])
+
+    def test_range_cap(self):
+        self.assertEqual(len(expand_gm.expand_gm('HOXA1-30')), 30)
+        self.assertEqual(expand_gm.expand_gm('HOXA1-31'), ['HOXA1-31'])
+        self.assertEqual(expand_gm.expand_gm('ABC1-5000'), ['ABC1-5000'])
+
+    def test_order_without_duplicates(self):
+        self.assertEqual(expand_gm.expand_gm('WNT9/10/9'), ['WNT9', 'WNT10'])
+        self.assertEqual(expand_gm.expand_gm('TLR2/1'), ['TLR2', 'TLR1'])
+
+    def test_not_expanded(self):
+        for word in ['p-AKT', 'IL-12', '4000-3295', 'NF-kB']:
+            self.assertEqual(expand_gm.expand_gm(word), [word])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,10 @@
 ## Replaces character strings in uppercased words with matched strings in "swaps" dictionary.
 
+import hashlib
+import re
+
+from .batch import map_joined, one_each
+
 # NOTE: entries should be upper and may contain non-alphanumerics
 swap_list = {
 'ALPHA':'A',
@@ -41,10 +46,87 @@ swap_list = {
 'EB13':'EBI3'
 }
 
+# Extra swaps can be loaded from tab-separated files, one "FROM<TAB>TO" per
+# line (blank lines and lines starting with # are skipped), with
+# load_swap_tables, e.g., via pfocr.py match --swap-table FILE. They're
+# added to swap_list, and override it for the same FROM.
+#
+# The table is compiled into one regex, with longer keys first, so each word
+# takes a single left-to-right pass, and where keys overlap the longest one
+# wins, e.g., III => 3 (not 2I). Replacements aren't swapped again.
+# Words are uppercased first, so lowercase keys (e.g., the Greek letters)
+# match their uppercase forms.
+
+swap_table_paths = []
+swap_table = dict(swap_list)
+
+
+def compile_swaps(table):
+    replacements = dict(table)
+    for key, value in table.items():
+        upper_key = key.upper()
+        # e.g., not ß, which uppercases to SS
+        if len(upper_key) == len(key) and upper_key not in replacements:
+            replacements[upper_key] = value
+    keys = sorted(replacements, key=lambda k: (-len(k), k))
+    if not keys:
+        # never matches
+        return re.compile("(?!)"), replacements
+    return re.compile("|".join(re.escape(k) for k in keys)), replacements
+
+
+swap_re, swap_replacements = compile_swaps(swap_table)
+
+
+def read_swap_table(path):
+    table = {}
+    with open(path, "r", encoding="utf8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) != 2 or not fields[0]:
+                raise ValueError('%s line %s: expected "FROM<TAB>TO"' % (path, line_number))
+            table[fields[0]] = fields[1]
+    return table
+
+
+def load_swap_tables(paths):
+    global swap_table, swap_re, swap_replacements
+    table = dict(swap_list)
+    for path in paths:
+        table.update(read_swap_table(path))
+    swap_table_paths[:] = paths
+    swap_table = table
+    swap_re, swap_replacements = compile_swaps(swap_table)
+
+
+def get_data_hash():
+    # identifies the extra tables for match.py; None when there are none
+    if not swap_table_paths:
+        return None
+    return hashlib.sha224(repr(sorted(swap_table.items())).encode()).hexdigest()
+
+
+def replace(m):
+    return swap_replacements[m.group(0)]
+
+
+def swap_upper(text):
+    return swap_re.sub(replace, text.upper())
+
+
 def multipleReplace(text, wordDict):
-    for key in wordDict:
-        text = text.upper().replace(key, wordDict[key])
-    return text
+    if wordDict is swap_table or wordDict is swap_list:
+        return swap_upper(text)
+    pattern, replacements = compile_swaps(wordDict)
+    return pattern.sub(lambda m: replacements[m.group(0)], text.upper())
+
 
 def swaps(word):
-    return [multipleReplace(word, swap_list)]
+    return [swap_upper(word)]
+
+
+def swaps_batch(words):
+    return one_each(words, map_joined(swap_upper, words))
@@ -0,0 +1,65 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# swaps.py uses relative imports, so import it through the transforms package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from transforms import swaps
+
+
+class TestSwaps(unittest.TestCase):
+
+    def tearDown(self):
+        swaps.load_swap_tables([])
+
+    def test_swaps(self):
+        self.assertEqual(swaps.swaps('VE-cadherin'), ['CDH5'])
+        self.assertEqual(swaps.swaps('p13k'), ['PI3K'])
+        self.assertEqual(swaps.swaps('AKT1'), ['AKT1'])
+
+    def test_longest_key_wins(self):
+        self.assertEqual(swaps.swaps('III'), ['3'])
+        self.assertEqual(swaps.swaps('II'), ['2'])
+        self.assertEqual(swaps.swaps('PLASMINOGEN'), ['PLG'])
+        self.assertEqual(swaps.swaps('PLASMIN'), ['PLG'])
+        self.assertEqual(swaps.swaps('KSP-CADHERIN'), ['CDH16'])
+
+    def test_single_pass(self):
+        # leftmost first, and replacements aren't swapped again
+        self.assertEqual(swaps.swaps('TGFBRII'), ['TGFBR1I'])
+        self.assertEqual(swaps.swaps('IIII'), ['3I'])
+
+    def test_lowercase_keys(self):
+        self.assertEqual(swaps.swaps('TGF-β1'), ['TGF-B1'])
+        self.assertEqual(swaps.swaps('IKKγ'), ['IKKG'])
+        self.assertEqual(swaps.swaps('Straße'), ['STRASSE'])
+
+    def test_batch(self):
+        words = ['III', 'tnf-α', 'a\nii', '', 'E-cadherin']
+        self.assertEqual(swaps.swaps_batch(words), ([swaps.swaps(w)[0] for w in words], [0, 1, 2, 3, 4]))
+
+    def test_swap_table_file(self):
+        table_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(table_dir, 'swaps.tsv')
+            with open(path, 'w') as f:
+                f.write('# extra swaps\nHER2\tERBB2\n\nII\tTWO\n')
+            self.assertIsNone(swaps.get_data_hash())
+            swaps.load_swap_tables([path])
+            self.assertEqual(swaps.swaps('her2'), ['ERBB2'])
+            self.assertEqual(swaps.swaps('II'), ['TWO'])
+            self.assertEqual(swaps.swaps('III'), ['3'])
+            self.assertIsNotNone(swaps.get_data_hash())
+
+            with open(path, 'w') as f:
+                f.write('HER2 ERBB2\n')
+            with self.assertRaises(ValueError):
+                swaps.load_swap_tables([path])
+        finally:
+            shutil.rmtree(table_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()